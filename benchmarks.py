@@ -0,0 +1,1685 @@
+"""
+Benchmarks for the Gem Chatbot that run against a stubbed Gemini SDK.
+
+Nothing here talks to the real API, so results are reproducible and
+free. Run a single benchmark with, for example:
+
+    python benchmarks.py startup
+    python benchmarks.py imports
+    python benchmarks.py streams --streams 2000
+    python benchmarks.py flush
+    python benchmarks.py delta
+    python benchmarks.py dedup
+    python benchmarks.py search --messages 100000
+    python benchmarks.py failover --streams 500
+    python benchmarks.py coalesce --streams 500
+    python benchmarks.py prefetch
+    python benchmarks.py cancel --streams 200
+    python benchmarks.py transport --streams 200 --turns 5
+    python benchmarks.py load --clients 200 --turns 3 --output run.json
+    python benchmarks.py load --compare run.json
+    python benchmarks.py scale --workers 4
+    python benchmarks.py spill --clients 500 --turns 5
+
+``serve`` runs the real Gradio app against the fake backend, so it can
+be load tested from outside:
+
+    python benchmarks.py serve --chunk-delay 0.02 --port 7861
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from typing import Dict, List, Tuple
+
+
+# --------------------------------------------------------------------------
+# Fake Gemini SDK
+# --------------------------------------------------------------------------
+
+
+class ResourceExhausted(Exception):
+    """Fake 429, named like ``google.api_core.exceptions``."""
+
+
+class ServiceUnavailable(Exception):
+    """Fake 503, named like ``google.api_core.exceptions``."""
+
+
+class InvalidArgument(Exception):
+    """Fake 400, named like ``google.api_core.exceptions``."""
+
+
+class NotFound(Exception):
+    """Fake 404, named like ``google.api_core.exceptions``."""
+
+
+class FakeChunk:
+    """A streamed response chunk with a ``text`` attribute."""
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeChatSession:
+    """Minimal stand-in for ``genai.ChatSession``."""
+
+    def __init__(self, fake_model, history=None):
+        self.model = fake_model
+        self.history = list(history or [])
+
+    def send_message(self, message, stream=False):
+        chunks = self.model.reply_chunks(message)
+        self.history.append({"role": "user", "parts": [{"text": message}]})
+        self.history.append(
+            {"role": "model", "parts": [{"text": "".join(chunks)}]}
+        )
+        return self._iterate(chunks)
+
+    def _iterate(self, chunks):
+        for piece in chunks:
+            if self.model.chunk_delay:
+                time.sleep(self.model.chunk_delay)
+            yield FakeChunk(piece)
+
+    async def send_message_async(self, message, stream=False):
+        self.model.maybe_fail()
+        chunks = self.model.reply_chunks(message)
+        self.history.append({"role": "user", "parts": [{"text": message}]})
+        self.history.append(
+            {"role": "model", "parts": [{"text": "".join(chunks)}]}
+        )
+        return self._iterate_async(chunks)
+
+    async def _iterate_async(self, chunks):
+        if self.model.first_chunk_delay:
+            await asyncio.sleep(self.model.first_chunk_delay)
+        for piece in chunks:
+            if self.model.chunk_delay:
+                await asyncio.sleep(self.model.chunk_delay)
+            FakeGenerativeModel.chunks_sent += 1
+            yield FakeChunk(piece)
+
+
+class FakeGenerativeModel:
+    """Deterministic stand-in for ``genai.GenerativeModel``."""
+
+    chunk_size = 16
+    chunk_delay = 0.0
+    first_chunk_delay = 0.0
+    reply_chars = 400
+
+    # Error injection, shared by all instances
+    error_rate = 0.0
+    unavailable_rate: Dict[str, float] = {}
+    quotas: Dict[str, int] = {}
+    calls: Dict[str, int] = {}
+    chunks_sent = 0
+    rng = random.Random(3)
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+
+    def maybe_fail(self) -> None:
+        """Raise the configured fake 429/503 errors for this call."""
+        name = self.model_name.split("/")[-1]
+        calls = self.calls[name] = self.calls.get(name, 0) + 1
+        quota = self.quotas.get(name)
+        if quota is not None and calls > quota:
+            raise ResourceExhausted(
+                f"429 You exceeded your current quota for {name}"
+            )
+        if self.rng.random() < self.unavailable_rate.get(name, 0.0):
+            raise ServiceUnavailable(f"503 {name} is overloaded")
+        if self.rng.random() < self.error_rate:
+            raise ResourceExhausted("429 Rate limited, retry in 0.01s")
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
+
+    async def generate_content_async(self, contents):
+        return FakeChunk(f"Summary of {len(str(contents))} characters.")
+
+    def reply_chunks(self, message: str) -> List[str]:
+        seed = f"Echo: {message} "
+        text = (seed * (self.reply_chars // len(seed) + 1))
+        text = text[: self.reply_chars]
+        return [
+            text[i:i + self.chunk_size]
+            for i in range(0, len(text), self.chunk_size)
+        ]
+
+
+def install_fake_genai(list_delay: float = 0.0, models=None):
+    """Register a fake ``google.generativeai`` module in ``sys.modules``."""
+    model_names = models or [
+        "models/gemini-2.5-pro",
+        "models/gemini-2.5-flash",
+        "models/gemini-flash-latest",
+    ]
+    stats: Dict[str, int] = {"list_models": 0, "models_created": 0}
+
+    def configure(**kwargs):
+        return None
+
+    def list_models():
+        stats["list_models"] += 1
+        time.sleep(list_delay)
+        for name in model_names:
+            yield types.SimpleNamespace(
+                name=name,
+                supported_generation_methods=["generateContent"],
+            )
+
+    class CountingModel(FakeGenerativeModel):
+        def __init__(self, model_name: str):
+            stats["models_created"] += 1
+            super().__init__(model_name)
+
+    genai = types.ModuleType("google.generativeai")
+    genai.configure = configure
+    genai.list_models = list_models
+    genai.GenerativeModel = CountingModel
+    genai.stats = stats
+
+    google = sys.modules.get("google") or types.ModuleType("google")
+    google.generativeai = genai
+    sys.modules["google"] = google
+    sys.modules["google.generativeai"] = genai
+    os.environ.setdefault("GOOGLE_API_KEY", "fake-key-for-benchmarks")
+    return genai
+
+
+# --------------------------------------------------------------------------
+# Startup
+# --------------------------------------------------------------------------
+
+
+def _startup_child(args) -> None:
+    """Time ``import chatbot`` and the first model resolution."""
+    genai = install_fake_genai(list_delay=args.list_delay)
+
+    started = time.perf_counter()
+    import chatbot
+    imported = time.perf_counter()
+    chatbot.get_model()
+    resolved = time.perf_counter()
+
+    print(json.dumps({
+        "import_s": imported - started,
+        "first_resolve_s": resolved - imported,
+        "list_models_calls": genai.stats["list_models"],
+        "model": chatbot.model_name,
+    }))
+
+
+def bench_startup(args) -> Dict:
+    """Compare cold (discovery) and warm (cached) model resolution."""
+    cache_path = os.path.join(tempfile.mkdtemp(), "model_cache.json")
+    env = dict(os.environ, GEM_MODEL_CACHE=cache_path)
+    command = [
+        sys.executable, os.path.abspath(__file__), "_startup-child",
+        "--list-delay", str(args.list_delay),
+    ]
+
+    results = {}
+    for label in ("cold", "cached"):
+        output = subprocess.run(
+            command, env=env, check=True, capture_output=True, text=True,
+        ).stdout
+        results[label] = json.loads(output.strip().splitlines()[-1])
+
+    for label, result in results.items():
+        print(
+            f" {label:>6}: import {result['import_s'] * 1000:8.1f} ms"
+            f" | first request resolve "
+            f"{result['first_resolve_s'] * 1000:8.1f} ms"
+            f" | list_models calls {result['list_models_calls']}"
+        )
+    return results
+
+
+IMPORT_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import chatbot
+imported = time.perf_counter()
+result = {"import_s": imported - started, "ui_s": None, "ui_error": None}
+if sys.argv[1] == "ui":
+    try:
+        chatbot.get_demo()
+        result["ui_s"] = time.perf_counter() - imported
+    except ImportError as e:
+        result["ui_error"] = str(e)
+result["sdks_loaded"] = [
+    name for name in ("gradio", "google.generativeai") if name in sys.modules
+]
+print(json.dumps(result))
+"""
+
+
+def parse_importtime(stderr: str) -> Dict[str, int]:
+    """Cumulative microseconds of each top-level ``-X importtime`` entry."""
+    costs: Dict[str, int] = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth <= 1:
+            costs[name.strip()] = int(cumulative)
+    return costs
+
+
+def bench_imports(args) -> Dict:
+    """
+    Cold ``import chatbot`` cost with the real SDKs, with and without UI.
+
+    Runs in fresh interpreters under ``python -X importtime``. The
+    engine-only import must not load Gradio or the Gemini SDK; the UI
+    pass times ``get_demo()`` on top. Without Gradio installed the UI
+    pass reports the import error instead.
+    """
+    env = dict(
+        os.environ,
+        GEM_CHAT_STORE="memory://",
+        GEM_MODEL_CACHE=os.path.join(tempfile.mkdtemp(), "models.json"),
+    )
+    runs = max(1, args.iterations // 200)
+    results: Dict = {}
+    for label in ("engine", "ui"):
+        samples = []
+        for _ in range(runs):
+            run = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", IMPORT_PROBE,
+                 label],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env=env, capture_output=True, text=True, check=True,
+            )
+            result = json.loads(run.stdout.strip().splitlines()[-1])
+            result["costs"] = parse_importtime(run.stderr)
+            samples.append(result)
+        result = sorted(samples, key=lambda r: r["import_s"])[runs // 2]
+        costs = result.pop("costs")
+        costs.pop("chatbot", None)
+        slowest = sorted(costs.items(), key=lambda item: -item[1])[:5]
+        result["slowest_imports_ms"] = {
+            name: us / 1000 for name, us in slowest
+        }
+        results[label] = result
+
+    for label, result in results.items():
+        if result["ui_s"] is not None:
+            ui = f"{result['ui_s'] * 1000:.1f} ms"
+        else:
+            ui = result["ui_error"] or "skipped"
+        print(
+            f" {label:>6}: import {result['import_s'] * 1000:8.1f} ms"
+            f" | UI build {ui}"
+            f" | SDKs loaded: {', '.join(result['sdks_loaded']) or 'none'}"
+        )
+        print(
+            "         slowest imports: "
+            + ", ".join(
+                f"{name} {ms:.1f} ms"
+                for name, ms in result["slowest_imports_ms"].items()
+            )
+        )
+    return results
+
+
+# --------------------------------------------------------------------------
+# Concurrent streaming
+# --------------------------------------------------------------------------
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of ``values``."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = round(pct / 100 * len(ordered)) - 1
+    rank = max(0, min(len(ordered) - 1, rank))
+    return ordered[rank]
+
+
+def bench_streams(args) -> Dict:
+    """Run many async streams at once against the fake async backend."""
+    genai = install_fake_genai()
+    genai.GenerativeModel.first_chunk_delay = args.first_chunk_delay
+    genai.GenerativeModel.chunk_delay = args.chunk_delay
+
+    import chatbot
+    chatbot.get_model()
+
+    in_flight = 0
+    peak = 0
+    ttfts: List[float] = []
+
+    async def one_stream(i: int) -> None:
+        nonlocal in_flight, peak
+        history, conversation_id = chatbot.handle_user_message(
+            f"question {i}", []
+        )
+        started = time.perf_counter()
+        first = None
+        in_flight += 1
+        peak = max(peak, in_flight)
+        async for _ in chatbot.chat_response_stream(
+            history, conversation_id
+        ):
+            if first is None:
+                first = time.perf_counter() - started
+        in_flight -= 1
+        ttfts.append(first or 0.0)
+
+    async def run() -> float:
+        started = time.perf_counter()
+        await asyncio.gather(*(one_stream(i) for i in range(args.streams)))
+        return time.perf_counter() - started
+
+    elapsed = asyncio.run(run())
+    results = {
+        "streams": args.streams,
+        "peak_concurrent_streams": peak,
+        "ttft_p50_ms": percentile(ttfts, 50) * 1000,
+        "ttft_p99_ms": percentile(ttfts, 99) * 1000,
+        "wall_s": elapsed,
+    }
+    print(
+        f" {results['streams']} streams, peak concurrent "
+        f"{results['peak_concurrent_streams']}, TTFT p50 "
+        f"{results['ttft_p50_ms']:.1f} ms / p99 "
+        f"{results['ttft_p99_ms']:.1f} ms, wall {elapsed:.2f} s"
+    )
+    return results
+
+
+# --------------------------------------------------------------------------
+# UI flush policy
+# --------------------------------------------------------------------------
+
+
+def synthetic_history(messages: int, chars: int = 200) -> List[Dict]:
+    """A chat history of alternating user/assistant messages."""
+    history = []
+    for i in range(messages):
+        role = "user" if i % 2 == 0 else "assistant"
+        history.append({"role": role, "content": f"{role} {i} " * (
+            chars // (len(role) + len(str(i)) + 2)
+        )})
+    return history
+
+
+def bench_flush(args) -> Dict:
+    """Bytes and time spent per reply with and without flush coalescing."""
+    genai = install_fake_genai()
+    genai.GenerativeModel.chunk_size = args.chunk_size
+    genai.GenerativeModel.chunk_delay = args.chunk_delay
+    genai.GenerativeModel.reply_chars = args.reply_chars
+    # Both policies must stream from upstream: a cache hit would be
+    # replayed at the replay pace instead
+    os.environ.setdefault("GEM_RESPONSE_CACHE_SIZE", "0")
+
+    import chatbot
+    chatbot.get_model()
+
+    policies = {
+        "every_chunk": chatbot.StreamFlushPolicy(0, 0),
+        "coalesced": chatbot.flush_policy,
+    }
+
+    async def one_reply(prior: List[Dict]) -> Dict:
+        history = [dict(msg) for msg in prior]
+        history, _ = chatbot.handle_user_message("benchmark", history)
+        emitted = 0
+        yields = 0
+        started = time.perf_counter()
+        async for update in chatbot.chat_response_stream(history):
+            # What Gradio would serialize and ship for this yield
+            emitted += len(json.dumps(update))
+            yields += 1
+        return {
+            "yields": yields,
+            "bytes": emitted,
+            "seconds": time.perf_counter() - started,
+        }
+
+    results: Dict = {}
+    for size in (10, 100, 1000):
+        prior = synthetic_history(size)
+        for label, policy in policies.items():
+            chatbot.flush_policy = policy
+            result = asyncio.run(one_reply(prior))
+            results[f"{label}/{size}"] = result
+            print(
+                f" {label:>11} | history {size:>4} | "
+                f"{result['yields']:>4} yields | "
+                f"{result['bytes'] / 1024:10.1f} KiB | "
+                f"{result['seconds'] * 1000:8.1f} ms"
+            )
+    return results
+
+
+def bench_delta(args) -> Dict:
+    """Per-chunk payload of full-history vs delta-only streaming."""
+    genai = install_fake_genai()
+    genai.GenerativeModel.chunk_size = args.chunk_size
+    genai.GenerativeModel.reply_chars = args.reply_chars
+    # Chunks must arrive apart to be flushed apart, and both modes must
+    # generate: a cache hit would replay in different-sized pieces
+    genai.GenerativeModel.chunk_delay = args.chunk_delay
+    os.environ.setdefault("GEM_RESPONSE_CACHE_SIZE", "0")
+
+    import chatbot
+    chatbot.get_model()
+    chatbot.flush_policy = chatbot.StreamFlushPolicy(0, 0)
+
+    modes = {
+        "full": chatbot.chat_response_stream,
+        "delta": chatbot.chat_response_stream_delta,
+    }
+
+    async def one_reply(stream_fn, prior: List[Dict]) -> List[int]:
+        history = [dict(msg) for msg in prior]
+        history, _ = chatbot.handle_user_message("benchmark", history)
+        sizes = []
+        async for update in stream_fn(history):
+            sizes.append(len(json.dumps(update, default=str)))
+        return sizes
+
+    results: Dict = {}
+    for turns in (2, 200):
+        prior = synthetic_history(turns * 2)
+        for label, stream_fn in modes.items():
+            sizes = asyncio.run(one_reply(stream_fn, prior))
+            # The last yield is the final full sync in delta mode
+            per_chunk = sizes[:-1] or sizes
+            result = {
+                "yields": len(sizes),
+                "bytes_per_chunk": sum(per_chunk) / len(per_chunk),
+                "total_bytes": sum(sizes),
+            }
+            results[f"{label}/{turns}"] = result
+            print(
+                f" {label:>5} | {turns:>3} turns | "
+                f"{result['bytes_per_chunk']:10.1f} B/chunk | "
+                f"{result['total_bytes'] / 1024:10.1f} KiB total"
+            )
+    return results
+
+
+# --------------------------------------------------------------------------
+# Duplicate detection
+# --------------------------------------------------------------------------
+
+
+def bench_dedup(args) -> Dict:
+    """Deep-compare vs content-hash "already saved?" checks."""
+    install_fake_genai()
+    os.environ.setdefault("GEM_CHAT_STORE", "memory://")
+
+    import chatbot
+
+    chats = [synthetic_history(500) for _ in range(20)]
+    for i, history in enumerate(chats):
+        history[-1]["content"] += f" chat {i}"
+    # Same prefix as a saved chat, different last message: the worst
+    # case for a deep comparison
+    current = [dict(msg) for msg in chats[-1]]
+    current[-1]["content"] += " edited"
+
+    store = chatbot.MemoryChatStore()
+    for history in chats:
+        store.save_chat(
+            "bench", "t", history, chatbot.history_digest(history)
+        )
+    all_history = [{"history": history} for history in chats]
+    hasher = chatbot.ConversationHasher()
+    hasher.digest(current[:-2], "current")
+
+    def deep_compare():
+        return any(chat["history"] == current for chat in all_history)
+
+    def hashed():
+        digest = hasher.digest(current, "current")
+        return store.find_chat("bench", digest) is not None
+
+    results = {}
+    for label, check in (("deep_compare", deep_compare), ("hashed", hashed)):
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            check()
+        per_check = (time.perf_counter() - started) / args.iterations
+        results[label] = {"us_per_check": per_check * 1e6}
+        print(f" {label:>12}: {per_check * 1e6:10.2f} us per check")
+    return results
+
+
+# --------------------------------------------------------------------------
+# History search
+# --------------------------------------------------------------------------
+
+
+def synthetic_corpus(messages: int, per_chat: int = 100, seed: int = 7):
+    """Chats of random words drawn from a Zipf-ish vocabulary."""
+    rng = random.Random(seed)
+    vocabulary = [f"w{i:05d}" for i in range(20000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    chats = []
+    for start in range(0, messages, per_chat):
+        history = []
+        for i in range(min(per_chat, messages - start)):
+            words = rng.choices(vocabulary, weights, k=12)
+            role = "user" if i % 2 == 0 else "assistant"
+            history.append({"role": role, "content": " ".join(words)})
+        chats.append(history)
+    return chats, vocabulary
+
+
+def bench_search(args) -> Dict:
+    """Query latency of the in-process index and SQLite FTS5."""
+    install_fake_genai()
+    os.environ.setdefault("GEM_CHAT_STORE", "memory://")
+
+    import chatbot
+
+    chats, vocabulary = synthetic_corpus(args.messages)
+    rng = random.Random(11)
+    queries = [
+        " ".join(rng.sample(vocabulary[:2000], rng.choice((1, 2))))
+        for _ in range(args.queries)
+    ]
+
+    stores = {
+        "memory": chatbot.MemoryChatStore(),
+        "sqlite_fts5": chatbot.SQLiteChatStore(
+            os.path.join(tempfile.mkdtemp(), "search.db")
+        ),
+    }
+
+    results: Dict = {}
+    for label, store in stores.items():
+        started = time.perf_counter()
+        for i, history in enumerate(chats):
+            store.save_chat(
+                "bench", f"chat {i}", history, chatbot.history_digest(history)
+            )
+        build_s = time.perf_counter() - started
+
+        latencies = []
+        for query in queries:
+            started = time.perf_counter()
+            store.search("bench", query, limit=10)
+            latencies.append(time.perf_counter() - started)
+
+        results[label] = {
+            "messages": args.messages,
+            "build_s": build_s,
+            "query_p50_ms": percentile(latencies, 50) * 1000,
+            "query_p99_ms": percentile(latencies, 99) * 1000,
+        }
+        print(
+            f" {label:>11}: {args.messages} messages indexed in "
+            f"{build_s:.2f} s | query p50 "
+            f"{results[label]['query_p50_ms']:.2f} ms / p99 "
+            f"{results[label]['query_p99_ms']:.2f} ms"
+        )
+    return results
+
+
+# --------------------------------------------------------------------------
+# Retry and failover
+# --------------------------------------------------------------------------
+
+
+def bench_failover(args) -> Dict:
+    """Success rate under injected 429/503 errors and quota exhaustion."""
+    genai = install_fake_genai()
+    fake = genai.GenerativeModel
+    fake.error_rate = 0.2 if args.error_rate is None else args.error_rate
+    fake.quotas = {
+        "gemini-flash-latest": 100 if args.quota is None else args.quota
+    }
+    fake.unavailable_rate = {"gemini-2.5-flash": 0.5}
+    os.environ.setdefault("GEM_RESPONSE_CACHE_SIZE", "0")
+
+    import chatbot
+    chatbot.get_model()
+    chatbot.request_executor = chatbot.RequestExecutor(
+        base_delay=0.005, max_delay=0.05, breaker_threshold=3,
+        breaker_reset=0.5,
+    )
+
+    outcomes = {"ok": 0, "error": 0}
+
+    async def one_request(i: int) -> None:
+        history, conversation_id = chatbot.handle_user_message(
+            f"request {i}", []
+        )
+        async for _ in chatbot.chat_response_stream(
+            history, conversation_id
+        ):
+            pass
+        failed = "API Error" in history[-1]["content"]
+        outcomes["error" if failed else "ok"] += 1
+
+    async def run() -> None:
+        for start in range(0, args.streams, 50):
+            batch = range(start, min(args.streams, start + 50))
+            await asyncio.gather(*(one_request(i) for i in batch))
+
+    asyncio.run(run())
+    results = {
+        "outcomes": outcomes,
+        "executor": chatbot.request_executor.stats,
+        "upstream_calls": dict(fake.calls),
+        "breakers": chatbot.request_executor.breaker_states(),
+        "retried_after_trial": asyncio.run(breaker_trials(chatbot)),
+        "skipped_missing_fallback": asyncio.run(missing_fallback(chatbot)),
+    }
+    print(f" outcomes: {outcomes}")
+    print(f" executor: {results['executor']}")
+    print(f" upstream calls per model: {results['upstream_calls']}")
+    print(f" breakers: {results['breakers']}")
+    print(f" model retried after trial: {results['retried_after_trial']}")
+    print(
+        " served past a missing fallback: "
+        f"{results['skipped_missing_fallback']}"
+    )
+    return results
+
+
+async def missing_fallback(chatbot) -> bool:
+    """
+    Whether a request whose primary is out of quota skips a fallback
+    that 404s and is served by the next one, instead of failing.
+    """
+    executor = chatbot.RequestExecutor()
+    models = {
+        name: FakeGenerativeModel(f"models/{name}")
+        for name in ("gemini-primary", "gemini-missing", "gemini-spare")
+    }
+    executor.candidates = lambda primary: [
+        (name, model) for name, model in models.items()
+    ]
+
+    async def open_session(candidate, fresh: bool):
+        if candidate is models["gemini-primary"]:
+            raise ResourceExhausted("429 You exceeded your current quota")
+        if candidate is models["gemini-missing"]:
+            raise NotFound("404 models/gemini-missing is not found")
+        return candidate.start_chat(), None
+
+    served_by, *_ = await executor.open_stream(
+        models["gemini-primary"], open_session, "hello"
+    )
+    return served_by is models["gemini-spare"]
+
+
+async def breaker_trials(chatbot) -> Dict[str, bool]:
+    """
+    Whether a half-open model is tried again after its trial request
+    hit a non-retryable error or was cancelled, neither of which says
+    anything about the model's health.
+    """
+    executor = chatbot.RequestExecutor(breaker_threshold=1, breaker_reset=0)
+    model = FakeGenerativeModel("models/gemini-trial")
+
+    async def rejected(candidate, fresh: bool):
+        raise InvalidArgument("fake 400")
+
+    async def stalled(candidate, fresh: bool):
+        await asyncio.sleep(3600)
+
+    async def working(candidate, fresh: bool):
+        return candidate.start_chat(), None
+
+    retried = {}
+    for label, open_session in (("error", rejected), ("cancel", stalled)):
+        # Open the breaker; with no reset timeout it is half-open at once
+        executor.breaker("gemini-trial").record_failure()
+        trial = asyncio.ensure_future(
+            executor.open_stream(model, open_session, "trial")
+        )
+        if label == "cancel":
+            await asyncio.sleep(0.01)
+            trial.cancel()
+        try:
+            await trial
+        except (InvalidArgument, asyncio.CancelledError):
+            pass
+        served_by, *_ = await executor.open_stream(model, working, "next")
+        retried[label] = served_by is model
+    return retried
+
+
+# --------------------------------------------------------------------------
+# Request coalescing
+# --------------------------------------------------------------------------
+
+
+def bench_coalesce(args) -> Dict:
+    """Upstream calls for a burst of identical prompt-card clicks."""
+    genai = install_fake_genai()
+    fake = genai.GenerativeModel
+    fake.first_chunk_delay = args.first_chunk_delay
+    fake.chunk_delay = args.chunk_delay
+    os.environ.setdefault("GEM_RESPONSE_CACHE_SIZE", "0")
+
+    import chatbot
+    chatbot.get_model()
+    prompt = "Explain quantum computing in simple terms"
+    rng = random.Random(3)
+    # Clicks spread over the time to first chunk, so some join late
+    offsets = [
+        rng.uniform(0, args.first_chunk_delay) for _ in range(args.streams)
+    ]
+
+    async def one_click(offset: float) -> str:
+        await asyncio.sleep(offset)
+        history, conversation_id = chatbot.handle_user_message(prompt, [])
+        async for _ in chatbot.chat_response_stream(
+            history, conversation_id
+        ):
+            pass
+        return history[-1]["content"]
+
+    async def burst() -> List[str]:
+        return await asyncio.gather(*(one_click(o) for o in offsets))
+
+    results = {"streams": args.streams}
+    for label, enabled in (("baseline", False), ("single_flight", True)):
+        chatbot.single_flight = chatbot.SingleFlight(enabled=enabled)
+        fake.calls = {}
+        started = time.perf_counter()
+        replies = asyncio.run(burst())
+        results[label] = {
+            "upstream_calls": sum(fake.calls.values()),
+            "distinct_replies": len(set(replies)),
+            "wall_s": time.perf_counter() - started,
+        }
+        print(
+            f" {label}: {results[label]['upstream_calls']} upstream calls"
+            f" for {args.streams} clicks, "
+            f"{results[label]['distinct_replies']} distinct replies, "
+            f"wall {results[label]['wall_s']:.2f} s"
+        )
+    return results
+
+
+def bench_prefetch(args) -> Dict:
+    """Time to first chunk for each prompt card, cold and prefetched."""
+    genai = install_fake_genai()
+    fake = genai.GenerativeModel
+    fake.first_chunk_delay = args.first_chunk_delay
+    fake.chunk_delay = args.chunk_delay
+    os.environ.setdefault("GEM_CHAT_STORE", "memory://")
+
+    import chatbot
+    chatbot.get_model()
+    cards = [message for _, message in chatbot.PROMPT_CARDS]
+
+    async def click(prompt: str) -> float:
+        history, conversation_id = chatbot.handle_user_message(prompt, [])
+        started = time.perf_counter()
+        first = None
+        async for _ in chatbot.chat_response_stream(
+            history, conversation_id
+        ):
+            if first is None:
+                first = time.perf_counter() - started
+        return first or 0.0
+
+    async def clicks() -> List[float]:
+        return [await click(prompt) for prompt in cards]
+
+    results = {"cards": len(cards)}
+    for label in ("cold", "prefetched"):
+        chatbot.response_cache = chatbot.ResponseCache(
+            max_size=len(cards), ttl=3600
+        )
+        chatbot.prefetcher = chatbot.Prefetcher(cards, 3000, 0)
+        if label == "prefetched":
+            asyncio.run(chatbot.prefetcher.refresh())
+        fake.calls = {}
+        ttft = asyncio.run(clicks())
+        results[label] = {
+            "ttft_ms": {
+                f"p{pct}": percentile(ttft, pct) * 1000 for pct in (50, 99)
+            },
+            "upstream_calls": sum(fake.calls.values()),
+            "prefetched_served": chatbot.prefetcher.counts["served"],
+        }
+        print(
+            f" {label:>10}: ttft p50 "
+            f"{results[label]['ttft_ms']['p50']:.1f} ms, "
+            f"{results[label]['upstream_calls']} upstream calls on click, "
+            f"{results[label]['prefetched_served']} served from prefetch"
+        )
+    return results
+
+
+# --------------------------------------------------------------------------
+# Cancellation
+# --------------------------------------------------------------------------
+
+
+def bench_cancel(args) -> Dict:
+    """Chunks pulled from upstream when users stop replies early."""
+    genai = install_fake_genai()
+    fake = genai.GenerativeModel
+    fake.first_chunk_delay = args.first_chunk_delay
+    fake.chunk_delay = args.chunk_delay
+    fake.reply_chars = args.reply_chars
+    os.environ.setdefault("GEM_RESPONSE_CACHE_SIZE", "0")
+
+    import chatbot
+    chatbot.get_model()
+    # Every fourth reply is read to the end, the rest are stopped
+    # after a quarter of the reply's chunks have reached the browser
+    full_chunks = -(-args.reply_chars // fake.chunk_size)
+    stop_after = args.first_chunk_delay + full_chunks * args.chunk_delay / 4
+
+    async def one_stream(i: int) -> None:
+        history, conversation_id = chatbot.handle_user_message(
+            f"question {i}", []
+        )
+
+        async def consume() -> None:
+            async for _ in chatbot.chat_response_stream(
+                history, conversation_id
+            ):
+                pass
+
+        task = asyncio.create_task(consume())
+        if i % 4:
+            await asyncio.sleep(stop_after)
+            task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def run() -> None:
+        await asyncio.gather(*(one_stream(i) for i in range(args.streams)))
+        # Let cancelled pump tasks run their cleanup
+        await asyncio.sleep(0.1)
+
+    started = time.perf_counter()
+    asyncio.run(run())
+    results = {
+        "streams": args.streams,
+        "chunks_without_cancellation": args.streams * full_chunks,
+        "chunks_pulled": fake.chunks_sent,
+        "cancellations": chatbot.cancellations.stats(),
+        "wall_s": time.perf_counter() - started,
+    }
+    print(
+        f" {args.streams} streams: pulled {results['chunks_pulled']} of "
+        f"{results['chunks_without_cancellation']} upstream chunks"
+    )
+    print(f" cancellations: {results['cancellations']}")
+    return results
+
+
+# --------------------------------------------------------------------------
+# HTTP transport
+# --------------------------------------------------------------------------
+
+
+class StandInGemini:
+    """
+    Local HTTP/1.1 stand-in for the Gemini REST API.
+
+    Answers ``generateContent`` and ``streamGenerateContent`` with
+    canned server-sent events and counts the TCP connections it
+    accepts. ``handshake_delay`` is paid once per connection, the way a
+    TLS handshake would be.
+    """
+
+    def __init__(self, reply_chars: int, chunk_size: int,
+                 handshake_delay: float):
+        self.handshake_delay = handshake_delay
+        text = ("Stand-in reply. " * (reply_chars // 16 + 1))[:reply_chars]
+        self.body = b"".join(
+            b"data: " + json.dumps({
+                "candidates": [
+                    {"content": {"parts": [{"text": text[i:i + chunk_size]}]}}
+                ]
+            }).encode() + b"\r\n\r\n"
+            for i in range(0, len(text), chunk_size)
+        )
+        self.connections = 0
+        self.requests = 0
+        self.handlers = set()
+
+    async def stop(self) -> None:
+        """Stop listening and wait for clients to hang up."""
+        self.server.close()
+        await asyncio.gather(*self.handlers)
+        await self.server.wait_closed()
+
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(
+            self.handle, "127.0.0.1", 0
+        )
+        port = self.server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    async def handle(self, reader, writer) -> None:
+        self.connections += 1
+        self.handlers.add(asyncio.current_task())
+        await asyncio.sleep(self.handshake_delay)
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    name, _, value = line.partition(b":")
+                    if name.strip().lower() == b"content-length":
+                        length = int(value)
+                await reader.readexactly(length)
+                self.requests += 1
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: text/event-stream\r\n"
+                    b"Content-Length: %d\r\n\r\n" % len(self.body)
+                    + self.body
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def bench_transport(args) -> Dict:
+    """
+    Connections opened and time to first byte, with and without reuse.
+
+    ``--streams`` concurrent conversations each send ``--turns`` messages
+    through ``chatbot.RestGemini`` against ``StandInGemini``. The
+    baseline expires every connection right away, so each request pays
+    a fresh connection and handshake.
+    """
+    import chatbot
+
+    async def run(keepalive: float) -> Dict:
+        server = StandInGemini(
+            args.reply_chars, args.chunk_size, args.handshake_delay
+        )
+        base_url = await server.start()
+        client = chatbot.RestGemini(
+            base_url, "stand-in-key", pool_size=args.pool_size,
+            shards=args.pool_shards, keepalive=keepalive, http2=False,
+        )
+        model = client.GenerativeModel("gemini-flash-latest")
+        ttfb: List[float] = []
+
+        async def conversation() -> None:
+            session = model.start_chat()
+            for turn in range(args.turns):
+                sent = time.perf_counter()
+                first = None
+                response = await session.send_message_async(
+                    f"turn {turn}", stream=True
+                )
+                async for chunk in response:
+                    if first is None:
+                        first = time.perf_counter() - sent
+                ttfb.append(first or 0.0)
+
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(conversation() for _ in range(args.streams))
+        )
+        wall = time.perf_counter() - started
+        await client.aclose()
+        await server.stop()
+        return {
+            "requests": server.requests,
+            "connections_opened": server.connections,
+            "client_stats": client.stats(),
+            "ttfb_ms": {
+                f"p{pct}": percentile(ttfb, pct) * 1000
+                for pct in (50, 95, 99)
+            },
+            "requests_per_s": server.requests / wall,
+            "wall_s": wall,
+        }
+
+    results = {
+        "no_reuse": asyncio.run(run(keepalive=0.0)),
+        "pooled": asyncio.run(run(keepalive=60.0)),
+    }
+    for label, result in results.items():
+        print(
+            f" {label:>8}: {result['requests']} requests over "
+            f"{result['connections_opened']} connections | ttfb "
+            + " / ".join(
+                f"{key} {value:.1f} ms"
+                for key, value in result["ttfb_ms"].items()
+            )
+            + f" | {result['requests_per_s']:.0f} req/s"
+        )
+    return results
+
+
+# --------------------------------------------------------------------------
+# Load test through the UI event chain
+# --------------------------------------------------------------------------
+
+
+def configure_fake_backend(args):
+    """Install the fake SDK with the load-shaping options from ``args``."""
+    genai = install_fake_genai()
+    fake = genai.GenerativeModel
+    fake.chunk_size = args.chunk_size
+    fake.chunk_delay = args.chunk_delay
+    fake.first_chunk_delay = args.first_chunk_delay
+    fake.reply_chars = args.reply_chars
+    fake.error_rate = args.error_rate or 0.0
+    if args.quota is not None:
+        fake.quotas = {"gemini-flash-latest": args.quota}
+    return genai
+
+
+def payload_bytes(outputs) -> int:
+    """Approximate size of what Gradio would send for one step's outputs."""
+    return len(json.dumps(outputs, default=str))
+
+
+def bench_load(args) -> Dict:
+    """
+    Concurrent clients sending messages through ``chatbot.MESSAGE_CHAIN``.
+
+    Each client runs its own conversation of ``--turns`` messages,
+    calling the same functions, in the same order, as the textbox event
+    chain in the UI. A second, traced pass measures memory per session.
+    """
+    import tracemalloc
+
+    configure_fake_backend(args)
+    os.environ.setdefault("GEM_RESPONSE_CACHE_SIZE", "0")
+    os.environ.setdefault("GEM_CHAT_STORE", "memory://")
+
+    import chatbot
+    chatbot.get_model()
+    add_message, show_chat, stream_fn = chatbot.MESSAGE_CHAIN
+
+    async def client(i: int, record: Dict) -> List[Dict]:
+        history: List[Dict] = []
+        conversation_id = ""
+        for turn in range(args.turns):
+            submitted = time.perf_counter()
+            history, conversation_id = add_message(
+                f"client {i} turn {turn}: tell me something", history,
+                conversation_id,
+            )
+            record["bytes"] += payload_bytes([history, conversation_id])
+            record["bytes"] += payload_bytes(show_chat(history))
+            first = None
+            async for outputs in stream_fn(history, conversation_id):
+                record["bytes"] += payload_bytes(outputs)
+                if first is None:
+                    first = time.perf_counter() - submitted
+            record["ttft"].append(first or 0.0)
+            record["latency"].append(time.perf_counter() - submitted)
+            if "API Error" in history[-1]["content"]:
+                record["errors"] += 1
+            record["chars"] += len(history[-1]["content"])
+        return history
+
+    async def run(record: Dict) -> List[List[Dict]]:
+        return await asyncio.gather(
+            *(client(i, record) for i in range(args.clients))
+        )
+
+    record = {"ttft": [], "latency": [], "bytes": 0, "errors": 0,
+              "chars": 0}
+    started = time.perf_counter()
+    asyncio.run(run(record))
+    wall = time.perf_counter() - started
+
+    # Memory: keep every conversation alive and compare against before
+    traced = {"ttft": [], "latency": [], "bytes": 0, "errors": 0,
+              "chars": 0}
+    tracemalloc.start()
+    baseline = tracemalloc.take_snapshot()
+    sessions = asyncio.run(run(traced))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    held = sum(
+        stat.size_diff for stat in after.compare_to(baseline, "filename")
+    )
+    del sessions
+
+    replies = args.clients * args.turns
+    results = {
+        "clients": args.clients,
+        "turns": args.turns,
+        "stream_mode": chatbot.STREAM_MODE,
+        "replies": replies,
+        "errors": record["errors"],
+        "throughput_replies_per_s": replies / wall,
+        "throughput_chars_per_s": record["chars"] / wall,
+        "ttft_ms": {
+            f"p{pct}": percentile(record["ttft"], pct) * 1000
+            for pct in (50, 95, 99)
+        },
+        "latency_ms": {
+            f"p{pct}": percentile(record["latency"], pct) * 1000
+            for pct in (50, 95, 99)
+        },
+        "bytes_over_wire": record["bytes"],
+        "bytes_per_reply": record["bytes"] / replies,
+        "memory_per_session_kib": held / args.clients / 1024,
+        "wall_s": wall,
+    }
+    print(
+        f" {args.clients} clients x {args.turns} turns "
+        f"({chatbot.STREAM_MODE} mode): "
+        f"{results['throughput_replies_per_s']:.1f} replies/s, "
+        f"{record['errors']} errors, wall {wall:.2f} s"
+    )
+    for name in ("ttft_ms", "latency_ms"):
+        print(
+            f" {name[:-3]:>7}: "
+            + " / ".join(
+                f"{key} {value:.1f} ms" for key, value in results[name].items()
+            )
+        )
+    print(
+        f" wire: {results['bytes_per_reply'] / 1024:.1f} KiB per reply, "
+        f"memory: {results['memory_per_session_kib']:.1f} KiB per session"
+    )
+    return results
+
+
+def bench_scale(args) -> Dict:
+    """
+    Aggregate throughput of the deployed proxy with 1 and ``--workers``
+    app workers.
+
+    ``chatbot.serve_workers`` starts the sticky proxy and its uvicorn
+    workers against the fake backend, and ``--clients`` clients, split
+    across ``--workers`` client processes, hold ``/v1/chat``
+    conversations through the proxy. Each client claims its own
+    address with X-Forwarded-For, so the proxy spreads them over the
+    workers as it would real users. Streaming delays are zero, so what
+    is left is the app's own work.
+    """
+    fake = {
+        "chunk_size": args.chunk_size, "chunk_delay": 0.0,
+        "first_chunk_delay": 0.0, "reply_chars": args.reply_chars,
+        "error_rate": 0.0, "quota": None,
+    }
+    scratch = tempfile.mkdtemp(prefix="gem_scale_")
+    env = dict(
+        os.environ,
+        GEM_BENCH_FAKE=json.dumps(fake),
+        GEM_API="1",
+        GEM_API_TOKEN=SCALE_TOKEN,
+        GEM_METRICS="1",
+        GEM_CHAT_STORE=f"sqlite:///{os.path.join(scratch, 'chats.db')}",
+        GEM_RESPONSE_CACHE_SIZE="0",
+        GEM_RESPONSE_CACHE_PATH=os.path.join(scratch, "cache.db"),
+        GEM_PREFETCH="0",
+    )
+    here = os.path.abspath(__file__)
+    shares = [
+        args.clients // args.workers + (i < args.clients % args.workers)
+        for i in range(args.workers)
+    ]
+    results: Dict = {}
+    for workers in sorted({1, args.workers}):
+        port = args.port
+        server = subprocess.Popen(
+            [
+                sys.executable, here, "_scale-server",
+                "--workers", str(workers), "--port", str(port),
+            ],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_for_workers(port, workers)
+            started = time.perf_counter()
+            clients = [
+                subprocess.Popen(
+                    [
+                        sys.executable, here, "_scale-client",
+                        "--port", str(port), "--clients", str(share),
+                        "--first-client", str(sum(shares[:i])),
+                        "--turns", str(args.turns),
+                    ],
+                    env=env,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    text=True,
+                )
+                for i, share in enumerate(shares) if share
+            ]
+            counts = [
+                json.loads(client.communicate()[0].strip().splitlines()[-1])
+                for client in clients
+            ]
+            wall = time.perf_counter() - started
+        finally:
+            server.terminate()
+            server.wait()
+        replies = sum(count["replies"] for count in counts)
+        results[f"workers_{workers}"] = {
+            "replies": replies,
+            "errors": sum(count["errors"] for count in counts),
+            "replies_per_s": replies / wall,
+            "wall_s": wall,
+        }
+    base = results["workers_1"]["replies_per_s"]
+    for label, result in results.items():
+        result["speedup"] = result["replies_per_s"] / base
+        print(
+            f" {label:>10}: {result['replies_per_s']:8.1f} replies/s "
+            f"(x{result['speedup']:.2f}), {result['errors']} errors"
+        )
+    return results
+
+
+# Bearer token the ``scale`` workers and clients share
+SCALE_TOKEN = "scale-benchmark"
+
+
+def wait_for_workers(port: int, workers: int, timeout: float = 60) -> None:
+    """Block until every worker behind the proxy on ``port`` answers."""
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    for worker_port in [port] + [port + 1 + i for i in range(workers)]:
+        while True:
+            try:
+                if httpx.get(
+                    f"http://127.0.0.1:{worker_port}/metrics", timeout=1
+                ).status_code == 200:
+                    break
+            except httpx.TransportError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"port {worker_port} never came up")
+            time.sleep(0.1)
+
+
+def fake_app():
+    """``chatbot.create_app`` against the fake backend, for ``scale``."""
+    configure_fake_backend(
+        argparse.Namespace(**json.loads(os.environ["GEM_BENCH_FAKE"]))
+    )
+    import chatbot
+    return chatbot.create_app()
+
+
+def _scale_server(args) -> None:
+    """The sticky proxy and its workers, as ``GEM_WORKERS`` runs them."""
+    install_fake_genai()
+    import chatbot
+    chatbot.serve_workers(
+        args.workers, "127.0.0.1", args.port, app="benchmarks:fake_app"
+    )
+
+
+def _scale_client(args) -> None:
+    """Hold ``--clients`` conversations through the proxy on ``--port``."""
+    import httpx
+
+    counts = {"replies": 0, "errors": 0}
+
+    async def client(http, i: int) -> None:
+        headers = {
+            "authorization": f"Bearer {SCALE_TOKEN}",
+            "x-forwarded-for": f"10.{i // 65536 % 256}.{i // 256 % 256}."
+                               f"{i % 256}",
+        }
+        history: List[Dict] = []
+        conversation_id = ""
+        for turn in range(args.turns):
+            response = await http.post(
+                "/v1/chat",
+                json={
+                    "message": f"client {i} turn {turn}: tell me something",
+                    "history": history,
+                    "conversation_id": conversation_id,
+                    "stream": False,
+                },
+                headers=headers,
+            )
+            if response.status_code != 200:
+                counts["errors"] += 1
+                continue
+            payload = response.json()
+            history = payload["history"]
+            conversation_id = payload["conversation_id"]
+            counts["replies"] += 1
+
+    async def run() -> None:
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{args.port}",
+            timeout=None,
+            limits=httpx.Limits(max_connections=None),
+        ) as http:
+            await asyncio.gather(
+                *(
+                    client(http, i)
+                    for i in range(
+                        args.first_client, args.first_client + args.clients
+                    )
+                )
+            )
+
+    asyncio.run(run())
+    print(json.dumps(counts))
+
+
+def serve(args) -> None:
+    """Run the real app against the fake backend, for external clients."""
+    configure_fake_backend(args)
+    import chatbot
+    chatbot.demo.queue().launch(
+        server_name="127.0.0.1", server_port=args.port
+    )
+
+
+def flatten(results, prefix: str = "") -> Dict[str, float]:
+    """Numeric leaves of a results dict, keyed by their dotted path."""
+    leaves: Dict[str, float] = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            leaves.update(flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            leaves[path] = value
+    return leaves
+
+
+def compare(baseline_path: str, results: Dict) -> None:
+    """Print how each numeric result moved against a saved JSON run."""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    before = flatten(baseline.get("results", baseline))
+    for path, value in flatten(results).items():
+        if path not in before:
+            continue
+        old = before[path]
+        change = (value - old) / old * 100 if old else 0.0
+        print(f" {path:<40} {old:>12.2f} -> {value:>12.2f} ({change:+.1f}%)")
+
+
+def bench_spill(args) -> Dict:
+    """
+    Memory held by idle sessions, and the cost of bringing one back.
+
+    ``--clients`` conversations of ``--turns`` exchanges go idle; with
+    spilling they are written to disk, without it they stay resident.
+    Each then sends one more message, timed to its first chunk.
+    """
+    import tracemalloc
+
+    genai = install_fake_genai()
+    fake = genai.GenerativeModel
+    fake.reply_chars = args.reply_chars
+    os.environ.setdefault("GEM_CHAT_STORE", "memory://")
+    os.environ.setdefault("GEM_RESPONSE_CACHE_SIZE", "0")
+
+    import chatbot
+    chatbot.get_model()
+
+    async def turn(history: List[Dict], conversation_id: str, text: str):
+        history, conversation_id = chatbot.handle_user_message(
+            text, history, conversation_id
+        )
+        started = time.perf_counter()
+        first = None
+        async for _ in chatbot.chat_response_stream(
+            history, conversation_id
+        ):
+            if first is None:
+                first = time.perf_counter() - started
+        return history, conversation_id, first or 0.0
+
+    async def conversations() -> List[Tuple[List[Dict], str]]:
+        chats = []
+        for i in range(args.clients):
+            history, conversation_id = [], ""
+            for n in range(args.turns):
+                history, conversation_id, _ = await turn(
+                    history, conversation_id, f"session {i} question {n}"
+                )
+            chats.append((history, conversation_id))
+        return chats
+
+    async def follow_ups(chats) -> List[float]:
+        return [
+            (await turn(history, conversation_id, "one more"))[2]
+            for history, conversation_id in chats
+        ]
+
+    results: Dict = {"sessions": args.clients, "turns": args.turns}
+    for label in ("resident", "spilled"):
+        spill = None
+        if label == "spilled":
+            spill = chatbot.SessionSpill(
+                os.path.join(tempfile.mkdtemp(), "sessions.db")
+            )
+        chatbot.session_cache = chatbot.SessionCache(
+            max_size=args.clients, ttl=3600, spill=spill
+        )
+        # Sessions allocated before tracing starts can't be seen freed
+        tracemalloc.start()
+        # The browser keeps each chat's messages either way
+        chats = asyncio.run(conversations())
+        gc.collect()
+        before = tracemalloc.take_snapshot()
+        sweep_ms = 0.0
+        if spill is not None:
+            # Everyone has gone idle; sweep once, then stop sweeping.
+            # The sweep itself only queues the writes; that is all the
+            # event loop waits for
+            chatbot.session_cache.idle = 1e-9
+            started = time.perf_counter()
+            chatbot.session_cache._sweep()
+            sweep_ms = (time.perf_counter() - started) * 1000
+            chatbot.session_cache.idle = 0
+            spill.flush()
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        freed = -sum(
+            stat.size_diff for stat in after.compare_to(before, "filename")
+        )
+        resident = chatbot.session_cache.stats()["size"]
+        ttft = asyncio.run(follow_ups(chats))
+        results[label] = {
+            "freed_bytes_per_session": max(freed, 0) / args.clients,
+            "resident_after_idle": resident,
+            "sweep_ms": sweep_ms,
+            "rehydrations": chatbot.session_cache.rehydrations,
+            "ttft_ms": {
+                f"p{pct}": percentile(ttft, pct) * 1000 for pct in (50, 99)
+            },
+        }
+        if spill is not None:
+            spill.flush()
+            results[label]["spill_file_bytes"] = os.path.getsize(spill.path)
+        print(
+            f" {label:>8}: {results[label]['resident_after_idle']} "
+            f"resident after idle, "
+            f"{results[label]['freed_bytes_per_session'] / 1024:.1f} KiB "
+            f"freed per session, follow-up ttft p50 "
+            f"{results[label]['ttft_ms']['p50']:.2f} ms, "
+            f"p99 {results[label]['ttft_ms']['p99']:.2f} ms, "
+            f"sweep {sweep_ms:.1f} ms on the loop"
+        )
+    return results
+
+
+BENCHMARKS = {
+    "startup": bench_startup,
+    "imports": bench_imports,
+    "streams": bench_streams,
+    "flush": bench_flush,
+    "delta": bench_delta,
+    "dedup": bench_dedup,
+    "search": bench_search,
+    "failover": bench_failover,
+    "coalesce": bench_coalesce,
+    "prefetch": bench_prefetch,
+    "cancel": bench_cancel,
+    "transport": bench_transport,
+    "load": bench_load,
+    "scale": bench_scale,
+    "spill": bench_spill,
+}
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        "benchmark",
+        choices=sorted(BENCHMARKS) + [
+            "serve", "_startup-child", "_scale-server", "_scale-client",
+        ],
+    )
+    parser.add_argument(
+        "--list-delay", type=float, default=2.0,
+        help="seconds the fake list_models() call takes",
+    )
+    parser.add_argument(
+        "--streams", type=int, default=2000,
+        help="number of concurrent streams",
+    )
+    parser.add_argument(
+        "--first-chunk-delay", type=float, default=0.2,
+        help="seconds the fake backend waits before the first chunk",
+    )
+    parser.add_argument(
+        "--chunk-delay", type=float, default=0.01,
+        help="seconds between fake chunks",
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=8,
+        help="characters per fake chunk",
+    )
+    parser.add_argument(
+        "--reply-chars", type=int, default=2000,
+        help="length of each fake reply",
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=1000,
+        help="repetitions for micro-benchmarks",
+    )
+    parser.add_argument(
+        "--messages", type=int, default=100000,
+        help="size of the synthetic search corpus",
+    )
+    parser.add_argument(
+        "--queries", type=int, default=200,
+        help="number of search queries to time",
+    )
+    parser.add_argument(
+        "--error-rate", type=float,
+        help="share of fake calls failing with a transient 429 "
+        "(default 0.2 for failover, 0 otherwise)",
+    )
+    parser.add_argument(
+        "--quota", type=int,
+        help="calls before the primary fake model runs out of quota "
+        "(default 100 for failover, unlimited otherwise)",
+    )
+    parser.add_argument(
+        "--clients", type=int, default=100,
+        help="concurrent simulated clients for the load test",
+    )
+    parser.add_argument(
+        "--turns", type=int, default=3,
+        help="messages each load-test client sends",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1,
+        help="processes for the scaling benchmark",
+    )
+    parser.add_argument(
+        "--pool-size", type=int, default=100,
+        help="HTTP connections the transport benchmark may keep open",
+    )
+    parser.add_argument(
+        "--pool-shards", type=int, default=4,
+        help="clients the transport benchmark's pool is split across",
+    )
+    parser.add_argument(
+        "--handshake-delay", type=float, default=0.1,
+        help="seconds the stand-in server spends on each new connection",
+    )
+    parser.add_argument(
+        "--port", type=int, default=7861,
+        help="port for serve, and the proxy port for scale",
+    )
+    parser.add_argument(
+        "--first-client", type=int, default=0, help=argparse.SUPPRESS,
+    )
+    parser.add_argument(
+        "--output", help="write the results as JSON to this path",
+    )
+    parser.add_argument(
+        "--compare", help="print changes against a saved JSON run",
+    )
+    args = parser.parse_args(argv)
+
+    # Load tests should measure the app, not the per-user rate limits
+    for name in (
+        "GEM_GLOBAL_RPM", "GEM_GLOBAL_TPM", "GEM_USER_RPM", "GEM_USER_TPM",
+    ):
+        os.environ.setdefault(name, "0")
+
+    if args.benchmark == "_startup-child":
+        _startup_child(args)
+        return
+    if args.benchmark == "_scale-server":
+        _scale_server(args)
+        return
+    if args.benchmark == "_scale-client":
+        _scale_client(args)
+        return
+    if args.benchmark == "serve":
+        serve(args)
+        return
+
+    results = BENCHMARKS[args.benchmark](args)
+    if args.compare:
+        compare(args.compare, results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "benchmark": args.benchmark,
+                    "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "python": sys.version.split()[0],
+                    "options": vars(args),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,37 @@
+import argparse
+import asyncio
+import atexit
+import bisect
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import hmac
+import importlib
+import io
+import itertools
+import json
+import logging
+import logging.handlers
+import math
 import os
+import queue
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
 import time
-from typing import Dict, List, Optional
+import types
+import uuid
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Tuple
 
-import gradio as gr
-import google.generativeai as genai
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -12,8 +40,766 @@ load_dotenv()
 # Get API key from environment
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY", "")
 
-# Configure Gemini AI
+
+class LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access.
+
+    Gradio and the Gemini SDK take most of this module's import time,
+    and the CLI, the API and the engine do not need the UI. ``setup``
+    runs once, right after the real import.
+    """
+
+    def __init__(self, name: str, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                module = importlib.import_module(self._name)
+                if self._setup is not None:
+                    self._setup(module)
+                self._module = module
+        return self._module
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._load()
+        return getattr(self._module, attr)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+gr = LazyModule("gradio")
+
+# --------------------------------------------------------------------------
+# Telemetry
+# --------------------------------------------------------------------------
+
+log = logging.getLogger("gem_chatbot")
+
+
+def configure_logging(level: str) -> None:
+    """
+    Log through a queue so request handlers never block on stderr.
+
+    Records are formatted and written by a listener thread; the
+    calling side only appends to a ``SimpleQueue``.
+    """
+    log_queue: "queue.SimpleQueue" = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+    )
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(level.upper())
+    log.propagate = False
+
+
+configure_logging(os.getenv("GEM_LOG_LEVEL", "INFO"))
+
+# Latency buckets in seconds, roughly log-spaced
+LATENCY_BUCKETS = (
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"),
+)
+SIZE_BUCKETS = (
+    64, 256, 1024, 4096, 16384, 65536, float("inf"),
+)
+RATE_BUCKETS = (
+    1, 5, 10, 25, 50, 100, 250, 1000, float("inf"),
+)
+
+
+class Metrics:
+    """
+    In-process counters and histograms in the Prometheus text format.
+
+    Components that already keep their own numbers register a
+    ``stats()`` callable as a collector; its numeric values are exported
+    as gauges when ``/metrics`` is scraped, so nothing is counted twice.
+    """
+
+    def __init__(self, prefix: str = "gem"):
+        self.prefix = prefix
+        self._counters: Dict[Tuple, float] = {}
+        self._histograms: Dict[Tuple, List] = {}
+        self._buckets: Dict[str, Tuple] = {}
+        self._help: Dict[str, str] = {}
+        self._collectors: List[Tuple] = []
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, help_text: str, buckets=None) -> None:
+        self._help[name] = help_text
+        if buckets is not None:
+            self._buckets[name] = buckets
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._buckets.get(name, LATENCY_BUCKETS)
+        with self._lock:
+            state = self._histograms.get(key)
+            if state is None:
+                state = self._histograms[key] = [[0] * len(buckets), 0, 0]
+            state[0][bisect.bisect_left(buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def register(self, component: str, collect) -> None:
+        self._collectors.append((component, collect))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, [list(state[0]), state[1], state[2]])
+                for key, state in self._histograms.items()
+            )
+
+        described = set()
+
+        def header(name: str, kind: str) -> None:
+            if name not in described:
+                described.add(name)
+                text = self._help.get(name, name.replace("_", " "))
+                lines.append(f"# HELP {self.prefix}_{name} {text}")
+                lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{self.prefix}_{name}{_labels(labels)} {value}")
+
+        for (name, labels), (counts, total, count) in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            buckets = self._buckets.get(name, LATENCY_BUCKETS)
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    f"{self.prefix}_{name}_bucket"
+                    f"{_labels(labels + (('le', le),))} {cumulative}"
+                )
+            lines.append(f"{self.prefix}_{name}_sum{_labels(labels)} {total}")
+            lines.append(
+                f"{self.prefix}_{name}_count{_labels(labels)} {count}"
+            )
+
+        for component, collect in self._collectors:
+            try:
+                values = collect()
+            except Exception as collect_error:
+                log.warning("Metrics for %s failed: %s", component,
+                            collect_error)
+                continue
+            for key, value in sorted(values.items()):
+                name = f"{component}_{key}"
+                if isinstance(value, dict):
+                    # One labelled series per entry, e.g. per model
+                    for label, inner in sorted(value.items()):
+                        if isinstance(inner, (int, float)):
+                            header(name, "gauge")
+                            lines.append(
+                                f"{self.prefix}_{name}"
+                                f"{_labels((('key', label),))} {inner}"
+                            )
+                elif isinstance(value, (int, float)):
+                    header(name, "gauge")
+                    lines.append(f"{self.prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class NullMetrics:
+    """Stand-in used when metrics are disabled; every call is a no-op."""
+
+    def describe(self, *args, **kwargs) -> None:
+        pass
+
+    def inc(self, *args, **kwargs) -> None:
+        pass
+
+    def observe(self, *args, **kwargs) -> None:
+        pass
+
+    def register(self, *args, **kwargs) -> None:
+        pass
+
+    def render(self) -> str:
+        return ""
+
+
+def _labels(labels: Tuple) -> str:
+    if not labels:
+        return ""
+    inner = ",".join(
+        '{}="{}"'.format(
+            key, str(value).replace("\\", "\\\\").replace('"', '\\"')
+        )
+        for key, value in labels
+    )
+    return "{" + inner + "}"
+
+
+# Opt-in: /metrics is served by the FastAPI app, not plain Gradio
+METRICS_ENABLED = os.getenv("GEM_METRICS", "0") == "1"
+metrics = Metrics() if METRICS_ENABLED else NullMetrics()
+metrics.describe(
+    "requests_total", "Chat replies by model and outcome"
+)
+metrics.describe(
+    "errors_total", "Failed replies by model and error type"
+)
+metrics.describe(
+    "time_to_first_chunk_seconds", "Time until the first reply text"
+)
+metrics.describe(
+    "reply_seconds", "Time from request to the end of the reply"
+)
+metrics.describe(
+    "chunks_per_second", "Streaming rate after the first chunk",
+    RATE_BUCKETS,
+)
+metrics.describe(
+    "prompt_chars", "Length of the user message", SIZE_BUCKETS
+)
+metrics.describe(
+    "prompt_tokens", "Estimated tokens sent with the prompt", SIZE_BUCKETS
+)
+metrics.describe(
+    "response_chars", "Length of the reply", SIZE_BUCKETS
+)
+metrics.describe(
+    "handler_seconds", "Time spent in sidebar and session handlers"
+)
+
+
+def timed_handler(func):
+    """Record how long a UI handler takes in ``handler_seconds``."""
+    if not METRICS_ENABLED:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.observe(
+                "handler_seconds",
+                time.perf_counter() - started,
+                handler=func.__name__,
+            )
+
+    return wrapper
+
+
+# --------------------------------------------------------------------------
+# Gemini transport
+# --------------------------------------------------------------------------
+
+# "sdk" calls Gemini through google-generativeai (gRPC). "rest" uses
+# RestGemini below, a pooled httpx client for the same REST API.
+GEMINI_TRANSPORT = os.getenv("GEM_TRANSPORT", "sdk").lower()
+GEMINI_API_BASE = os.getenv(
+    "GEM_API_BASE", "https://generativelanguage.googleapis.com"
+).rstrip("/")
+HTTP_POOL_SIZE = int(os.getenv("GEM_HTTP_POOL_SIZE", "100"))
+HTTP_POOL_SHARDS = int(os.getenv("GEM_HTTP_POOL_SHARDS", "4"))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("GEM_HTTP_KEEPALIVE_SECONDS", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("GEM_HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("GEM_HTTP_READ_TIMEOUT", "60"))
+HTTP2_ENABLED = os.getenv("GEM_HTTP2", "1") != "0"
+
+metrics.describe(
+    "gemini_connect_seconds", "TCP and TLS setup for new Gemini connections"
+)
+metrics.describe(
+    "gemini_ttfb_seconds", "Time from sending a request to its first byte"
+)
+metrics.describe(
+    "gemini_http_requests_total", "Gemini HTTP requests by status"
+)
+
+
+class GeminiHTTPError(Exception):
+    """An error response from the REST API, keeping the HTTP response."""
+
+    def __init__(self, message: str, response=None):
+        super().__init__(message)
+        self.response = response
+
+
+# Named like ``google.api_core.exceptions`` so the retry and failover
+# rules treat both transports the same
+class InvalidArgument(GeminiHTTPError):
+    pass
+
+
+class PermissionDenied(GeminiHTTPError):
+    pass
+
+
+class NotFound(GeminiHTTPError):
+    pass
+
+
+class ResourceExhausted(GeminiHTTPError):
+    pass
+
+
+class InternalServerError(GeminiHTTPError):
+    pass
+
+
+class ServiceUnavailable(GeminiHTTPError):
+    pass
+
+
+class DeadlineExceeded(GeminiHTTPError):
+    pass
+
+
+HTTP_ERRORS = {
+    400: InvalidArgument,
+    403: PermissionDenied,
+    404: NotFound,
+    429: ResourceExhausted,
+    500: InternalServerError,
+    503: ServiceUnavailable,
+    504: DeadlineExceeded,
+}
+
+
+def _reply_text(payload: Dict) -> str:
+    candidates = payload.get("candidates") or [{}]
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    return "".join(part.get("text", "") for part in parts)
+
+
+class RestReply:
+    """A reply chunk, or a whole non-streamed reply, with ``text``."""
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class RestStream:
+    """
+    Streamed ``streamGenerateContent`` reply read from server-sent events.
+
+    The chat history is only extended once the reply is complete, as
+    the SDK does. ``aclose()`` releases the connection back to the pool.
+    """
+
+    def __init__(self, response, session, message: str, started: float):
+        self._response = response
+        self._session = session
+        self._message = message
+        self._started = started
+
+    async def __aiter__(self):
+        parts: List[str] = []
+        first = True
+        try:
+            async for line in self._response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                if first:
+                    first = False
+                    metrics.observe(
+                        "gemini_ttfb_seconds",
+                        time.perf_counter() - self._started,
+                    )
+                text = _reply_text(json.loads(line[5:]))
+                parts.append(text)
+                yield RestReply(text)
+        finally:
+            await self._response.aclose()
+        self._session.history += [
+            {"role": "user", "parts": [{"text": self._message}]},
+            {"role": "model", "parts": [{"text": "".join(parts)}]},
+        ]
+
+    async def aclose(self) -> None:
+        await self._response.aclose()
+
+
+class RestChatSession:
+    """Chat session holding its own history, like ``genai.ChatSession``."""
+
+    def __init__(self, model: "RestModel", history=None):
+        self.model = model
+        self.history = _api_contents(history or [])
+
+    async def send_message_async(self, message: str, stream: bool = True):
+        contents = self.history + [
+            {"role": "user", "parts": [{"text": message}]}
+        ]
+        if not stream:
+            reply = await self.model.generate_content_async(contents)
+            self.history = contents + [
+                {"role": "model", "parts": [{"text": reply.text}]}
+            ]
+            return reply
+        response, started = await self.model.client.post(
+            f"{self.model.model_name}:streamGenerateContent",
+            {"contents": contents},
+            stream=True,
+        )
+        return RestStream(response, self, message, started)
+
+
+class RestModel:
+    """The parts of ``genai.GenerativeModel`` this app uses, over REST."""
+
+    def __init__(self, client: "RestGemini", model_name: str):
+        self.client = client
+        self.model_name = (
+            model_name if model_name.startswith("models/")
+            else f"models/{model_name}"
+        )
+
+    def start_chat(self, history=None) -> RestChatSession:
+        return RestChatSession(self, history)
+
+    async def generate_content_async(self, contents) -> RestReply:
+        response, _ = await self.client.post(
+            f"{self.model_name}:generateContent",
+            {"contents": _api_contents(contents)},
+        )
+        return RestReply(_reply_text(response.json()))
+
+    async def count_tokens_async(self, contents):
+        """Prompt size from ``countTokens``, as ``.total_tokens``."""
+        response, _ = await self.client.post(
+            f"{self.model_name}:countTokens",
+            {"contents": _api_contents(contents)},
+        )
+        return types.SimpleNamespace(
+            total_tokens=response.json().get("totalTokens", 0)
+        )
+
+
+def _api_contents(contents) -> List[Dict]:
+    """SDK-style contents, whose parts may be bare strings, for REST."""
+    if isinstance(contents, str):
+        contents = [{"role": "user", "parts": [{"text": contents}]}]
+    return [
+        {
+            "role": turn["role"],
+            "parts": [
+                {"text": part} if isinstance(part, str) else part
+                for part in turn["parts"]
+            ],
+        }
+        for turn in contents
+    ]
+
+
+class RestGemini:
+    """
+    Gemini REST client over one pooled, keep-alive ``httpx`` client.
+
+    Exposes ``list_models()`` and ``GenerativeModel`` like the SDK
+    module, so it can stand in for ``genai``. Connections are reused
+    across turns and conversations; with ``h2`` installed and HTTP/2
+    enabled, concurrent streams share connections too. Each request
+    records whether it opened a connection, the TCP/TLS setup time and
+    the time to first byte.
+
+    httpcore scans every pooled connection on each request, which gets
+    costly with dozens of connections on one event loop, so the pool is
+    split into ``shards`` clients that requests take in turn.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str,
+        pool_size: int = 100,
+        shards: int = 4,
+        keepalive: float = 60.0,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 60.0,
+        http2: bool = True,
+    ):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.shards = max(1, shards)
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.http2 = http2 and self._h2_available()
+        self._clients: List = []
+        self._next_client = itertools.count()
+        self._loop = None
+        self._closing = None
+        self.counts = {
+            "requests": 0, "connections_opened": 0, "http2_requests": 0,
+            "errors": 0,
+        }
+
+    @staticmethod
+    def _h2_available() -> bool:
+        try:
+            importlib.import_module("h2")
+        except ImportError:
+            log.info("h2 is not installed; Gemini REST calls use HTTP/1.1")
+            return False
+        return True
+
+    def GenerativeModel(self, model_name: str) -> RestModel:
+        return RestModel(self, model_name)
+
+    def _headers(self) -> Dict[str, str]:
+        return {"x-goog-api-key": self.api_key}
+
+    def list_models(self):
+        """Yield the available models (blocking; used by discovery)."""
+        import httpx
+
+        with httpx.Client(
+            base_url=self.base_url, timeout=self.connect_timeout
+        ) as client:
+            page_token = ""
+            while True:
+                response = client.get(
+                    "/v1beta/models",
+                    params={"pageSize": 1000, "pageToken": page_token},
+                    headers=self._headers(),
+                )
+                self._raise_for_status(response, response.text)
+                payload = response.json()
+                for entry in payload.get("models", []):
+                    yield types.SimpleNamespace(
+                        name=entry["name"],
+                        supported_generation_methods=entry.get(
+                            "supportedGenerationMethods", []
+                        ),
+                    )
+                page_token = payload.get("nextPageToken")
+                if not page_token:
+                    return
+
+    def async_client(self):
+        """The next pooled client for the running event loop."""
+        import httpx
+
+        loop = asyncio.get_running_loop()
+        if not self._clients or self._loop is not loop:
+            # Pooled connections belong to the loop that opened them
+            if self._clients:
+                self._retire(self._clients, self._loop)
+            self._loop = loop
+            per_shard = -(-self.pool_size // self.shards)
+            self._clients = [
+                httpx.AsyncClient(
+                    base_url=self.base_url,
+                    http2=self.http2,
+                    limits=httpx.Limits(
+                        max_connections=per_shard,
+                        max_keepalive_connections=per_shard,
+                        keepalive_expiry=self.keepalive,
+                    ),
+                    timeout=httpx.Timeout(
+                        self.read_timeout, connect=self.connect_timeout
+                    ),
+                )
+                for _ in range(self.shards)
+            ]
+        return self._clients[next(self._next_client) % self.shards]
+
+    def _retire(self, clients: List, old_loop) -> None:
+        """Close the clients of a loop this client no longer serves."""
+        closing = self._close_clients(clients)
+        if old_loop.is_running():
+            asyncio.run_coroutine_threadsafe(closing, old_loop)
+        else:
+            # Their loop has stopped; close what can be closed from here
+            self._closing = asyncio.get_running_loop().create_task(closing)
+
+    @staticmethod
+    async def _close_clients(clients: List) -> None:
+        for client in clients:
+            try:
+                await client.aclose()
+            except RuntimeError as close_error:
+                log.debug("Could not close a pooled client: %s",
+                          close_error)
+
+    def _raise_for_status(self, response, body: str) -> None:
+        if response.status_code < 400:
+            return
+        self.counts["errors"] += 1
+        error_class = HTTP_ERRORS.get(response.status_code, GeminiHTTPError)
+        raise error_class(
+            f"{response.status_code} {body[:500]}", response=response
+        )
+
+    async def post(self, path: str, payload: Dict, stream: bool = False):
+        """
+        Send one API request and return ``(response, started)``.
+
+        With ``stream`` the body is left unread for the caller. Network
+        failures are raised as ``ServiceUnavailable`` so they are
+        retried like a 503.
+        """
+        import httpx
+
+        client = self.async_client()
+        marks: Dict[str, float] = {}
+
+        async def trace(event: str, info) -> None:
+            if event.startswith("connection."):
+                marks[event] = time.perf_counter()
+
+        request = client.build_request(
+            "POST",
+            f"/v1beta/{path}",
+            params={"alt": "sse"} if stream else None,
+            json=payload,
+            headers=self._headers(),
+            extensions={"trace": trace},
+        )
+        started = time.perf_counter()
+        self.counts["requests"] += 1
+        try:
+            response = await client.send(request, stream=stream)
+        except httpx.TransportError as error:
+            self.counts["errors"] += 1
+            raise ServiceUnavailable(
+                f"{type(error).__name__}: {error}"
+            ) from error
+
+        opened = marks.get("connection.connect_tcp.started")
+        if opened is not None:
+            self.counts["connections_opened"] += 1
+            ready = marks.get(
+                "connection.start_tls.complete",
+                marks.get("connection.connect_tcp.complete", opened),
+            )
+            metrics.observe("gemini_connect_seconds", ready - opened)
+        if response.http_version == "HTTP/2":
+            self.counts["http2_requests"] += 1
+        if not stream:
+            metrics.observe(
+                "gemini_ttfb_seconds", time.perf_counter() - started
+            )
+
+        metrics.inc(
+            "gemini_http_requests_total", status=response.status_code
+        )
+        if response.status_code >= 400:
+            body = (await response.aread()).decode("utf-8", "replace")
+            await response.aclose()
+            self._raise_for_status(response, body)
+        return response, started
+
+    def stats(self) -> Dict[str, int]:
+        pool = self.counts["connections_opened"]
+        return dict(
+            self.counts,
+            connections_reused=self.counts["requests"] - pool,
+        )
+
+    async def aclose(self) -> None:
+        clients, self._clients = self._clients, []
+        await self._close_clients(clients)
+
+
+def _configure_genai(module) -> None:
+    if GOOGLE_API_KEY:
+        module.configure(api_key=GOOGLE_API_KEY)
+
+
+# ``genai`` is whatever the model code talks to: the SDK module, or the
+# REST client offering the same ``list_models`` and ``GenerativeModel``
+if GEMINI_TRANSPORT == "rest":
+    genai = RestGemini(
+        GEMINI_API_BASE,
+        GOOGLE_API_KEY,
+        pool_size=HTTP_POOL_SIZE,
+        shards=HTTP_POOL_SHARDS,
+        keepalive=HTTP_KEEPALIVE_SECONDS,
+        connect_timeout=HTTP_CONNECT_TIMEOUT,
+        read_timeout=HTTP_READ_TIMEOUT,
+        http2=HTTP2_ENABLED,
+    )
+    metrics.register("gemini_http", genai.stats)
+elif GEMINI_TRANSPORT == "sdk":
+    genai = LazyModule("google.generativeai", setup=_configure_genai)
+else:
+    raise ValueError(
+        f"GEM_TRANSPORT must be 'sdk' or 'rest', not {GEMINI_TRANSPORT!r}"
+    )
+
+
+# Model discovery is deferred to the first request (or a background
+# thread) and the resolved name is cached on disk so later starts can
+# skip ``genai.list_models()`` entirely.
+MODEL_CACHE_PATH = os.getenv(
+    "GEM_MODEL_CACHE",
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), ".model_cache.json"
+    ),
+)
+MODEL_CACHE_TTL = float(os.getenv("GEM_MODEL_CACHE_TTL", "86400"))
+
+# Prioritize models with best free tier quotas
+PREFERRED_MODELS = [
+    "gemini-flash-latest",
+    "gemini-2.5-flash",
+    "gemini-2.0-flash",
+    "gemini-pro-latest",
+]
+
+# Last resort: standard model names tried without listing
+DIRECT_MODEL_NAMES = [
+    "gemini-flash-latest",
+    "gemini-2.5-flash",
+    "gemini-2.0-flash",
+    "gemini-pro",
+]
+
+# Streams run as async generators on one event loop, so they are not
+# bound by the worker thread pool (0 = unlimited).
+STREAM_CONCURRENCY_LIMIT = (
+    int(os.getenv("GEM_STREAM_CONCURRENCY", "0")) or None
+)
+
+# Where __main__ serves the app. With GEM_WORKERS > 1 this port belongs
+# to a sticky front proxy and the workers listen on the ports after it.
+SERVER_HOST = os.getenv("GEM_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("GEM_PORT", "7860"))
+WORKERS = int(os.getenv("GEM_WORKERS", "1"))
+
+# Longest user message sent to the model
+MAX_MESSAGE_CHARS = 10000
+
+# Errors that mean the cached model itself is unusable
+MODEL_GONE_ERRORS = ("NotFound", "PermissionDenied", "InvalidArgument")
+
 model = None
+model_name: Optional[str] = None
+discovered_models: List[str] = []
+model_from_cache = False
+_model_lock = threading.Lock()
+_model_resolved = False
+
 if not GOOGLE_API_KEY:
     print(" ERROR: GOOGLE_API_KEY not found in .env file")
     print(" Please create a .env file and add your API key:")
@@ -21,98 +807,159 @@ if not GOOGLE_API_KEY:
     print(
         " Get your API key from: https://aistudio.google.com/app/apikey"
     )
-else:
+
+
+def _read_model_cache() -> Optional[str]:
+    """Return the cached model name if the cache is still fresh."""
+    try:
+        with open(MODEL_CACHE_PATH, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if time.time() - cached.get("resolved_at", 0) > MODEL_CACHE_TTL:
+        return None
+    return cached.get("model")
+
+
+def _write_model_cache(name: str) -> None:
+    """Persist the resolved model name for later starts."""
+    try:
+        tmp_path = MODEL_CACHE_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"model": name, "resolved_at": time.time()}, f)
+        os.replace(tmp_path, MODEL_CACHE_PATH)
+    except OSError as cache_error:
+        print(f" Could not write model cache: {cache_error}")
+
+
+def discover_model():
+    """List available models and pick the best one for the free tier."""
+    print("\n Checking available models...")
+    available_models = discovered_models
+    available_models.clear()
+
     try:
-        genai.configure(api_key=GOOGLE_API_KEY)
-        
-        # First, list all available models
-        print("\n Checking available models...")
-        available_models = []
-        
-        # Prioritize models with best free tier quotas
-        preferred_models = [
-            "gemini-flash-latest",
-            "gemini-2.5-flash",
-            "gemini-2.0-flash",
-            "gemini-pro-latest"
+        for m in genai.list_models():
+            if 'generateContent' in m.supported_generation_methods:
+                available_models.append(m.name)
+                print(f"    Found: {m.name}")
+    except Exception as list_error:
+        print(f"    Could not list models: {list_error}")
+
+    # Try preferred models first (best quotas for free tier)
+    print("\n Selecting best model for free tier...")
+    for pref_model in PREFERRED_MODELS:
+        matching = [
+            m for m in available_models
+            if pref_model in m.lower()
+        ]
+        if matching:
+            try:
+                found = genai.GenerativeModel(matching[0])
+                print(f" Successfully initialized: {matching[0]}")
+                return found, matching[0]
+            except Exception as model_error:
+                print(f" Failed {matching[0]}: {model_error}")
+                continue
+
+    # Fallback: try any flash model (better quotas than pro)
+    if available_models:
+        print("\n Trying fallback flash models...")
+        flash_models = [
+            m for m in available_models
+            if 'flash' in m.lower() and 'exp' not in m.lower()
         ]
-        
+        for flash_model in flash_models:
+            try:
+                found = genai.GenerativeModel(flash_model)
+                print(f" Using fallback: {flash_model}")
+                return found, flash_model
+            except Exception:
+                continue
+    else:
+        print("\n No models found, trying direct initialization...")
+        for direct_name in DIRECT_MODEL_NAMES:
+            try:
+                found = genai.GenerativeModel(direct_name)
+                print(f" Initialized with: {direct_name}")
+                return found, direct_name
+            except Exception:
+                print(f"    Failed: {direct_name}")
+                continue
+
+    raise Exception(
+        "No compatible model found. "
+        "Your API key may have exhausted its quota. "
+        "Please wait or get a new API key."
+    )
+
+
+def get_model():
+    """Resolve the Gemini model on first use, preferring the disk cache."""
+    global model, model_name, model_from_cache, _model_resolved
+
+    if _model_resolved or not GOOGLE_API_KEY:
+        return model
+
+    with _model_lock:
+        if _model_resolved:
+            return model
+
+        cached_name = _read_model_cache()
+        if cached_name:
+            try:
+                model = genai.GenerativeModel(cached_name)
+                model_name = cached_name
+                model_from_cache = True
+                _model_resolved = True
+                print(f" Using cached model: {cached_name}")
+                return model
+            except Exception as cache_error:
+                print(f" Cached model failed: {cache_error}")
+
         try:
-            for m in genai.list_models():
-                if 'generateContent' in m.supported_generation_methods:
-                    available_models.append(m.name)
-                    print(f"    Found: {m.name}")
-        except Exception as list_error:
-            print(f"    Could not list models: {list_error}")
-        
-        # Try preferred models first (best quotas for free tier)
-        model = None
-        print("\n Selecting best model for free tier...")
-        
-        for pref_model in preferred_models:
-            matching = [
-                m for m in available_models 
-                if pref_model in m.lower()
-            ]
-            if matching:
-                try:
-                    model = genai.GenerativeModel(matching[0])
-                    print(f" Successfully initialized: {matching[0]}")
-                    break
-                except Exception as model_error:
-                    print(f" Failed {matching[0]}: {model_error}")
-                    continue
-        
-        # Fallback: try any flash model (better quotas than pro)
-        if not model:
-            print("\n Trying fallback flash models...")
-            flash_models = [
-                m for m in available_models 
-                if 'flash' in m.lower() and 'exp' not in m.lower()
-            ]
-            for flash_model in flash_models:
-                try:
-                    model = genai.GenerativeModel(flash_model)
-                    print(f" Using fallback: {flash_model}")
-                    break
-                except Exception:
-                    continue
-        else:
-            # Last resort: try standard model names directly
-            print("\n No models found, trying direct initialization...")
-            model_names = [
-                "gemini-flash-latest",
-                "gemini-2.5-flash",
-                "gemini-2.0-flash",
-                "gemini-pro"
-            ]
-            
+            model, model_name = discover_model()
+            model_from_cache = False
+            _write_model_cache(model_name)
+        except Exception as init_error:
+            print(f"\n Error initializing Gemini model: {init_error}")
+            print("\n Troubleshooting steps:")
+            print("   1. Verify API key at: "
+                  "https://aistudio.google.com/app/apikey")
+            print("   2. Check internet connection")
+            print("   3. Update library: "
+                  "pip install --upgrade google-generativeai")
             model = None
-            for model_name in model_names:
-                try:
-                    model = genai.GenerativeModel(model_name)
-                    print(f" Initialized with: {model_name}")
-                    break
-                except Exception:
-                    print(f"    Failed: {model_name}")
-                    continue
-            
-            if not model:
-                raise Exception(
-                    "No compatible model found. "
-                    "Your API key may have exhausted its quota. "
-                    "Please wait or get a new API key."
-                )
-                
-    except Exception as init_error:
-        print(f"\n Error initializing Gemini model: {init_error}")
-        print("\n Troubleshooting steps:")
-        print("   1. Verify API key at: "
-              "https://aistudio.google.com/app/apikey")
-        print("   2. Check internet connection")
-        print("   3. Update library: "
-              "pip install --upgrade google-generativeai")
+            model_name = None
+
+        _model_resolved = True
+        return model
+
+
+def invalidate_model_cache() -> None:
+    """Forget the resolved model so the next request rediscovers it."""
+    global model, model_name, model_from_cache, _model_resolved
+
+    with _model_lock:
+        log.warning("Invalidating model cache (%s)", model_name)
+        try:
+            os.remove(MODEL_CACHE_PATH)
+        except OSError:
+            pass
         model = None
+        model_name = None
+        model_from_cache = False
+        _model_resolved = False
+
+
+def start_model_discovery() -> threading.Thread:
+    """Resolve the model in a background thread."""
+    thread = threading.Thread(
+        target=get_model, name="model-discovery", daemon=True
+    )
+    thread.start()
+    return thread
 
 
 CSS = """
@@ -181,6 +1028,22 @@ CSS = """
     transform: translateX(4px) !important;
 }
 
+/* History List */
+.history-list button {
+    width: 100% !important;
+    background-color: transparent !important;
+    color: #94a3b8 !important;
+    border: 1px solid #334155 !important;
+    text-align: left !important;
+    border-radius: 0.5rem !important;
+    font-size: 0.875rem !important;
+}
+
+.history-list button:hover {
+    color: white !important;
+    border-color: #10b981 !important;
+}
+
 /* Delete Buttons */
 .delete-btn {
     background-color: #7f1d1d !important;
@@ -337,53 +1200,2669 @@ def convert_history_for_api(history: List[Dict]) -> List[Dict]:
     return api_history
 
 
-def chat_response_stream(history: List[Dict]):
-    """Stream response from Gemini model."""
-    print(f" Processing message (history: {len(history)} messages)")
+# "full" re-sends the message list on every flush, "delta" sends only
+# the newly appended text and patches it in client-side
+STREAM_MODE = os.getenv("GEM_STREAM_MODE", "full").lower()
 
-    if not history or len(history) < 2:
-        print(" Insufficient history")
-        return
+DELTA_FRAME_SEP = "\x1f"
 
-    user_message = history[-2].get("content", "")
-    print(f" User: {user_message[:50]}...")
+STREAM_DELTA_JS = """
+(frame) => {
+    if (!frame) return;
+    const sep = frame.indexOf("\\u001f");
+    const seq = Number(frame.slice(0, sep));
+    const bubbles = document.querySelectorAll("#gem-chatbot .message.bot");
+    const last = bubbles[bubbles.length - 1];
+    if (!last) return;
+    const target = last.querySelector(".md, .prose") || last;
+    if (seq === 0) target.textContent = "";
+    target.textContent += frame.slice(sep + 1);
+}
+"""
 
-    if not model:
-        error_msg = (
-            " Error: Model not initialized. "
-            "Please check your API key in the .env file."
-        )
-        print(error_msg)
-        history[-1]["content"] = error_msg
-        yield history
-        return
 
-    if len(user_message) > 10000:
-        error_msg = (
-            " Error: Message too long. "
-            "Please keep messages under 10,000 characters."
-        )
-        history[-1]["content"] = error_msg
-        yield history
-        return
+class StreamFlushPolicy:
+    """
+    Decide when streamed text is worth sending to the browser.
 
-    try:
-        api_history = convert_history_for_api(history[:-2])
+    Every yield re-sends the whole message list, so chunks are coalesced
+    until ``min_interval_ms`` has passed or ``min_chars`` new characters
+    have arrived, whichever comes first. The first chunk is always sent
+    straight away so time-to-first-token is unaffected. Setting both
+    limits to 0 flushes on every chunk.
+    """
 
-        # Start chat session
-        session = model.start_chat(history=api_history)
+    def __init__(self, min_interval_ms: float, min_chars: int):
+        self.min_interval = min_interval_ms / 1000
+        self.min_chars = min_chars
 
-        # Send message and stream response
-        response = session.send_message(user_message, stream=True)
+    def should_flush(
+        self, pending_chars: int, flushed_at: Optional[float], now: float
+    ) -> bool:
+        if flushed_at is None:
+            return True
+        if self.min_chars and pending_chars >= self.min_chars:
+            return True
+        if not self.min_interval and not self.min_chars:
+            return True
+        return bool(self.min_interval) and (
+            now - flushed_at >= self.min_interval
+        )
 
-        full_response = ""
-        for chunk in response:
-            if hasattr(chunk, "text"):
-                full_response += chunk.text
-                history[-1]["content"] = full_response
-                yield history
 
-        print(f" Response completed ({len(full_response)} chars)")
+flush_policy = StreamFlushPolicy(
+    min_interval_ms=float(os.getenv("GEM_FLUSH_INTERVAL_MS", "50")),
+    min_chars=int(os.getenv("GEM_FLUSH_MIN_CHARS", "200")),
+)
+
+
+class SessionCache:
+    """
+    LRU cache of live chat sessions keyed by conversation id.
+
+    Each entry remembers how many messages the session already holds and
+    the content digest of those messages, so a turn can reuse the
+    session only if the visible history, every earlier turn included,
+    is exactly what the session holds. Anything else (an edited
+    history, a different model) falls back to a rebuild from the full
+    history.
+
+    With a ``spill`` store, sessions idle for ``idle`` seconds, pushed
+    out by ``max_size`` or over the ``memory_budget`` (in estimated
+    bytes) are written to disk instead of dropped, and rehydrated from
+    their history on next use. Sessions unused for ``ttl`` seconds are
+    forgotten either way. Entries remember the chat user they belong
+    to, so a reopened chat only takes over that user's own session and
+    deleting chats forgets theirs.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: float,
+        idle: float = 0.0,
+        memory_budget: int = 0,
+        spill: Optional["SessionSpill"] = None,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.idle = idle
+        self.memory_budget = memory_budget
+        self.spill = spill
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._resident_bytes = 0
+        self._next_sweep = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.spills = 0
+        self.rehydrations = 0
+
+    async def get(
+        self, conversation_id: str, history: List[Dict], owner
+    ) -> Optional[Dict]:
+        """
+        Return the entry for ``history[:-2]``, if still valid.
+
+        Entries carry the live ``session`` and the prompt ``tokens`` it
+        already holds.
+        """
+        if not conversation_id or self.max_size <= 0:
+            return None
+
+        self._sweep()
+        prior = history[:-2] if len(history) >= 2 else []
+        with self._lock:
+            entry = self._pop(conversation_id)
+        if entry is None and self.spill is not None:
+            entry = await self._rehydrate(conversation_id, owner)
+
+        valid = (
+            entry is not None
+            and time.monotonic() - entry["used_at"] <= self.ttl
+            and entry["owner"] is owner
+            and entry["length"] == len(prior)
+            and entry["digest"]
+            == conversation_hasher.digest(prior, conversation_id)
+        )
+        with self._lock:
+            if not valid:
+                self.misses += 1
+                return None
+            entry["used_at"] = time.monotonic()
+            self._insert(conversation_id, entry)
+            self.hits += 1
+        return entry
+
+    def put(
+        self,
+        conversation_id: str,
+        session,
+        history: List[Dict],
+        owner,
+        tokens: int = 0,
+        user_id: str = "",
+    ) -> None:
+        """Remember ``session`` as holding exactly ``history``."""
+        if not conversation_id or self.max_size <= 0:
+            return
+
+        entry = {
+            "session": session,
+            "owner": owner,
+            "user": user_id,
+            "tokens": tokens,
+            "length": len(history),
+            "digest": conversation_hasher.digest(history, conversation_id),
+            "bytes": estimate_session_bytes(history),
+            "used_at": time.monotonic(),
+        }
+        with self._lock:
+            self._pop(conversation_id)
+            self._insert(conversation_id, entry)
+            evicted = self._over_limits()
+        self._spill_entries(evicted)
+        self._sweep()
+
+    def discard(self, conversation_id: str) -> None:
+        """Drop the session for a conversation."""
+        with self._lock:
+            self._pop(conversation_id)
+        if self.spill is not None:
+            self.spill.delete(conversation_id)
+
+    def park(self, conversation_id: str) -> None:
+        """Spill a session the user has just left, e.g. for a new chat."""
+        with self._lock:
+            entry = self._pop(conversation_id)
+        if entry is not None:
+            self._spill_entries([(conversation_id, entry)])
+
+    def adopt(
+        self, history: List[Dict], conversation_id: str, user_id: str
+    ) -> None:
+        """
+        Hand ``user_id``'s session for ``history`` to ``conversation_id``.
+
+        A chat reopened from the sidebar gets a new conversation id; if
+        the session that produced it is still resident or spilled, the
+        next message continues it instead of rebuilding.
+        """
+        if not user_id:
+            return
+        digest = history_digest(history)
+        with self._lock:
+            for old_id, entry in list(self._entries.items()):
+                if entry["digest"] == digest and entry["user"] == user_id:
+                    self._pop(old_id)
+                    self._insert(conversation_id, entry)
+                    return
+        if self.spill is not None:
+            self.spill.rename(digest, conversation_id, user_id)
+
+    def forget(self, user_id: str, digest: Optional[str] = None) -> None:
+        """
+        Drop ``user_id``'s sessions, resident and spilled: all of them,
+        or those holding exactly the chat with content hash ``digest``.
+        """
+        with self._lock:
+            for conversation_id, entry in list(self._entries.items()):
+                if entry["user"] == user_id and digest in (
+                    None, entry["digest"]
+                ):
+                    self._pop(conversation_id)
+        if self.spill is not None:
+            self.spill.forget(user_id, digest)
+
+    def _insert(self, conversation_id: str, entry: Dict) -> None:
+        self._entries[conversation_id] = entry
+        self._entries.move_to_end(conversation_id)
+        self._resident_bytes += entry["bytes"]
+
+    def _pop(self, conversation_id: str) -> Optional[Dict]:
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self._resident_bytes -= entry["bytes"]
+        return entry
+
+    def _over_limits(self) -> List[Tuple[str, Dict]]:
+        """Remove and return least recently used entries over the limits."""
+        evicted = []
+        while self._entries and (
+            len(self._entries) > self.max_size
+            or (
+                self.memory_budget
+                and self._resident_bytes > self.memory_budget
+                and len(self._entries) > 1
+            )
+        ):
+            conversation_id = next(iter(self._entries))
+            evicted.append((conversation_id, self._pop(conversation_id)))
+        return evicted
+
+    def _sweep(self) -> None:
+        """Spill idle sessions and purge expired ones, every so often."""
+        now = time.monotonic()
+        if not self.idle or now < self._next_sweep:
+            return
+        self._next_sweep = now + min(self.idle / 4, 60.0)
+        idle = []
+        with self._lock:
+            for conversation_id, entry in list(self._entries.items()):
+                if now - entry["used_at"] >= self.idle:
+                    idle.append((conversation_id, self._pop(conversation_id)))
+        self._spill_entries(idle)
+        if self.spill is not None:
+            self.spill.purge(self.ttl)
+
+    def _spill_entries(self, entries: List[Tuple[str, Dict]]) -> None:
+        if self.spill is None:
+            return
+        for conversation_id, entry in entries:
+            if time.monotonic() - entry["used_at"] > self.ttl:
+                continue
+            self.spill.write(conversation_id, entry)
+            self.spills += 1
+
+    async def _rehydrate(
+        self, conversation_id: str, owner
+    ) -> Optional[Dict]:
+        started = time.perf_counter()
+        row = await self.spill.take(conversation_id)
+        if row is None or row["model"] != getattr(owner, "model_name", ""):
+            return None
+        entry = {
+            "session": owner.start_chat(history=row["contents"]),
+            "owner": owner,
+            "user": row["user"],
+            "tokens": row["tokens"],
+            "length": row["length"],
+            "digest": row["digest"],
+            "bytes": row["bytes"],
+            "used_at": time.monotonic() - row["idle"],
+        }
+        self.rehydrations += 1
+        metrics.observe(
+            "session_rehydrate_seconds", time.perf_counter() - started
+        )
+        return entry
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = {
+                "size": len(self._entries),
+                "resident_bytes": self._resident_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "spills": self.spills,
+                "rehydrations": self.rehydrations,
+            }
+        if self.spill is not None:
+            stats["spilled"] = self.spill.count()
+        return stats
+
+
+# Rough per-message cost of a live session on top of its text: the
+# SDK's Content and Part objects, and the dicts they were built from
+SESSION_MESSAGE_OVERHEAD = 400
+
+
+def estimate_session_bytes(history: List[Dict]) -> int:
+    return sum(
+        len(msg.get("content") or "") + SESSION_MESSAGE_OVERHEAD
+        for msg in history
+    )
+
+
+def session_contents(session) -> List[Dict]:
+    """A live chat session's history as plain Gemini ``contents``."""
+    contents = []
+    for turn in session.history:
+        if isinstance(turn, dict):
+            role, parts = turn["role"], turn["parts"]
+        else:
+            role, parts = turn.role, turn.parts
+        text = "".join(
+            part if isinstance(part, str)
+            else part.get("text", "") if isinstance(part, dict)
+            else getattr(part, "text", "")
+            for part in parts
+        )
+        contents.append({"role": role, "parts": [{"text": text}]})
+    return contents
+
+
+def _session_codec() -> str:
+    """msgpack+zstd when both are installed, else json+zlib."""
+    try:
+        importlib.import_module("msgpack")
+        importlib.import_module("zstandard")
+    except ImportError:
+        return "json+zlib"
+    return "msgpack+zstd"
+
+
+def encode_session(payload: Dict, codec: str) -> bytes:
+    if codec == "msgpack+zstd":
+        import msgpack
+        import zstandard
+
+        return zstandard.ZstdCompressor().compress(msgpack.packb(payload))
+    return zlib.compress(json.dumps(payload).encode("utf-8"))
+
+
+def decode_session(data: bytes, codec: str) -> Dict:
+    if codec == "msgpack+zstd":
+        import msgpack
+        import zstandard
+
+        return msgpack.unpackb(zstandard.ZstdDecompressor().decompress(data))
+    return json.loads(zlib.decompress(data))
+
+
+class SessionSpill:
+    """
+    SQLite file holding idle sessions' histories, compressed.
+
+    All file work, encoding included, runs in order on one background
+    thread, so spilling never blocks the event loop and a read sees
+    every write queued before it. Sessions are local to the worker that
+    holds them, so the default file sits in a private temporary
+    directory, made on the first spill and removed at exit; the file
+    itself is only readable by its owner.
+    """
+
+    def __init__(self, path: str = ""):
+        self.path = path
+        self.codec = _session_codec()
+        self._local = threading.local()
+        # Rows in the file, kept by the spill thread so that stats()
+        # never has to query it
+        self._count = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="session-spill"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        """One connection per thread, opened (and the file made) lazily."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if not self.path:
+                directory = tempfile.mkdtemp(prefix="gem_sessions_")
+                atexit.register(shutil.rmtree, directory, True)
+                self.path = os.path.join(directory, "sessions.db")
+            # Chat text: owner-only, which SQLite carries over to the
+            # -wal and -shm files
+            os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+            os.chmod(self.path, 0o600)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Spilled sessions are only a cache; skip the fsyncs
+            conn.execute("PRAGMA synchronous=OFF")
+            with conn:
+                columns = {
+                    row[1] for row in conn.execute(
+                        "PRAGMA table_info(spilled_sessions)"
+                    )
+                }
+                if columns and "user_id" not in columns:
+                    conn.execute("DROP TABLE spilled_sessions")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS spilled_sessions ("
+                    "conversation_id TEXT PRIMARY KEY, "
+                    "user_id TEXT NOT NULL, digest TEXT NOT NULL, "
+                    "model TEXT NOT NULL, tokens INTEGER NOT NULL, "
+                    "length INTEGER NOT NULL, bytes INTEGER NOT NULL, "
+                    "codec TEXT NOT NULL, data BLOB NOT NULL, "
+                    "used_at REAL NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS spilled_sessions_user "
+                    "ON spilled_sessions (user_id, digest)"
+                )
+                # A GEM_SESSION_SPILL_PATH file may hold earlier rows
+                self._count = conn.execute(
+                    "SELECT COUNT(*) FROM spilled_sessions"
+                ).fetchone()[0]
+            self._local.conn = conn
+        return conn
+
+    def _submit(self, work, *args) -> concurrent.futures.Future:
+        def run():
+            try:
+                return work(*args)
+            except Exception as spill_error:
+                log.warning("Session spill failed: %s", spill_error)
+                return None
+
+        return self._executor.submit(run)
+
+    def write(self, conversation_id: str, entry: Dict) -> None:
+        """Queue a session (no longer in use) to be written out."""
+        # Wall-clock time, since the file outlives monotonic readings
+        used_at = time.time() - (time.monotonic() - entry["used_at"])
+        self._submit(self._write, conversation_id, entry, used_at)
+
+    def _write(self, conversation_id: str, entry: Dict, used_at: float):
+        payload = {"contents": session_contents(entry["session"])}
+        conn = self._connect()
+        with conn:
+            replaced = conn.execute(
+                "SELECT 1 FROM spilled_sessions WHERE conversation_id = ?",
+                (conversation_id,),
+            ).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO spilled_sessions (conversation_id, "
+                "user_id, digest, model, tokens, length, bytes, codec, "
+                "data, used_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    conversation_id, entry["user"], entry["digest"],
+                    getattr(entry["owner"], "model_name", ""),
+                    entry["tokens"], entry["length"], entry["bytes"],
+                    self.codec, encode_session(payload, self.codec),
+                    used_at,
+                ),
+            )
+        if replaced is None:
+            self._count += 1
+
+    async def take(self, conversation_id: str) -> Optional[Dict]:
+        """Remove and return a spilled session, if there is one."""
+        return await asyncio.wrap_future(
+            self._submit(self._take, conversation_id)
+        )
+
+    def _take(self, conversation_id: str) -> Optional[Dict]:
+        conn = self._connect()
+        with conn:
+            row = conn.execute(
+                "SELECT user_id, digest, model, tokens, length, bytes, "
+                "codec, data, used_at FROM spilled_sessions "
+                "WHERE conversation_id = ?",
+                (conversation_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "DELETE FROM spilled_sessions WHERE conversation_id = ?",
+                (conversation_id,),
+            )
+        self._count -= 1
+        (
+            user_id, digest, model, tokens, length, size, codec, data,
+            used_at,
+        ) = row
+        payload = decode_session(data, codec)
+        return {
+            "user": user_id,
+            "digest": digest,
+            "model": model,
+            "tokens": tokens,
+            "length": length,
+            "bytes": size,
+            "contents": payload["contents"],
+            "idle": max(0.0, time.time() - used_at),
+        }
+
+    def rename(self, digest: str, conversation_id: str, user_id: str):
+        """Move ``user_id``'s newest session with ``digest`` to a new id."""
+        self._submit(self._rename, digest, conversation_id, user_id)
+
+    def _rename(self, digest: str, conversation_id: str, user_id: str):
+        conn = self._connect()
+        with conn:
+            self._count -= conn.execute(
+                "DELETE FROM spilled_sessions WHERE conversation_id = ?",
+                (conversation_id,),
+            ).rowcount
+            conn.execute(
+                "UPDATE spilled_sessions SET conversation_id = ? "
+                "WHERE rowid = (SELECT rowid FROM spilled_sessions "
+                "WHERE user_id = ? AND digest = ? "
+                "ORDER BY used_at DESC LIMIT 1)",
+                (conversation_id, user_id, digest),
+            )
+
+    def delete(self, conversation_id: str) -> None:
+        self._submit(
+            self._execute,
+            "DELETE FROM spilled_sessions WHERE conversation_id = ?",
+            (conversation_id,),
+        )
+
+    def forget(self, user_id: str, digest: Optional[str] = None) -> None:
+        if digest is None:
+            self._submit(
+                self._execute,
+                "DELETE FROM spilled_sessions WHERE user_id = ?",
+                (user_id,),
+            )
+        else:
+            self._submit(
+                self._execute,
+                "DELETE FROM spilled_sessions "
+                "WHERE user_id = ? AND digest = ?",
+                (user_id, digest),
+            )
+
+    def purge(self, ttl: float) -> None:
+        self._submit(
+            self._execute,
+            "DELETE FROM spilled_sessions WHERE used_at < ?",
+            (time.time() - ttl,),
+        )
+
+    def _execute(self, sql: str, params: Tuple) -> None:
+        """Run a DELETE, keeping the row count."""
+        conn = self._connect()
+        with conn:
+            self._count -= conn.execute(sql, params).rowcount
+
+    def flush(self) -> None:
+        """Wait for the queued file work; for benchmarks and shutdown."""
+        self._executor.submit(lambda: None).result()
+
+    def count(self) -> int:
+        """Spilled sessions, as of the last spill-thread operation."""
+        return self._count
+
+
+SESSION_SPILL_ENABLED = os.getenv("GEM_SESSION_SPILL", "1") != "0"
+metrics.describe(
+    "session_rehydrate_seconds", "Time to restore a spilled chat session"
+)
+session_cache = SessionCache(
+    max_size=int(os.getenv("GEM_SESSION_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("GEM_SESSION_CACHE_TTL", "86400")),
+    idle=float(os.getenv("GEM_SESSION_IDLE_SECONDS", "300")),
+    memory_budget=int(
+        float(os.getenv("GEM_SESSION_MEMORY_MB", "256")) * 1024 * 1024
+    ),
+    spill=(
+        SessionSpill(os.getenv("GEM_SESSION_SPILL_PATH", ""))
+        if SESSION_SPILL_ENABLED else None
+    ),
+)
+metrics.register("session_cache", lambda: session_cache.stats())
+
+
+def new_conversation_id() -> str:
+    """Generate an id for a fresh conversation."""
+    return uuid.uuid4().hex
+
+
+class ConversationHasher:
+    """
+    Incrementally maintained content hash per conversation.
+
+    The digest is a hash chain over ``(role, content)`` pairs, so a
+    longer history extends the digest of its prefix. Each conversation
+    id remembers the messages it has hashed, and a new turn only hashes
+    the messages added since. The remembered messages are compared with
+    the history's prefix first (mostly identity checks on the same
+    strings), so a history edited anywhere, e.g. by an API client, is
+    hashed afresh rather than matched on its last message alone.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def digest(self, history: List[Dict], conversation_id: str = "") -> str:
+        if not conversation_id:
+            return history_digest(history)
+
+        start, digest = 0, ""
+        keys = _message_keys(history)
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+        if entry is not None:
+            cached_keys, cached_digest = entry
+            hashed = len(cached_keys)
+            if 0 < hashed <= len(keys) and keys[:hashed] == cached_keys:
+                start, digest = hashed, cached_digest
+
+        for msg in history[start:]:
+            digest = _chain_digest(digest, msg)
+
+        if history:
+            with self._lock:
+                self._entries[conversation_id] = (keys, digest)
+                self._entries.move_to_end(conversation_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return digest
+
+
+def _message_key(msg: Dict) -> Tuple[str, str]:
+    return msg.get("role") or "", msg.get("content") or ""
+
+
+def _message_keys(history: List[Dict]) -> Tuple[Tuple[str, str], ...]:
+    return tuple([
+        (msg.get("role") or "", msg.get("content") or "")
+        for msg in history
+    ])
+
+
+def _chain_digest(previous: str, msg: Dict) -> str:
+    role, content = _message_key(msg)
+    h = hashlib.sha256(previous.encode())
+    h.update(b"\x00" + role.encode() + b"\x00")
+    h.update(content.encode())
+    return h.hexdigest()
+
+
+def history_digest(history: List[Dict]) -> str:
+    """Content hash of a full history (see ``ConversationHasher``)."""
+    digest = ""
+    for msg in history:
+        digest = _chain_digest(digest, msg)
+    return digest
+
+
+conversation_hasher = ConversationHasher()
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-cased word tokens used by the search indexes."""
+    return TOKEN_RE.findall(text.lower())
+
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+class InvertedIndex:
+    """
+    Compact in-process full-text index.
+
+    Postings map each token to ``{doc_id: occurrences}`` and are updated
+    incrementally as documents are added or removed. All query tokens
+    must match; the last one also matches as a prefix so results show
+    up while a word is still being typed.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._doc_tokens: Dict[int, List[str]] = {}
+        self._vocabulary: List[str] = []
+        self._vocabulary_dirty = False
+        self._lock = threading.Lock()
+
+    def add(self, doc_id: int, texts: List[str]) -> None:
+        counts: Dict[str, int] = {}
+        for text in texts:
+            for token in tokenize(text):
+                counts[token] = counts.get(token, 0) + 1
+        with self._lock:
+            for token, count in counts.items():
+                postings = self._postings.setdefault(token, {})
+                if not postings:
+                    self._vocabulary_dirty = True
+                postings[doc_id] = postings.get(doc_id, 0) + count
+            self._doc_tokens.setdefault(doc_id, []).extend(counts)
+
+    def remove(self, doc_id: int) -> None:
+        with self._lock:
+            for token in self._doc_tokens.pop(doc_id, []):
+                postings = self._postings.get(token)
+                if postings is None:
+                    continue
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self._postings[token]
+                    self._vocabulary_dirty = True
+
+    def search(self, query: str) -> List[int]:
+        """Doc ids matching every token, best matches first."""
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        with self._lock:
+            scores: Optional[Dict[int, int]] = None
+            for i, token in enumerate(tokens):
+                if i == len(tokens) - 1:
+                    matches = self._prefix_postings(token)
+                else:
+                    matches = self._postings.get(token, {})
+                if scores is None:
+                    scores = dict(matches)
+                else:
+                    scores = {
+                        doc_id: score + matches[doc_id]
+                        for doc_id, score in scores.items()
+                        if doc_id in matches
+                    }
+                if not scores:
+                    return []
+
+        return sorted(scores, key=lambda doc_id: (-scores[doc_id], -doc_id))
+
+    def _prefix_postings(self, prefix: str) -> Dict[int, int]:
+        if self._vocabulary_dirty:
+            self._vocabulary = sorted(self._postings)
+            self._vocabulary_dirty = False
+
+        merged: Dict[int, int] = {}
+        start = bisect.bisect_left(self._vocabulary, prefix)
+        for token in itertools.islice(self._vocabulary, start, None):
+            if not token.startswith(prefix):
+                break
+            for doc_id, count in self._postings[token].items():
+                merged[doc_id] = merged.get(doc_id, 0) + count
+        return merged
+
+
+def fts_query(query: str) -> str:
+    """Turn free text into a safe FTS5 query (AND, last token prefix)."""
+    tokens = tokenize(query)
+    if not tokens:
+        return ""
+    terms = [f'"{token}"' for token in tokens]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+class ChatStore(ABC):
+    """
+    Storage backend for saved conversations.
+
+    Chats are listed newest first as summaries (``id``, ``title``,
+    ``timestamp``, ``message_count``, ``content_hash``); the messages of
+    a chat are only read when it is loaded, so the sidebar never pulls
+    full histories into memory. Duplicates are found by content hash.
+    """
+
+    @abstractmethod
+    def list_chats(
+        self, user_id: str, offset: int = 0, limit: int = 10
+    ) -> List[Dict]:
+        ...
+
+    @abstractmethod
+    def get_summary(self, user_id: str, chat_id: int) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    def get_history(self, user_id: str, chat_id: int) -> List[Dict]:
+        ...
+
+    @abstractmethod
+    def find_chat(self, user_id: str, digest: str) -> Optional[int]:
+        """Return the id of a saved chat with this content hash."""
+
+    @abstractmethod
+    def save_chat(
+        self, user_id: str, title: str, history: List[Dict], digest: str
+    ) -> int:
+        ...
+
+    @abstractmethod
+    def delete_chat(self, user_id: str, chat_id: int) -> None:
+        ...
+
+    @abstractmethod
+    def clear(self, user_id: str) -> None:
+        ...
+
+    @abstractmethod
+    def search(
+        self, user_id: str, query: str, offset: int = 0, limit: int = 10
+    ) -> List[Dict]:
+        """Summaries of chats whose messages match ``query``."""
+
+    def trim(self, user_id: str, keep: int) -> None:
+        """Delete all but the ``keep`` newest chats of a user."""
+        for chat in self.list_chats(user_id, offset=keep, limit=-1):
+            self.delete_chat(user_id, chat["id"])
+
+
+class MemoryChatStore(ChatStore):
+    """In-process store, mainly for single-worker development."""
+
+    def __init__(self):
+        self._chats: Dict[str, List[Dict]] = {}
+        self._by_hash: Dict[Tuple[str, str], int] = {}
+        self._index = InvertedIndex()
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def list_chats(self, user_id, offset=0, limit=10):
+        chats = self._chats.get(user_id, [])
+        end = None if limit < 0 else offset + limit
+        return [
+            {k: v for k, v in chat.items() if k != "history"}
+            for chat in chats[offset:end]
+        ]
+
+    def get_summary(self, user_id, chat_id):
+        for chat in self._chats.get(user_id, []):
+            if chat["id"] == chat_id:
+                return {k: v for k, v in chat.items() if k != "history"}
+        return None
+
+    def get_history(self, user_id, chat_id):
+        for chat in self._chats.get(user_id, []):
+            if chat["id"] == chat_id:
+                return [dict(msg) for msg in chat["history"]]
+        return []
+
+    def find_chat(self, user_id, digest):
+        return self._by_hash.get((user_id, digest))
+
+    def save_chat(self, user_id, title, history, digest):
+        with self._lock:
+            chat_id = self._next_id
+            self._next_id += 1
+            self._chats.setdefault(user_id, []).insert(0, {
+                "id": chat_id,
+                "title": title,
+                "timestamp": time.time(),
+                "message_count": len(history),
+                "content_hash": digest,
+                "history": [dict(msg) for msg in history],
+            })
+            self._by_hash.setdefault((user_id, digest), chat_id)
+        self._index.add(
+            chat_id, [msg.get("content") or "" for msg in history]
+        )
+        return chat_id
+
+    def search(self, user_id, query, offset=0, limit=10):
+        chats = {chat["id"]: chat for chat in self._chats.get(user_id, [])}
+        hits = [
+            chat_id for chat_id in self._index.search(query)
+            if chat_id in chats
+        ]
+        return [
+            {k: v for k, v in chats[chat_id].items() if k != "history"}
+            for chat_id in hits[offset:offset + limit]
+        ]
+
+    def delete_chat(self, user_id, chat_id):
+        with self._lock:
+            kept = []
+            for chat in self._chats.get(user_id, []):
+                if chat["id"] == chat_id:
+                    self._forget_hash(user_id, chat)
+                else:
+                    kept.append(chat)
+            self._chats[user_id] = kept
+
+    def clear(self, user_id):
+        with self._lock:
+            for chat in self._chats.pop(user_id, []):
+                self._forget_hash(user_id, chat)
+
+    def _forget_hash(self, user_id, chat):
+        self._index.remove(chat["id"])
+        key = (user_id, chat["content_hash"])
+        if self._by_hash.get(key) == chat["id"]:
+            del self._by_hash[key]
+
+
+class SQLiteChatStore(ChatStore):
+    """
+    SQLite store in WAL mode, shared by every worker on the host.
+
+    Messages are append-only rows keyed by ``(chat_id, seq)`` and chats
+    are indexed by ``(user_id, created_at)`` so a sidebar page is a
+    single index range scan. Message text is also indexed with FTS5 when
+    the SQLite build has it; FTS rowids pack ``(chat_id, seq)`` so a
+    chat's entries can be dropped with one rowid range delete.
+    """
+
+    FTS_SEQ_BITS = 20
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS chats (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        title TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        message_count INTEGER NOT NULL,
+        content_hash TEXT
+    );
+    CREATE INDEX IF NOT EXISTS chats_by_user
+        ON chats (user_id, created_at DESC);
+    CREATE TABLE IF NOT EXISTS messages (
+        chat_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        PRIMARY KEY (chat_id, seq)
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._setup_lock = threading.Lock()
+        self._ready = False
+
+    def _migrate(self, conn: sqlite3.Connection) -> None:
+        """Add and backfill ``content_hash`` on older databases."""
+        columns = {
+            row[1] for row in conn.execute("PRAGMA table_info(chats)")
+        }
+        with conn:
+            if "content_hash" not in columns:
+                conn.execute("ALTER TABLE chats ADD COLUMN content_hash TEXT")
+            missing = conn.execute(
+                "SELECT id, user_id FROM chats WHERE content_hash IS NULL"
+            ).fetchall()
+            for chat_id, user_id in missing:
+                conn.execute(
+                    "UPDATE chats SET content_hash = ? WHERE id = ?",
+                    (
+                        history_digest(self.get_history(user_id, chat_id)),
+                        chat_id,
+                    ),
+                )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS chats_by_hash "
+                "ON chats (user_id, content_hash)"
+            )
+
+        # Full-text index, built once for databases that predate it
+        has_fts = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+        ).fetchone()
+        try:
+            with conn:
+                conn.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts "
+                    "USING fts5(content, user_id UNINDEXED)"
+                )
+                if not has_fts:
+                    conn.execute(
+                        "INSERT INTO messages_fts (rowid, content, user_id) "
+                        f"SELECT (m.chat_id << {self.FTS_SEQ_BITS}) | m.seq, "
+                        "m.content, c.user_id FROM messages m "
+                        "JOIN chats c ON c.id = m.chat_id"
+                    )
+            self.fts = True
+        except sqlite3.OperationalError as fts_error:
+            log.warning("FTS5 unavailable, search will scan: %s", fts_error)
+            self.fts = False
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        One connection per thread; Gradio runs handlers in a pool.
+
+        The first connection creates and migrates the database, so
+        importing the module doesn't touch the file.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+            with self._setup_lock:
+                if not self._ready:
+                    conn.executescript(self.SCHEMA)
+                    self._migrate(conn)
+                    self._ready = True
+        return conn
+
+    SUMMARY_COLUMNS = (
+        "SELECT chats.id, title, created_at, message_count, "
+        "content_hash FROM chats "
+    )
+
+    def list_chats(self, user_id, offset=0, limit=10):
+        rows = self._connect().execute(
+            self.SUMMARY_COLUMNS + "WHERE user_id = ? "
+            "ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?",
+            (user_id, limit, offset),
+        )
+        return [self._summary(row) for row in rows]
+
+    def get_summary(self, user_id, chat_id):
+        row = self._connect().execute(
+            self.SUMMARY_COLUMNS + "WHERE id = ? AND user_id = ?",
+            (chat_id, user_id),
+        ).fetchone()
+        return self._summary(row) if row else None
+
+    @staticmethod
+    def _summary(row) -> Dict:
+        chat_id, title, created_at, message_count, content_hash = row
+        return {
+            "id": chat_id,
+            "title": title,
+            "timestamp": created_at,
+            "message_count": message_count,
+            "content_hash": content_hash,
+        }
+
+    def get_history(self, user_id, chat_id):
+        rows = self._connect().execute(
+            "SELECT m.role, m.content FROM messages m "
+            "JOIN chats c ON c.id = m.chat_id "
+            "WHERE c.id = ? AND c.user_id = ? ORDER BY m.seq",
+            (chat_id, user_id),
+        )
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def find_chat(self, user_id, digest):
+        row = self._connect().execute(
+            "SELECT id FROM chats WHERE user_id = ? AND content_hash = ? "
+            "LIMIT 1",
+            (user_id, digest),
+        ).fetchone()
+        return row[0] if row else None
+
+    def save_chat(self, user_id, title, history, digest):
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO chats (user_id, title, created_at, "
+                "message_count, content_hash) VALUES (?, ?, ?, ?, ?)",
+                (user_id, title, time.time(), len(history), digest),
+            )
+            chat_id = cursor.lastrowid
+            self._append_messages(conn, user_id, chat_id, 0, history)
+        return chat_id
+
+    def _append_messages(self, conn, user_id, chat_id, start_seq, messages):
+        rows = [
+            (chat_id, start_seq + i, msg["role"], msg["content"])
+            for i, msg in enumerate(_plain_messages(messages))
+        ]
+        conn.executemany(
+            "INSERT INTO messages (chat_id, seq, role, content) "
+            "VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        if self.fts:
+            conn.executemany(
+                "INSERT INTO messages_fts (rowid, content, user_id) "
+                "VALUES (?, ?, ?)",
+                [
+                    ((chat_id << self.FTS_SEQ_BITS) | seq, content, user_id)
+                    for chat_id, seq, _, content in rows
+                ],
+            )
+
+    def _delete_fts(self, conn, chat_id) -> None:
+        if self.fts:
+            conn.execute(
+                "DELETE FROM messages_fts WHERE rowid >= ? AND rowid < ?",
+                (
+                    chat_id << self.FTS_SEQ_BITS,
+                    (chat_id + 1) << self.FTS_SEQ_BITS,
+                ),
+            )
+
+    def search(self, user_id, query, offset=0, limit=10):
+        conn = self._connect()
+        if self.fts:
+            match = fts_query(query)
+            if not match:
+                return []
+            rows = conn.execute(
+                self.SUMMARY_COLUMNS + "JOIN ("
+                f"SELECT rowid >> {self.FTS_SEQ_BITS} AS chat_id, "
+                "min(rank) AS score FROM messages_fts "
+                "WHERE messages_fts MATCH ? AND user_id = ? "
+                "GROUP BY chat_id"
+                ") hits ON hits.chat_id = chats.id "
+                "ORDER BY hits.score, chats.id DESC LIMIT ? OFFSET ?",
+                (match, user_id, limit, offset),
+            )
+        else:
+            # Match the text literally, not as a LIKE pattern
+            pattern = re.sub(r"([\\%_])", r"\\\1", query.strip())
+            rows = conn.execute(
+                self.SUMMARY_COLUMNS + "WHERE user_id = ? AND id IN ("
+                "SELECT chat_id FROM messages "
+                "WHERE content LIKE ? ESCAPE '\\'"
+                ") ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?",
+                (user_id, f"%{pattern}%", limit, offset),
+            )
+        return [self._summary(row) for row in rows]
+
+    def delete_chat(self, user_id, chat_id):
+        conn = self._connect()
+        with conn:
+            deleted = conn.execute(
+                "DELETE FROM chats WHERE id = ? AND user_id = ?",
+                (chat_id, user_id),
+            ).rowcount
+            if deleted:
+                conn.execute(
+                    "DELETE FROM messages WHERE chat_id = ?", (chat_id,)
+                )
+                self._delete_fts(conn, chat_id)
+
+    def clear(self, user_id):
+        conn = self._connect()
+        with conn:
+            for (chat_id,) in conn.execute(
+                "SELECT id FROM chats WHERE user_id = ?", (user_id,)
+            ).fetchall():
+                self._delete_fts(conn, chat_id)
+            conn.execute(
+                "DELETE FROM messages WHERE chat_id IN "
+                "(SELECT id FROM chats WHERE user_id = ?)",
+                (user_id,),
+            )
+            conn.execute("DELETE FROM chats WHERE user_id = ?", (user_id,))
+
+
+def _plain_messages(history: List[Dict]) -> List[Dict]:
+    """Reduce messages to the role/content pairs the store keeps."""
+    return [
+        {"role": msg.get("role"), "content": msg.get("content") or ""}
+        for msg in history
+    ]
+
+
+def create_chat_store(url: str) -> ChatStore:
+    """Build a store from ``sqlite:///path`` or ``memory://``."""
+    if url.startswith("memory://"):
+        return MemoryChatStore()
+    if url.startswith("sqlite:///"):
+        return SQLiteChatStore(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported chat store: {url}")
+
+
+chat_store = create_chat_store(
+    os.getenv(
+        "GEM_CHAT_STORE",
+        "sqlite:///" + os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "chats.db"
+        ),
+    )
+)
+
+# Keep only the newest chats per user (0 = keep everything)
+MAX_SAVED_CHATS = int(os.getenv("GEM_MAX_SAVED_CHATS", "20"))
+
+# Chats per sidebar page
+SIDEBAR_PAGE_SIZE = int(os.getenv("GEM_SIDEBAR_PAGE_SIZE", "10"))
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap local token estimate (about four characters per token)."""
+    return len(text) // 4 + 1 if text else 0
+
+
+SUMMARY_ACK = "Understood, I'll keep that in mind."
+
+
+def message_tokens(msg: Dict) -> int:
+    return estimate_tokens(msg.get("content") or "")
+
+
+def history_tokens(history: List[Dict]) -> int:
+    return sum(message_tokens(msg) for msg in history)
+
+
+class ContextManager:
+    """
+    Keep the prompt sent to Gemini within a token budget.
+
+    Short conversations are sent as-is. Once the history outgrows
+    ``budget`` the first exchange stays pinned, the most recent turns
+    are kept down to a low-water mark, and everything in between is
+    folded into a rolling summary. The fold point and summary are cached
+    per user and conversation and only recomputed when the window has
+    to slide again, so most turns reuse the previous summary untouched.
+    A cached window is only reused while the digest of the messages it
+    folded still matches the history it is applied to.
+    """
+
+    SUMMARY_PROMPT = (
+        "Summarize the conversation below for your own later reference "
+        "in at most {words} words. Keep facts, names, decisions, code "
+        "identifiers and open questions; drop pleasantries.\n\n"
+        "Summary so far:\n{previous}\n\nNew messages:\n{messages}"
+    )
+
+    def __init__(
+        self,
+        budget: int,
+        low_water: float = 0.6,
+        summary_tokens: int = 512,
+        pin_first: bool = True,
+        token_counter: str = "estimate",
+        max_conversations: int = 1024,
+    ):
+        self.budget = budget
+        self.low_water = low_water
+        self.summary_tokens = summary_tokens
+        self.pin_first = pin_first
+        self.token_counter = token_counter
+        self.max_conversations = max_conversations
+        self._windows: "OrderedDict[Tuple[str, str], Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.turns = 0
+        self.windowed_turns = 0
+        self.summaries = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.last_turn_before = 0
+        self.last_turn_after = 0
+
+    def fits(self, tokens: int) -> bool:
+        return not self.budget or tokens <= self.budget
+
+    def record(self, before: int, after: int) -> None:
+        """Account one turn's prompt tokens without and with windowing."""
+        with self._lock:
+            self.turns += 1
+            self.windowed_turns += before != after
+            self.tokens_before += before
+            self.tokens_after += after
+            self.last_turn_before = before
+            self.last_turn_after = after
+        log.debug("Prompt tokens: %d -> %d", before, after)
+
+    async def build(
+        self,
+        active_model,
+        prior: List[Dict],
+        user_message: str,
+        conversation_id: str = "",
+        user_id: str = "",
+    ) -> Tuple[List[Dict], int, int]:
+        """API history for ``prior`` and its prompt tokens before/after."""
+        tokens = [message_tokens(msg) for msg in prior]
+        new_tokens = estimate_tokens(user_message)
+        before = sum(tokens) + new_tokens
+
+        if self.fits(before):
+            api_history = convert_history_for_api(prior)
+            after = await self._count(
+                active_model, api_history, user_message, before
+            )
+            return api_history, before, after
+
+        pin = 2 if self.pin_first and len(prior) > 2 else 0
+        fixed = sum(tokens[:pin]) + new_tokens + self.summary_tokens
+
+        key = (user_id, conversation_id)
+        with self._lock:
+            window = self._windows.get(key)
+        if window is not None and (
+            window["start"] > len(prior)
+            or window["digest"] != history_digest(prior[:window["start"]])
+        ):
+            # Another history under this id, or it was edited; start over
+            window = None
+        if window is None or fixed + sum(
+            tokens[window["start"]:]
+        ) > self.budget:
+            start = self._slide(tokens, pin, fixed)
+            if window is not None:
+                start = max(start, window["start"])
+            window = await self._fold(active_model, prior, pin, start, window)
+            window["digest"] = history_digest(prior[:window["start"]])
+
+        if conversation_id:
+            with self._lock:
+                self._windows[key] = window
+                self._windows.move_to_end(key)
+                while len(self._windows) > self.max_conversations:
+                    self._windows.popitem(last=False)
+
+        api_history = convert_history_for_api(prior[:pin])
+        if window["summary"]:
+            summary = (
+                "Summary of our earlier conversation:\n" + window["summary"]
+            )
+            api_history += convert_history_for_api([
+                {"role": "user", "content": summary},
+                {"role": "assistant", "content": SUMMARY_ACK},
+            ])
+        api_history += convert_history_for_api(prior[window["start"]:])
+
+        after = (
+            sum(tokens[:pin])
+            + estimate_tokens(window["summary"])
+            + sum(tokens[window["start"]:])
+            + new_tokens
+        )
+        after = await self._count(
+            active_model, api_history, user_message, after
+        )
+        return api_history, before, after
+
+    def _slide(self, tokens: List[int], pin: int, fixed: int) -> int:
+        """First kept message when trimming down to the low-water mark."""
+        target = int(self.budget * self.low_water) - fixed
+        start, kept = len(tokens), 0
+        while start > pin and kept + tokens[start - 1] <= target:
+            start -= 1
+            kept += tokens[start]
+        # Keep whole user/model exchanges
+        if (start - pin) % 2:
+            start += 1
+        return start
+
+    async def _fold(
+        self, active_model, prior, pin, start, window
+    ) -> Dict:
+        """Fold ``prior[previous start:start]`` into the summary."""
+        previous = window["summary"] if window else ""
+        folded_from = window["start"] if window else pin
+        folded = prior[folded_from:start]
+        if not folded:
+            return {"start": start, "summary": previous}
+
+        messages = "\n".join(
+            f"{'User' if msg.get('role') == 'user' else 'Assistant'}: "
+            f"{msg.get('content') or ''}"
+            for msg in folded
+        )
+        prompt = self.SUMMARY_PROMPT.format(
+            words=int(self.summary_tokens * 0.75),
+            previous=previous or "(none)",
+            messages=messages,
+        )
+        try:
+            response = await active_model.generate_content_async(prompt)
+            summary = response.text.strip()
+            with self._lock:
+                self.summaries += 1
+            log.info("Summarized %d older messages", len(folded))
+        except Exception as summary_error:
+            log.warning("Could not summarize history: %s", summary_error)
+            summary = previous
+        return {"start": start, "summary": summary}
+
+    async def _count(
+        self, active_model, api_history, user_message, estimate
+    ) -> int:
+        """Exact prompt size from the API when configured to ask it."""
+        if self.token_counter != "model":
+            return estimate
+        contents = api_history + convert_history_for_api(
+            [{"role": "user", "content": user_message}]
+        )
+        try:
+            counted = await active_model.count_tokens_async(contents)
+            return counted.total_tokens
+        except Exception as count_error:
+            log.warning("Could not count tokens: %s", count_error)
+            return estimate
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "turns": self.turns,
+                "windowed_turns": self.windowed_turns,
+                "summaries": self.summaries,
+                "prompt_tokens_before": self.tokens_before,
+                "prompt_tokens_after": self.tokens_after,
+                "last_turn_tokens_before": self.last_turn_before,
+                "last_turn_tokens_after": self.last_turn_after,
+            }
+
+
+context_manager = ContextManager(
+    budget=int(os.getenv("GEM_CONTEXT_TOKENS", "16000")),
+    summary_tokens=int(os.getenv("GEM_SUMMARY_TOKENS", "512")),
+    pin_first=os.getenv("GEM_CONTEXT_PIN_FIRST", "1") != "0",
+    token_counter=os.getenv("GEM_TOKEN_COUNTER", "estimate"),
+)
+metrics.register("context_manager", lambda: context_manager.stats())
+
+
+class ResponseCache:
+    """
+    Cache of complete replies in front of ``send_message``.
+
+    Keys hash the model name, the content hash of the prior history,
+    the user message with surrounding whitespace trimmed and the
+    generation config, so repeated prompt-card clicks share one entry.
+    Entries are evicted LRU beyond ``max_size`` and expire after ``ttl``
+    seconds. With ``path`` set they are also persisted in SQLite and
+    survive restarts. All SQLite work runs on one background thread:
+    writes are batched, each batch drops expired rows and keeps the
+    newest ``max_size``, and lookups that miss in memory read there.
+    """
+
+    def __init__(self, max_size: int, ttl: float, path: str = ""):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+        self._pending: List[Tuple] = []
+        self._writer = None
+        if path:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS response_cache ("
+                    "key TEXT PRIMARY KEY, text TEXT NOT NULL, "
+                    "latency REAL NOT NULL, created_at REAL NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS response_cache_created "
+                    "ON response_cache (created_at)"
+                )
+            self._writer = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="response-cache"
+            )
+            atexit.register(self.flush)
+
+    @staticmethod
+    def key(
+        model_name: Optional[str],
+        history_hash: str,
+        message: str,
+        generation_config=None,
+    ) -> str:
+        payload = json.dumps(
+            [
+                model_name or "",
+                history_hash,
+                normalize_prompt(message),
+                generation_config,
+            ],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    async def get(self, key: str) -> Optional[Dict]:
+        if self.max_size <= 0:
+            return None
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry["created_at"] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is None and self.path:
+            # Another worker sharing the file may have stored it
+            entry = await self._on_writer(self._load, key, now - self.ttl)
+            if entry is not None:
+                self._remember(key, entry)
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.latency_saved += entry["latency"]
+            return entry
+
+    def put(self, key: str, text: str, latency: float) -> None:
+        if self.max_size <= 0:
+            return
+
+        entry = {"text": text, "latency": latency, "created_at": time.time()}
+        self._remember(key, entry)
+        if self.path:
+            with self._lock:
+                self._pending.append(
+                    (key, text, latency, entry["created_at"])
+                )
+                first = len(self._pending) == 1
+            if first:
+                self._writer.submit(self.flush)
+
+    async def _on_writer(self, function, *args):
+        return await asyncio.wrap_future(self._writer.submit(function, *args))
+
+    def _load(self, key: str, since: float) -> Optional[Dict]:
+        try:
+            row = self._connect().execute(
+                "SELECT text, latency, created_at FROM response_cache "
+                "WHERE key = ? AND created_at > ?",
+                (key, since),
+            ).fetchone()
+        except sqlite3.Error as error:
+            log.warning("Could not read the response cache: %s", error)
+            return None
+        if row is None:
+            return None
+        return {"text": row[0], "latency": row[1], "created_at": row[2]}
+
+    def flush(self) -> None:
+        """Write queued entries in one transaction and prune the table."""
+        with self._lock:
+            rows, self._pending = self._pending, []
+        if not rows:
+            return
+        try:
+            conn = self._connect()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO response_cache "
+                    "(key, text, latency, created_at) VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                conn.execute(
+                    "DELETE FROM response_cache WHERE created_at <= ?",
+                    (time.time() - self.ttl,),
+                )
+                conn.execute(
+                    "DELETE FROM response_cache WHERE key NOT IN ("
+                    "SELECT key FROM response_cache "
+                    "ORDER BY created_at DESC LIMIT ?)",
+                    (self.max_size,),
+                )
+        except sqlite3.Error as error:
+            log.warning("Could not write the response cache: %s", error)
+
+    async def age(self, key: str) -> Optional[float]:
+        """Seconds since ``key`` was stored, without counting a lookup."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None and self.path:
+            entry = await self._on_writer(self._load, key, 0.0)
+        if entry is None:
+            return None
+        return time.time() - entry["created_at"]
+
+    def _remember(self, key: str, entry: Dict) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        """Hit-rate and latency-saved counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "latency_saved_s": self.latency_saved,
+            }
+
+
+def reply_cache_key(active_model, history_hash: str, message: str) -> str:
+    """Response cache key for ``message`` sent to ``active_model``."""
+    return response_cache.key(
+        getattr(active_model, "model_name", model_name),
+        history_hash,
+        message,
+        getattr(active_model, "_generation_config", None),
+    )
+
+
+def normalize_prompt(message: str) -> str:
+    """Trim whitespace around ``message``; the rest is significant."""
+    return message.strip()
+
+
+response_cache = ResponseCache(
+    max_size=int(os.getenv("GEM_RESPONSE_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("GEM_RESPONSE_CACHE_TTL", "3600")),
+    path=os.getenv("GEM_RESPONSE_CACHE_PATH", ""),
+)
+metrics.register("response_cache", lambda: response_cache.stats())
+
+# Cache hits are replayed in pieces of this size and pace
+REPLAY_CHUNK_CHARS = int(os.getenv("GEM_REPLAY_CHUNK_CHARS", "24"))
+REPLAY_CHUNK_DELAY = float(os.getenv("GEM_REPLAY_CHUNK_DELAY_MS", "10")) / 1000
+
+
+async def replay_stream(text: str):
+    """Yield a cached reply as a simulated stream."""
+    for i in range(0, len(text), REPLAY_CHUNK_CHARS):
+        if i and REPLAY_CHUNK_DELAY:
+            await asyncio.sleep(REPLAY_CHUNK_DELAY)
+        yield text[i:i + REPLAY_CHUNK_CHARS]
+
+
+async def response_texts(response):
+    """Yield the text of each streamed response chunk."""
+    finished = False
+    try:
+        async for chunk in response:
+            if hasattr(chunk, "text"):
+                yield chunk.text
+        finished = True
+    finally:
+        if not finished:
+            await close_upstream(response)
+
+
+async def close_upstream(response) -> None:
+    """Stop an SDK stream early so the rest of the reply isn't generated."""
+    # The SDK wraps the gRPC call; cancelling it closes the HTTP/2 stream
+    iterator = getattr(response, "_iterator", response)
+    cancel = getattr(iterator, "cancel", None)
+    if cancel is not None:
+        cancel()
+        return
+    aclose = getattr(iterator, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+class CancellationStats:
+    """
+    Count streams abandoned before the reply finished.
+
+    Tokens saved are estimated against the running average length of
+    replies that did finish, minus what had arrived before the cancel.
+    """
+
+    def __init__(self, expected_reply_tokens: int = 500):
+        self.average_reply_tokens = float(expected_reply_tokens)
+        self.abandoned: Dict[str, int] = {}
+        self.upstream_cancelled = 0
+        self.tokens_received = 0
+        self.tokens_saved = 0
+
+    def reply_finished(self, tokens: int) -> None:
+        self.average_reply_tokens += 0.1 * (
+            tokens - self.average_reply_tokens
+        )
+
+    def stream_abandoned(self, reason: str) -> None:
+        self.abandoned[reason] = self.abandoned.get(reason, 0) + 1
+
+    def upstream_stopped(self, tokens_received: int) -> None:
+        self.upstream_cancelled += 1
+        self.tokens_received += tokens_received
+        self.tokens_saved += max(
+            0, round(self.average_reply_tokens) - tokens_received
+        )
+
+    def stats(self) -> Dict:
+        return {
+            "abandoned": dict(self.abandoned),
+            "upstream_cancelled": self.upstream_cancelled,
+            "tokens_received": self.tokens_received,
+            "tokens_saved_estimate": self.tokens_saved,
+        }
+
+
+# Reply size assumed before a reply has been seen
+EXPECTED_REPLY_TOKENS = int(os.getenv("GEM_EXPECTED_REPLY_TOKENS", "500"))
+
+cancellations = CancellationStats(EXPECTED_REPLY_TOKENS)
+metrics.register("cancellations", lambda: cancellations.stats())
+
+
+class Flight:
+    """One upstream reply shared by every identical in-flight request."""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        # (served_by, session, token info) once the stream is open
+        self.opened: asyncio.Future = (
+            asyncio.get_running_loop().create_future()
+        )
+        self._changed = asyncio.Event()
+
+    def publish(self, text: str) -> None:
+        self.chunks.append(text)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self) -> None:
+        # Wake everyone waiting on the current event, then start a new one
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self):
+        """Yield every chunk from the start, then follow the live stream."""
+        self.subscribers += 1
+        try:
+            index = 0
+            while True:
+                if index < len(self.chunks):
+                    # Late joiners catch up from the replay buffer
+                    text = "".join(self.chunks[index:])
+                    index = len(self.chunks)
+                    yield text
+                elif self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                else:
+                    await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+
+
+class SingleFlight:
+    """
+    Share one upstream stream between identical concurrent requests.
+
+    The first request for a key leads: a background task opens the
+    stream and copies its chunks into a ``Flight``. Requests for the
+    same key that arrive while it is running follow that flight instead
+    of calling Gemini. The task outlives any one subscriber and is
+    cancelled only when nobody is listening any more.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._flights: Dict[str, Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def join(self, key: str) -> Optional[Flight]:
+        """Return the in-flight reply for ``key``, if there is one."""
+        if not self.enabled:
+            return None
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.followers += 1
+        return flight
+
+    def in_flight(self, key: str) -> bool:
+        return self.enabled and key in self._flights
+
+    def lead(self, key: str, opening, on_done=None) -> Flight:
+        """
+        Start a flight for ``key`` from an ``open_stream`` awaitable.
+
+        ``on_done(served_by, session, info, reply)`` runs in the flight's
+        task once the whole reply is in, whoever is still listening.
+        """
+        flight = Flight(key)
+        self._flights[key] = flight
+        self.leaders += 1
+        flight.task = asyncio.get_running_loop().create_task(
+            self._pump(flight, opening, on_done)
+        )
+        return flight
+
+    def _forget(self, flight: Flight) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    async def follow(self, flight: Flight):
+        """Yield the flight's text; the last one out cancels it."""
+        try:
+            async for text in flight.subscribe():
+                yield text
+        finally:
+            if not flight.subscribers and not flight.done:
+                self._forget(flight)
+                flight.task.cancel()
+
+    async def _pump(self, flight: Flight, opening, on_done) -> None:
+        texts = None
+        try:
+            served_by, session, info, texts = await opening
+            flight.opened.set_result((served_by, session, info))
+            async for text in texts:
+                flight.publish(text)
+        except asyncio.CancelledError:
+            # Everyone left; whatever Gemini had not sent yet is saved
+            if flight.opened.done():
+                cancellations.upstream_stopped(
+                    estimate_tokens("".join(flight.chunks))
+                )
+            flight.finish(asyncio.CancelledError())
+            raise
+        except Exception as e:
+            if not flight.opened.done():
+                flight.opened.set_exception(e)
+                # Nobody else will retrieve it; avoid a loop warning
+                flight.opened.exception()
+            flight.finish(e)
+        else:
+            reply = "".join(flight.chunks)
+            cancellations.reply_finished(estimate_tokens(reply))
+            if on_done is not None:
+                try:
+                    on_done(*flight.opened.result(), reply)
+                except Exception as done_error:
+                    log.warning("Could not store a finished reply: %s",
+                                done_error)
+            flight.finish()
+        finally:
+            self._forget(flight)
+            if texts is not None and hasattr(texts, "aclose"):
+                await texts.aclose()
+
+    def stats(self) -> Dict:
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
+
+
+single_flight = SingleFlight(
+    enabled=os.getenv("GEM_SINGLE_FLIGHT", "1") != "0"
+)
+metrics.register("single_flight", lambda: single_flight.stats())
+
+
+def error_name(error: BaseException) -> str:
+    return type(error).__name__
+
+
+def is_quota_exhausted(error: BaseException) -> bool:
+    """A 429 that will not clear by waiting a few seconds."""
+    return error_name(error) in RATE_LIMIT_ERRORS and (
+        "quota" in str(error).lower()
+    )
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """Server-provided retry hint, from headers or the error text."""
+    hint = getattr(error, "retry_after", None)
+    if hint is None:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+        hint = headers.get("retry-after") if headers else None
+    if hint is None:
+        match = RETRY_HINT_RE.search(str(error))
+        hint = match.group(1) if match else None
+    try:
+        return float(hint) if hint is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+# 429s and 503s, matched by class name so fakes and transports work
+RATE_LIMIT_ERRORS = ("ResourceExhausted", "TooManyRequests")
+RETRYABLE_ERRORS = RATE_LIMIT_ERRORS + (
+    "ServiceUnavailable",
+    "DeadlineExceeded",
+    "InternalServerError",
+)
+RETRY_HINT_RE = re.compile(
+    r"retry(?:[ _-]?after|[ _-]?delay|[ _]in)\D{0,20}(\d+(?:\.\d+)?)",
+    re.IGNORECASE,
+)
+
+
+class CircuitBreaker:
+    """
+    Per-model breaker: after ``threshold`` consecutive failures the model
+    is skipped for ``reset_timeout`` seconds, then one trial request is
+    let through (half-open) to decide whether to close it again.
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._trial_running:
+            self._trial_running = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._trial_running = False
+        if self.failures >= self.threshold or self.opened_at is not None:
+            self.opened_at = time.monotonic()
+
+    def end_trial(self) -> None:
+        """Let another trial through after one ended without a verdict."""
+        self._trial_running = False
+
+
+class RequestExecutor:
+    """
+    Retry, backoff and failover around opening a reply stream.
+
+    Rate-limit and availability errors are retried with jittered
+    exponential backoff, honoring retry-after hints. Quota exhaustion or
+    running out of attempts moves on to the next model in
+    ``PREFERRED_MODELS`` and the discovered flash models, skipping any
+    whose circuit breaker is open. Retries only happen until the first
+    chunk arrives; a stream that fails half-way surfaces its error
+    rather than repeating text.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 20.0,
+        breaker_threshold: int = 5,
+        breaker_reset: float = 60.0,
+        model_factory=None,
+        sleep=asyncio.sleep,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.model_factory = model_factory
+        self.sleep = sleep
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._models: Dict[str, object] = {}
+        self.stats = {"attempts": 0, "retries": 0, "failovers": 0}
+
+    def breaker(self, name: str) -> CircuitBreaker:
+        if name not in self._breakers:
+            self._breakers[name] = CircuitBreaker(
+                self.breaker_threshold, self.breaker_reset
+            )
+        return self._breakers[name]
+
+    def candidates(self, primary) -> List[Tuple[str, object]]:
+        """The primary model followed by the failover chain."""
+        primary_name = _short_model_name(
+            getattr(primary, "model_name", model_name or "")
+        )
+        names = [primary_name] + PREFERRED_MODELS + [
+            m for m in discovered_models
+            if 'flash' in m.lower() and 'exp' not in m.lower()
+        ]
+        seen = set()
+        chain = []
+        for name in names:
+            short = _short_model_name(name)
+            if short and short not in seen:
+                seen.add(short)
+                given = primary if short == primary_name else None
+                chain.append((short, given))
+        return chain
+
+    def _model(self, name: str, given):
+        if given is not None:
+            return given
+        if name not in self._models:
+            factory = self.model_factory or genai.GenerativeModel
+            self._models[name] = factory(name)
+        return self._models[name]
+
+    def backoff(self, attempt: int, error: BaseException) -> float:
+        hint = retry_after(error)
+        if hint is not None:
+            return min(hint, self.max_delay)
+        ceiling = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(ceiling / 2, ceiling)
+
+    async def open_stream(self, primary, open_session, message: str):
+        """
+        Return ``(model, session, info, texts)`` for the first candidate
+        that starts streaming. ``open_session(model, fresh)`` builds the
+        chat session and returns ``(session, info)``.
+        """
+        last_error: Optional[BaseException] = None
+        primary_error: Optional[BaseException] = None
+        for position, (name, given) in enumerate(self.candidates(primary)):
+            breaker = self.breaker(name)
+            trial = breaker.state == "half-open"
+            if not breaker.allow():
+                continue
+            if position:
+                self.stats["failovers"] += 1
+                log.warning("Failing over to %s", name)
+
+            try:
+                for attempt in range(self.max_attempts):
+                    self.stats["attempts"] += 1
+                    try:
+                        candidate = self._model(name, given)
+                        session, info = await open_session(
+                            candidate, attempt > 0
+                        )
+                        response = await session.send_message_async(
+                            message, stream=True
+                        )
+                        texts = response_texts(response)
+                        first = await texts.__anext__()
+                    except StopAsyncIteration:
+                        breaker.record_success()
+                        return candidate, session, info, _empty_texts()
+                    except Exception as error:
+                        last_error = error
+                        if not position:
+                            primary_error = error
+                        if error_name(error) not in RETRYABLE_ERRORS:
+                            if not position:
+                                raise
+                            # A fallback this key can't use (unknown
+                            # model, no access); try the next one
+                            log.warning("%s can't serve: %s", name, error)
+                            break
+                        breaker.record_failure()
+                        log.warning(
+                            "%s attempt %d failed: %s",
+                            name, attempt + 1, error,
+                        )
+                        if (
+                            is_quota_exhausted(error)
+                            or breaker.state != "closed"
+                        ):
+                            break
+                        if attempt + 1 < self.max_attempts:
+                            self.stats["retries"] += 1
+                            await self.sleep(self.backoff(attempt, error))
+                        continue
+
+                    breaker.record_success()
+                    return candidate, session, info, _prepend(first, texts)
+            finally:
+                # A trial that was cancelled or hit a non-retryable
+                # error says nothing about the model; let another one
+                # through rather than skipping the model for good
+                if trial:
+                    breaker.end_trial()
+
+        # Report the primary's own error; a fallback's would wrongly
+        # suggest the primary model is gone
+        if primary_error is not None:
+            raise primary_error
+        raise RuntimeError(
+            "All models are unavailable right now. Please try again later."
+        ) from last_error
+
+    def breaker_states(self) -> Dict[str, str]:
+        return {name: b.state for name, b in self._breakers.items()}
+
+
+def _short_model_name(name: str) -> str:
+    return name.split("/", 1)[1] if name.startswith("models/") else name
+
+
+async def _prepend(first: str, texts):
+    try:
+        yield first
+        async for text in texts:
+            yield text
+    finally:
+        await texts.aclose()
+
+
+async def _empty_texts():
+    return
+    yield
+
+
+request_executor = RequestExecutor(
+    max_attempts=int(os.getenv("GEM_RETRY_ATTEMPTS", "3")),
+    base_delay=float(os.getenv("GEM_RETRY_BASE_DELAY", "0.5")),
+    max_delay=float(os.getenv("GEM_RETRY_MAX_DELAY", "20")),
+    breaker_threshold=int(os.getenv("GEM_BREAKER_THRESHOLD", "5")),
+    breaker_reset=float(os.getenv("GEM_BREAKER_RESET", "60")),
+)
+metrics.register(
+    "executor",
+    lambda: dict(
+        request_executor.stats,
+        breaker_open={
+            name: int(state == "open")
+            for name, state in request_executor.breaker_states().items()
+        },
+    ),
+)
+
+
+class TokenBucket:
+    """Continuously refilled bucket; ``per_minute`` of 0 means unlimited."""
+
+    def __init__(self, per_minute: float, burst: Optional[float] = None):
+        self.per_minute = per_minute
+        self.capacity = burst if burst is not None else per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.updated
+        self.updated = now
+        self.tokens = min(
+            self.capacity, self.tokens + elapsed * self.per_minute / 60
+        )
+
+    def time_until(self, amount: float, now: Optional[float] = None) -> float:
+        """Seconds until ``amount`` will have accumulated, unbounded."""
+        if not self.per_minute:
+            return 0.0
+        self._refill(now if now is not None else time.monotonic())
+        return max(0.0, (amount - self.tokens) * 60 / self.per_minute)
+
+    def wait_time(self, amount: float, now: Optional[float] = None) -> float:
+        """Seconds until ``amount`` can be taken (0 if available now)."""
+        # Requests larger than the bucket only wait for a full bucket
+        return self.time_until(min(amount, self.capacity), now)
+
+    def take(self, amount: float) -> None:
+        if self.per_minute:
+            self._refill(time.monotonic())
+            self.tokens -= amount
+
+
+class AdmissionTicket:
+    """A queued request waiting for rate-limit admission."""
+
+    __slots__ = ("user", "tokens", "future", "enqueued_at")
+
+    def __init__(self, user: str, tokens: int, future: asyncio.Future):
+        self.user = user
+        self.tokens = tokens
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class AdmissionController:
+    """
+    Request and token-per-minute limits, per user and global, in front
+    of Gemini.
+
+    Waiting requests sit in one FIFO per user and a single dispatcher
+    admits them round-robin across users, so a heavy user queues behind
+    their own requests instead of everyone else's. A user over their
+    own limit is skipped without holding up the others. Token usage is
+    charged from an estimate up front and corrected once the reply is
+    known.
+    """
+
+    def __init__(
+        self,
+        global_rpm: float = 0,
+        global_tpm: float = 0,
+        user_rpm: float = 0,
+        user_tpm: float = 0,
+        max_users: int = 10000,
+    ):
+        self.global_requests = TokenBucket(global_rpm)
+        self.global_tokens = TokenBucket(global_tpm)
+        self.user_rpm = user_rpm
+        self.user_tpm = user_tpm
+        self.max_users = max_users
+        self.enabled = any((global_rpm, global_tpm, user_rpm, user_tpm))
+        self._user_buckets: "OrderedDict[str, Tuple]" = OrderedDict()
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.admitted = 0
+        self.total_wait = 0.0
+
+    def _buckets(self, user: str) -> Tuple[TokenBucket, TokenBucket]:
+        buckets = self._user_buckets.get(user)
+        if buckets is None:
+            buckets = (TokenBucket(self.user_rpm), TokenBucket(self.user_tpm))
+            self._user_buckets[user] = buckets
+            while len(self._user_buckets) > self.max_users:
+                self._user_buckets.popitem(last=False)
+        self._user_buckets.move_to_end(user)
+        return buckets
+
+    def _wait_time(self, ticket: AdmissionTicket, now: float) -> float:
+        user_requests, user_tokens = self._buckets(ticket.user)
+        return max(
+            self.global_requests.wait_time(1, now),
+            self.global_tokens.wait_time(ticket.tokens, now),
+            user_requests.wait_time(1, now),
+            user_tokens.wait_time(ticket.tokens, now),
+        )
+
+    def _admit(self, ticket: AdmissionTicket) -> None:
+        user_requests, user_tokens = self._buckets(ticket.user)
+        for bucket, amount in (
+            (self.global_requests, 1),
+            (self.global_tokens, ticket.tokens),
+            (user_requests, 1),
+            (user_tokens, ticket.tokens),
+        ):
+            bucket.take(amount)
+        self.admitted += 1
+        self.total_wait += time.monotonic() - ticket.enqueued_at
+        ticket.future.set_result(True)
+
+    def enqueue(self, user: str, tokens: int) -> AdmissionTicket:
+        loop = asyncio.get_running_loop()
+        ticket = AdmissionTicket(user, tokens, loop.create_future())
+        if not self.enabled:
+            ticket.future.set_result(True)
+            return ticket
+        # Nobody waiting and within limits: admit without queueing
+        if not self._queues and self._wait_time(ticket, time.monotonic()) <= 0:
+            self._admit(ticket)
+            return ticket
+
+        self._queues.setdefault(user, deque()).append(ticket)
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = loop.create_task(self._dispatch())
+        return ticket
+
+    def cancel(self, ticket: AdmissionTicket) -> None:
+        """Withdraw a ticket that is no longer wanted."""
+        queue = self._queues.get(ticket.user)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.user]
+        if not ticket.future.done():
+            ticket.future.cancel()
+
+    def settle(self, user: str, estimated: int, actual: int) -> None:
+        """Correct the token charge once the real usage is known."""
+        difference = actual - estimated
+        if difference:
+            self.global_tokens.take(difference)
+            self._buckets(user)[1].take(difference)
+
+    async def _dispatch(self) -> None:
+        while self._queues:
+            self._wakeup.clear()
+            now = time.monotonic()
+            soonest = None
+            # One pass of round-robin over the users with waiters
+            for user in list(self._queues):
+                queue = self._queues[user]
+                ticket = queue[0]
+                wait = self._wait_time(ticket, now)
+                if wait <= 0:
+                    queue.popleft()
+                    self._admit(ticket)
+                    # Served users go to the back of the rotation
+                    if queue:
+                        self._queues.move_to_end(user)
+                    else:
+                        del self._queues[user]
+                elif soonest is None or wait < soonest:
+                    soonest = wait
+            if soonest is not None:
+                try:
+                    await asyncio.wait_for(
+                        self._wakeup.wait(), timeout=soonest
+                    )
+                except asyncio.TimeoutError:
+                    pass
+
+    def position(self, ticket: AdmissionTicket) -> Tuple[int, float]:
+        """1-based queue position and estimated wait in seconds."""
+        queue = self._queues.get(ticket.user)
+        if queue is None or ticket not in queue:
+            return 0, 0.0
+        index = queue.index(ticket)
+        ahead = index
+        for user, other in self._queues.items():
+            if user != ticket.user:
+                ahead += min(len(other), index + 1)
+
+        now = time.monotonic()
+        user_requests, user_tokens = self._buckets(ticket.user)
+        # Everyone ahead is charged before this ticket; token usage
+        # ahead is assumed to look like this request's estimate
+        eta = max(
+            self.global_requests.time_until(ahead + 1, now),
+            self.global_tokens.time_until(ticket.tokens * (ahead + 1), now),
+            user_requests.time_until(index + 1, now),
+            user_tokens.time_until(ticket.tokens * (index + 1), now),
+        )
+        return ahead + 1, eta
+
+    def stats(self) -> Dict:
+        return {
+            "queued": sum(len(queue) for queue in self._queues.values()),
+            "admitted": self.admitted,
+            "avg_wait_s": (
+                self.total_wait / self.admitted if self.admitted else 0.0
+            ),
+        }
+
+
+admission = AdmissionController(
+    global_rpm=float(os.getenv("GEM_GLOBAL_RPM", "120")),
+    global_tpm=float(os.getenv("GEM_GLOBAL_TPM", "2000000")),
+    user_rpm=float(os.getenv("GEM_USER_RPM", "20")),
+    user_tpm=float(os.getenv("GEM_USER_TPM", "200000")),
+)
+metrics.register("admission", lambda: admission.stats())
+
+# How often a queued request refreshes its position in the UI
+QUEUE_REFRESH_SECONDS = 1.0
+
+
+def request_user_key(request) -> str:
+    """Rate-limit identity: username, else client IP, else session."""
+    if request is None:
+        return "anonymous"
+    username = getattr(request, "username", None)
+    if username:
+        return f"user:{username}"
+    client = getattr(request, "client", None)
+    host = getattr(client, "host", None)
+    if host:
+        return f"ip:{host}"
+    return f"session:{getattr(request, 'session_hash', '')}"
+
+
+def queue_placeholder(position: int, eta: float) -> str:
+    return (
+        f"⏳ You're #{position} in the queue "
+        f"(about {max(1, round(eta))}s)..."
+    )
+
+
+async def get_model_async():
+    """Resolve the model without blocking the event loop."""
+    if _model_resolved or not GOOGLE_API_KEY:
+        return model
+    return await asyncio.to_thread(get_model)
+
+
+def record_reply_metrics(
+    model: str,
+    outcome: str,
+    started: float,
+    first_at: Optional[float],
+    chunks: int,
+    prompt: str,
+    prompt_tokens: Optional[int],
+    response: str,
+) -> None:
+    """Record one finished reply in the request metrics."""
+    finished_at = time.monotonic()
+    metrics.inc("requests_total", model=model, outcome=outcome)
+    metrics.observe("reply_seconds", finished_at - started, model=model)
+    if first_at is not None:
+        metrics.observe(
+            "time_to_first_chunk_seconds", first_at - started, model=model
+        )
+        if chunks > 1 and finished_at > first_at:
+            metrics.observe(
+                "chunks_per_second",
+                (chunks - 1) / (finished_at - first_at),
+                model=model,
+            )
+    metrics.observe("prompt_chars", len(prompt), model=model)
+    if prompt_tokens is not None:
+        metrics.observe("prompt_tokens", prompt_tokens, model=model)
+    metrics.observe("response_chars", len(response), model=model)
+
+
+async def _stream_reply(
+    history: List[Dict],
+    conversation_id: str,
+    user_key: str = "anonymous",
+    user_id: str = "",
+):
+    """
+    Stream the reply into ``history[-1]`` and yield what changed.
+
+    ``user_key`` is the rate-limit identity; ``user_id`` the chat user
+    whose saved chats the live session may later be matched with.
+
+    Each yield is the text appended since the previous one, or ``None``
+    when the assistant message was replaced outright (queue position,
+    errors).
+    """
+    log.debug("Processing message (history: %d messages)", len(history))
+
+    if not history or len(history) < 2:
+        log.debug("Insufficient history")
+        return
+
+    user_message = history[-2].get("content", "")
+    log.debug("User: %.50s...", user_message)
+
+    active_model = await get_model_async()
+    if not active_model:
+        error_msg = (
+            " Error: Model not initialized. "
+            "Please check your API key in the .env file."
+        )
+        log.error(error_msg.strip())
+        history[-1]["content"] = error_msg
+        yield None
+        return
+
+    if len(user_message) > MAX_MESSAGE_CHARS:
+        error_msg = (
+            " Error: Message too long. "
+            "Please keep messages under 10,000 characters."
+        )
+        history[-1]["content"] = error_msg
+        yield None
+        return
+
+    served_model = _short_model_name(
+        getattr(active_model, "model_name", None) or model_name or ""
+    )
+    outcome = "ok"
+    try:
+        started = time.monotonic()
+        cache_key = reply_cache_key(
+            active_model,
+            conversation_hasher.digest(history[:-2], conversation_id),
+            user_message,
+        )
+        cached = await response_cache.get(cache_key)
+
+        flight = None if cached is not None else single_flight.join(
+            cache_key
+        )
+        leader = None
+        if cached is not None:
+            # Replay the stored reply so the UI streams as usual
+            log.debug("Response cache hit")
+            outcome = "cache_hit"
+            prefetcher.record_hit(cache_key)
+            session_cache.discard(conversation_id)
+            texts = replay_stream(cached["text"])
+        elif flight is not None:
+            # The same request is already streaming; share its reply
+            log.debug("Joined an identical in-flight request")
+            outcome = "coalesced"
+            session_cache.discard(conversation_id)
+            texts = single_flight.follow(flight)
+        else:
+            async def open_session(candidate, fresh: bool):
+                # Reuse the live session so only the new turn is sent
+                # through, unless it has outgrown the context budget
+                if fresh:
+                    session_cache.discard(conversation_id)
+                entry = await session_cache.get(
+                    conversation_id, history, candidate
+                )
+                new_tokens = estimate_tokens(user_message)
+                if entry is not None and context_manager.fits(
+                    entry["tokens"] + new_tokens
+                ):
+                    before = history_tokens(history[:-2]) + new_tokens
+                    return entry["session"], (
+                        before, entry["tokens"] + new_tokens
+                    )
+                api_history, before, after = await context_manager.build(
+                    candidate,
+                    history[:-2],
+                    user_message,
+                    conversation_id,
+                    user_id or user_key,
+                )
+                return candidate.start_chat(history=api_history), (
+                    before, after
+                )
+
+            # Wait for rate-limit admission, showing the queue position
+            # in the placeholder while it takes
+            estimated_tokens = (
+                min(
+                    history_tokens(history[:-2]),
+                    context_manager.budget or sys.maxsize,
+                )
+                + estimate_tokens(user_message)
+                + EXPECTED_REPLY_TOKENS
+            )
+            ticket = admission.enqueue(user_key, estimated_tokens)
+            try:
+                while not ticket.future.done():
+                    position, eta = admission.position(ticket)
+                    if position:
+                        history[-1]["content"] = queue_placeholder(
+                            position, eta
+                        )
+                        yield None
+                    await asyncio.wait(
+                        [ticket.future], timeout=QUEUE_REFRESH_SECONDS
+                    )
+            finally:
+                admission.cancel(ticket)
+
+            # Send message and stream response without holding a thread,
+            # retrying and failing over before the first chunk arrives.
+            # Identical requests arriving meanwhile share this stream.
+            flight = single_flight.join(cache_key)
+            if flight is None:
+                def store_reply(served_by, session, info, reply: str):
+                    # Runs in the flight's task once the reply is
+                    # complete, even if this request has left by then
+                    tokens_before, prompt_tokens = info
+                    context_manager.record(tokens_before, prompt_tokens)
+                    session_cache.put(
+                        conversation_id,
+                        session,
+                        history[:-1] + [
+                            {"role": "assistant", "content": reply}
+                        ],
+                        served_by,
+                        prompt_tokens + estimate_tokens(reply),
+                        user_id,
+                    )
+                    if reply:
+                        response_cache.put(
+                            cache_key, reply, time.monotonic() - started
+                        )
+                    admission.settle(
+                        user_key,
+                        estimated_tokens,
+                        prompt_tokens + estimate_tokens(reply),
+                    )
+
+                flight = leader = single_flight.lead(
+                    cache_key,
+                    request_executor.open_stream(
+                        active_model, open_session, user_message
+                    ),
+                    store_reply,
+                )
+            else:
+                admission.settle(user_key, estimated_tokens, 0)
+                outcome = "coalesced"
+                session_cache.discard(conversation_id)
+            texts = single_flight.follow(flight)
+
+        # Accumulate chunks and only push an update to the browser
+        # when the flush policy says enough has changed
+        buffer = io.StringIO()
+        pending: List[str] = []
+        pending_chars = 0
+        flushed_at = None
+        first_at = None
+        chunks = 0
+        finished = False
+        try:
+            async for text in texts:
+                buffer.write(text)
+                pending.append(text)
+                pending_chars += len(text)
+                chunks += 1
+                now = time.monotonic()
+                if first_at is None:
+                    first_at = now
+                if flush_policy.should_flush(
+                    pending_chars, flushed_at, now
+                ):
+                    history[-1]["content"] = buffer.getvalue()
+                    delta = "".join(pending)
+                    pending.clear()
+                    pending_chars = 0
+                    flushed_at = now
+                    yield delta
+            finished = True
+        except (asyncio.CancelledError, GeneratorExit) as e:
+            # Stop button, navigation or a closed tab: release the
+            # upstream stream now rather than reading it to the end
+            cancellations.stream_abandoned(
+                "cancelled" if isinstance(e, asyncio.CancelledError)
+                else "closed"
+            )
+            log.info("Stream abandoned, closing upstream")
+            metrics.inc(
+                "requests_total", model=served_model, outcome="cancelled"
+            )
+            # A half-read chat session can't take another turn
+            session_cache.discard(conversation_id)
+            raise
+        finally:
+            if not finished:
+                await texts.aclose()
+
+        full_response = buffer.getvalue()
+        if pending:
+            history[-1]["content"] = full_response
+            yield "".join(pending)
+
+        log.debug("Response completed (%d chars)", len(full_response))
+        prompt_tokens = None
+        if leader is not None:
+            served_by, _, (_, prompt_tokens) = leader.opened.result()
+            served_model = _short_model_name(
+                getattr(served_by, "model_name", served_model)
+            )
+        record_reply_metrics(
+            served_model,
+            outcome,
+            started,
+            first_at,
+            chunks,
+            user_message,
+            prompt_tokens,
+            full_response,
+        )
 
     except Exception as e:
         error_msg = (
@@ -393,27 +3872,107 @@ def chat_response_stream(history: List[Dict]):
             "• API key validity\n"
             "• Rate limits"
         )
-        print(f" Exception: {e}")
+        log.error("Reply failed: %s", e)
+        metrics.inc("requests_total", model=served_model, outcome="error")
+        metrics.inc("errors_total", model=served_model, error=error_name(e))
+        session_cache.discard(conversation_id)
+        # The executor only lets these through from the primary model;
+        # a fallback that is gone is skipped instead
+        if model_from_cache and type(e).__name__ in MODEL_GONE_ERRORS:
+            invalidate_model_cache()
         history[-1]["content"] = error_msg
-        yield history
+        yield None
+
+
+async def chat_response_stream(
+    history: List[Dict],
+    conversation_id: str = "",
+    user_id: str = "",
+    request: "gr.Request" = None,
+):
+    """Stream response from Gemini model on the event loop."""
+    stream = _stream_reply(
+        history,
+        conversation_id,
+        request_user_key(request),
+        resolve_user_id(user_id, request),
+    )
+    try:
+        async for _ in stream:
+            yield history
+    finally:
+        # Runs when Gradio cancels or closes this generator, and passes
+        # that on so the upstream stream stops too
+        await stream.aclose()
+
+
+async def chat_response_stream_delta(
+    history: List[Dict],
+    conversation_id: str = "",
+    user_id: str = "",
+    request: "gr.Request" = None,
+):
+    """
+    Stream only the appended text of the assistant message.
+
+    Yields ``(chatbot_update, delta_frame)`` pairs. While streaming the
+    chatbot is left untouched and ``STREAM_DELTA_JS`` patches each frame
+    into the last bot bubble in the browser, so the payload per chunk no
+    longer depends on conversation length. Frames leave the component's
+    own value behind, so the full history is sent once at the end if
+    any were streamed since it was last sent; a reply therefore costs
+    one full history plus its frames, however many chunks it has.
+    """
+    seq = 0
+    synced = True
+    stream = _stream_reply(
+        history,
+        conversation_id,
+        request_user_key(request),
+        resolve_user_id(user_id, request),
+    )
+    try:
+        async for delta in stream:
+            if delta is None:
+                yield history, ""
+                synced = True
+                continue
+            yield gr.update(), f"{seq}{DELTA_FRAME_SEP}{delta}"
+            seq += 1
+            synced = False
+    finally:
+        await stream.aclose()
+    if not synced:
+        yield history, ""
 
 
-def handle_user_message(message: str, history: Optional[List[Dict]]):
+THINKING_PLACEHOLDER = "🤔 Thinking..."
+
+
+@timed_handler
+def handle_user_message(
+    message: str,
+    history: Optional[List[Dict]],
+    conversation_id: str = "",
+):
     """Process user message and add to chat history."""
-    print(" New message received")
+    log.debug("New message received")
 
     if not message or not message.strip():
-        print(" Empty message")
-        return history if history else []
+        log.debug("Empty message")
+        return (history if history else []), conversation_id
 
     if history is None:
         history = []
 
+    if not conversation_id:
+        conversation_id = new_conversation_id()
+
     history.append({"role": "user", "content": message.strip()})
-    history.append({"role": "assistant", "content": "🤔 Thinking..."})
+    history.append({"role": "assistant", "content": THINKING_PLACEHOLDER})
 
-    print(f" History updated: {len(history)} messages")
-    return history
+    log.debug("History updated: %d messages", len(history))
+    return history, conversation_id
 
 
 def show_chat_and_clear_textbox(chatbot_history: List[Dict]):
@@ -429,410 +3988,1414 @@ def show_chat_and_clear_textbox(chatbot_history: List[Dict]):
     return initial_view_update, chatbot_update, msg_update
 
 
-def save_and_clear_session(
-    current_history: List[Dict], all_history: List[Dict]
+# The steps a message goes through, in order. The UI wires them as one
+# event chain per trigger and benchmarks.py drives the same sequence.
+MESSAGE_CHAIN = (
+    handle_user_message,
+    show_chat_and_clear_textbox,
+    (
+        chat_response_stream_delta
+        if STREAM_MODE == "delta"
+        else chat_response_stream
+    ),
+)
+
+
+async def reply_events(
+    message: str,
+    history: Optional[List[Dict]] = None,
+    conversation_id: str = "",
+    user_key: str = "anonymous",
+):
+    """
+    Run one turn without the UI and yield ``(kind, payload)`` events.
+
+    ``status`` carries the placeholder text while queued, ``delta`` the
+    reply text as it streams. The last event is ``done`` with the reply,
+    conversation id and updated history, or ``error`` with the message
+    the UI would have shown.
+    """
+    if not message or not message.strip():
+        yield "error", "Message is empty."
+        return
+
+    history = [dict(msg) for msg in history or []]
+    history, conversation_id = handle_user_message(
+        message, history, conversation_id
+    )
+    streamed: List[str] = []
+    # Replacements are only known to be statuses once more text follows;
+    # the last one may be an error
+    replaced, status_text = False, ""
+    async for delta in _stream_reply(history, conversation_id, user_key):
+        if replaced:
+            yield "status", status_text
+            replaced = False
+        if delta is None:
+            replaced, status_text = True, history[-1]["content"]
+            continue
+        streamed.append(delta)
+        yield "delta", delta
+
+    reply = "".join(streamed)
+    content = history[-1]["content"]
+    # An empty reply leaves the placeholder; anything else is an error
+    if content != reply and (streamed or content != THINKING_PLACEHOLDER):
+        yield "error", content.strip()
+        return
+    history[-1]["content"] = reply
+    yield "done", {
+        "reply": reply,
+        "conversation_id": conversation_id,
+        "history": history,
+    }
+
+
+def resolve_user_id(user_id: str, request=None) -> str:
+    """Authenticated username, else the id kept in the browser."""
+    username = getattr(request, "username", None)
+    return username or user_id or new_conversation_id()
+
+
+def chat_title(history: List[Dict]) -> str:
+    """Create title from first user message."""
+    for msg in history:
+        if msg.get("role") == "user" and msg.get("content"):
+            first = msg["content"].strip()
+            title = first[:50]
+            if len(first) > 50:
+                title += "..."
+            return title
+    return "New Chat"
+
+
+def save_chat_if_new(
+    user_id: str, history: List[Dict], conversation_id: str = ""
+) -> bool:
+    """Store ``history`` unless an identical chat is already saved."""
+    if not history:
+        return False
+    digest = conversation_hasher.digest(history, conversation_id)
+    if chat_store.find_chat(user_id, digest) is not None:
+        return False
+    chat_store.save_chat(user_id, chat_title(history), history, digest)
+    if MAX_SAVED_CHATS:
+        chat_store.trim(user_id, MAX_SAVED_CHATS)
+    return True
+
+
+def sidebar_updates(user_id: str, page: int, query: str = ""):
+    """
+    One page of the history list plus its navigation state.
+
+    Returns ``(history_list, page_ids, page, prev_btn, next_btn,
+    search_box)``; the payload is bounded by ``SIDEBAR_PAGE_SIZE``
+    however many chats the user has saved. A non-empty ``query`` pages
+    through search results instead of the newest-first list.
+    """
+    page = max(page, 0)
+    query = (query or "").strip()
+    offset = page * SIDEBAR_PAGE_SIZE
+    if query:
+        chats = chat_store.search(
+            user_id, query, offset=offset, limit=SIDEBAR_PAGE_SIZE + 1
+        )
+    else:
+        chats = chat_store.list_chats(
+            user_id, offset=offset, limit=SIDEBAR_PAGE_SIZE + 1
+        )
+    if not chats and page > 0:
+        return sidebar_updates(user_id, page - 1, query)
+
+    has_next = len(chats) > SIDEBAR_PAGE_SIZE
+    chats = chats[:SIDEBAR_PAGE_SIZE]
+    return (
+        gr.update(samples=[[chat["title"]] for chat in chats]),
+        [chat["id"] for chat in chats],
+        page,
+        gr.update(interactive=page > 0),
+        gr.update(interactive=has_next),
+        gr.update(value=query),
+    )
+
+
+def sidebar_unchanged(page_ids: List[int], page: int):
+    """Sidebar outputs for an action that did not change the list."""
+    return (
+        gr.update(), page_ids, page, gr.update(), gr.update(), gr.update()
+    )
+
+
+@timed_handler
+def init_session(user_id: str, request: "gr.Request" = None):
+    """Assign a user id on page load and show their saved chats."""
+    user_id = resolve_user_id(user_id, request)
+    return (user_id, *sidebar_updates(user_id, 0))
+
+
+@timed_handler
+def change_sidebar_page(
+    user_id: str,
+    page: int,
+    step: int,
+    query: str = "",
+    request: "gr.Request" = None,
 ):
-    """Save current chat and start new session."""
-    print(" Starting new chat")
+    """Move the history list one page newer or older."""
+    user_id = resolve_user_id(user_id, request)
+    return sidebar_updates(user_id, page + step, query)
 
-    if current_history and len(current_history) > 0:
-        # Create title from first user message
-        title = "New Chat"
-        for msg in current_history:
-            if msg.get("role") == "user" and msg.get("content"):
-                first = msg["content"].strip()
-                title = first[:50]
-                if len(first) > 50:
-                    title += "..."
-                break
 
-        # Check duplicates
-        is_duplicate = any(
-            chat["history"] == current_history for chat in all_history
-        )
+@timed_handler
+def search_chat_history(
+    user_id: str, query: str, request: "gr.Request" = None
+):
+    """Show the first page of chats matching the search box."""
+    log.debug("Searching chats: %.50s", query)
+    user_id = resolve_user_id(user_id, request)
+    return sidebar_updates(user_id, 0, query)
 
-        if not is_duplicate:
-            all_history.insert(
-                0,
-                {
-                    "title": title,
-                    "history": current_history.copy(),
-                    "timestamp": time.time(),
-                },
-            )
 
-            # Keep only last 20 chats
-            if len(all_history) > 20:
-                all_history = all_history[:20]
+@timed_handler
+def save_and_clear_session(
+    current_history: List[Dict],
+    user_id: str,
+    conversation_id: str = "",
+    request: "gr.Request" = None,
+):
+    """Save current chat and start new session."""
+    log.debug("Starting new chat")
+    user_id = resolve_user_id(user_id, request)
+    session_cache.park(conversation_id)
 
-    # Update history buttons with delete buttons
-    history_updates: List[gr.Update] = []
-    for i in range(10):
-        if i < len(all_history):
-            history_updates.append(
-                gr.update(value=all_history[i]["title"], visible=True)
-            )
-            history_updates.append(gr.update(visible=True))
-        else:
-            history_updates.append(gr.update(visible=False))
-            history_updates.append(gr.update(visible=False))
+    if current_history and len(current_history) > 0:
+        save_chat_if_new(user_id, current_history, conversation_id)
 
     return (
-        all_history,
+        user_id,
         gr.update(value=[], visible=False),
         gr.update(visible=True),
-        *history_updates,
+        "",
+        None,
+        *sidebar_updates(user_id, 0),
     )
 
 
+@timed_handler
 def load_chat_history(
-    current_history: List[Dict], all_history: List[Dict], index: int
+    current_history: List[Dict],
+    user_id: str,
+    index: int,
+    page_ids: List[int],
+    page: int,
+    conversation_id: str = "",
+    query: str = "",
+    request: "gr.Request" = None,
 ):
     """Load selected chat history."""
-    print(f" Loading chat at index: {index}")
+    log.debug("Loading chat at index: %s", index)
+    user_id = resolve_user_id(user_id, request)
+    page_ids = page_ids or []
 
-    if index < 0 or index >= len(all_history):
-        print(f" Invalid index: {index}")
-        return all_history, gr.update(), gr.update()
+    if index is None or not 0 <= index < len(page_ids):
+        log.warning("Invalid index: %s", index)
+        return (
+            user_id, gr.update(), gr.update(), conversation_id,
+            gr.update(), *sidebar_unchanged(page_ids, page),
+        )
+    chat_id = page_ids[index]
 
     # Save current chat if not empty and not already saved
+    sidebar = sidebar_unchanged(page_ids, page)
     if current_history and len(current_history) > 0:
-        is_saved = any(
-            chat["history"] == current_history for chat in all_history
-        )
-        if not is_saved:
-            title = "New Chat"
-            for msg in current_history:
-                if msg.get("role") == "user" and msg.get("content"):
-                    first = msg["content"].strip()
-                    title = first[:50]
-                    if len(first) > 50:
-                        title += "..."
-                    break
-
-            all_history.insert(
-                0,
-                {
-                    "title": title,
-                    "history": current_history.copy(),
-                    "timestamp": time.time(),
-                },
-            )
+        if save_chat_if_new(user_id, current_history, conversation_id):
+            sidebar = sidebar_updates(user_id, page, query)
 
-            # Adjust index after insertion
-            index += 1
-
-            if len(all_history) > 20:
-                all_history = all_history[:20]
-
-    if index < len(all_history):
-        chat_to_load = all_history[index]
+    history = chat_store.get_history(user_id, chat_id)
+    if not history:
         return (
-            all_history,
-            gr.update(value=chat_to_load["history"], visible=True),
-            gr.update(visible=False),
+            user_id, gr.update(), gr.update(), conversation_id,
+            gr.update(), *sidebar,
         )
 
-    return all_history, gr.update(), gr.update()
+    # A loaded chat gets a fresh id; it takes over the chat's session,
+    # resident or spilled, if that is still around
+    session_cache.park(conversation_id)
+    loaded_id = new_conversation_id()
+    session_cache.adopt(history, loaded_id, user_id)
+    return (
+        user_id,
+        gr.update(value=history, visible=True),
+        gr.update(visible=False),
+        loaded_id,
+        chat_id,
+        *sidebar,
+    )
 
 
+@timed_handler
 def delete_chat_history(
-    all_history: List[Dict], index: int, current_history: List[Dict]
+    user_id: str,
+    chat_id: Optional[int],
+    current_history: List[Dict],
+    page: int,
+    conversation_id: str = "",
+    query: str = "",
+    request: "gr.Request" = None,
 ):
-    """Delete a specific chat from history."""
-    print(f" Deleting chat at index: {index}")
+    """Delete the selected chat from history."""
+    log.info("Deleting chat: %s", chat_id)
+    user_id = resolve_user_id(user_id, request)
 
     chatbot_update = gr.update()
     initial_view_update = gr.update()
 
-    if 0 <= index < len(all_history):
-        deleted_chat = all_history.pop(index)
-        print(f" Deleted: {deleted_chat['title']}")
+    summary = chat_store.get_summary(user_id, chat_id) if chat_id else None
+    if summary:
+        chat_store.delete_chat(user_id, chat_id)
+        session_cache.forget(user_id, summary["content_hash"])
+        log.info("Deleted: %s", summary["title"])
 
-        if current_history and current_history == deleted_chat["history"]:
+        if current_history and conversation_hasher.digest(
+            current_history, conversation_id
+        ) == summary["content_hash"]:
             chatbot_update = gr.update(value=[], visible=False)
             initial_view_update = gr.update(visible=True)
 
-    # Update all history buttons
-    history_updates: List[gr.Update] = []
-    for i in range(10):
-        if i < len(all_history):
-            history_updates.append(
-                gr.update(value=all_history[i]["title"], visible=True)
-            )
-            history_updates.append(gr.update(visible=True))
-        else:
-            history_updates.append(gr.update(visible=False))
-            history_updates.append(gr.update(visible=False))
-
     return (
-        all_history,
+        user_id,
         chatbot_update,
         initial_view_update,
-        *history_updates,
+        None,
+        *sidebar_updates(user_id, page, query),
     )
 
 
+@timed_handler
 def clear_all_history(
-    all_history: List[Dict], current_history: List[Dict]
+    user_id: str,
+    current_history: List[Dict],
+    request: "gr.Request" = None,
 ):
     """Clear all chat history."""
-    print(" Clearing all chat history")
-
-    all_history.clear()
+    log.info("Clearing all chat history")
+    user_id = resolve_user_id(user_id, request)
 
-    history_updates: List[gr.Update] = []
-    for _ in range(10):
-        history_updates.append(gr.update(visible=False))
-        history_updates.append(gr.update(visible=False))
+    chat_store.clear(user_id)
+    session_cache.forget(user_id)
 
     return (
-        all_history,
+        user_id,
         gr.update(value=[], visible=False),
         gr.update(visible=True),
-        *history_updates,
+        None,
+        *sidebar_updates(user_id, 0),
     )
 
 
-# Create Gradio Interface
-with gr.Blocks(
-    css=CSS, theme=gr.themes.Soft(), title="Manansh Chatbot"
-) as demo:
-    all_chats = gr.State([])
+# --------------------------------------------------------------------------
+# Prompt cards and prefetch
+# --------------------------------------------------------------------------
 
-    with gr.Row():
-        # Sidebar
-        with gr.Column(
-            scale=1, elem_classes="sidebar-column", min_width=280
+# Welcome-screen cards: (button label, message sent when clicked)
+PROMPT_CARDS = [
+    (
+        " Explain quantum computing\nin simple terms",
+        "Explain quantum computing in simple terms",
+    ),
+    (
+        " Creative ideas for a\n10 year old's birthday",
+        "Got any creative ideas for a 10 year old's birthday?",
+    ),
+    (
+        " How to make an HTTP\nrequest in JavaScript?",
+        "How do I make an HTTP request in JavaScript?",
+    ),
+    (
+        " Write a poem about\nartificial intelligence",
+        "Write a poem about artificial intelligence",
+    ),
+]
+
+# Off by default: every refresh spends Gemini quota
+PREFETCH_ENABLED = os.getenv("GEM_PREFETCH", "0") == "1"
+# Optional file of extra first messages to keep warm, one per line
+PREFETCH_PROMPTS_PATH = os.getenv("GEM_PREFETCH_PROMPTS", "")
+# Refresh a little before GEM_RESPONSE_CACHE_TTL runs out
+PREFETCH_INTERVAL = float(
+    os.getenv("GEM_PREFETCH_INTERVAL") or 0.9 * response_cache.ttl
+)
+# Most Gemini calls prefetching may make in 24 hours; 0 is unlimited.
+# Unset, it is what a day of refreshes needs for every prompt
+PREFETCH_DAILY_REQUESTS = os.getenv("GEM_PREFETCH_DAILY_REQUESTS")
+
+
+def prefetch_prompts(path: str = "") -> List[str]:
+    """The prompt-card messages plus those listed in ``path``."""
+    prompts = [message for _, message in PROMPT_CARDS]
+    if path:
+        with open(path, encoding="utf-8") as f:
+            prompts += [
+                line.strip() for line in f
+                if line.strip() and not line.startswith("#")
+            ]
+    unique: Dict[str, str] = {}
+    for prompt in prompts:
+        unique.setdefault(normalize_prompt(prompt), prompt)
+    return list(unique.values())
+
+
+class Prefetcher:
+    """
+    Keep replies to known first messages warm in ``response_cache``.
+
+    Each pass generates the replies that are missing or would expire
+    before the next pass, so a prompt-card click replays from the cache
+    instead of waiting for Gemini's first token. Calls go through
+    admission control as the ``prefetch`` user, are capped by a daily
+    budget, and run as single-flight leaders so a click that arrives
+    mid-generation shares the stream.
+    """
+
+    def __init__(self, prompts: List[str], interval: float,
+                 daily_requests: Optional[int] = None):
+        self.prompts = prompts
+        self.interval = interval
+        if daily_requests is None:
+            daily_requests = self.daily_calls()
+        self.daily_requests = daily_requests
+        self.budget = TokenBucket(daily_requests / 1440, daily_requests)
+        self.task: Optional[asyncio.Task] = None
+        # Cache key -> prompt, for every reply this prefetcher stored
+        self._warmed: Dict[str, str] = {}
+        self.counts = {
+            "generated": 0, "fresh": 0, "over_budget": 0, "failed": 0,
+            "served": 0,
+        }
+
+    def daily_calls(self) -> int:
+        """Gemini calls a day of refreshes makes to keep every prompt warm."""
+        if self.interval <= 0:
+            raise ValueError(
+                f"Prefetch interval must be positive, not {self.interval:g}"
+                " (set GEM_PREFETCH_INTERVAL or GEM_RESPONSE_CACHE_TTL)"
+            )
+        if response_cache.ttl <= 0:
+            return 0  # Nothing stays cached, so refresh() does nothing
+        # A reply is regenerated on the last pass before it would expire
+        passes = max(1, math.ceil(response_cache.ttl / self.interval) - 1)
+        return math.ceil(
+            len(self.prompts) * 86400 / (self.interval * passes)
+        )
+
+    async def _fresh(self, key: str) -> bool:
+        age = await response_cache.age(key)
+        return age is not None and age + self.interval < response_cache.ttl
+
+    def start(self) -> asyncio.Task:
+        """Run ``refresh()`` now and every ``interval`` seconds."""
+        needed = self.daily_calls()
+        if 0 < self.daily_requests < needed:
+            log.warning(
+                "Prefetch budget of %d calls a day is below the %d that "
+                "refreshing %d prompts every %.0f s needs; some will go "
+                "cold", self.daily_requests, needed, len(self.prompts),
+                self.interval,
+            )
+        self.task = asyncio.get_running_loop().create_task(self._run())
+        return self.task
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except Exception as prefetch_error:
+                log.warning("Prefetch pass failed: %s", prefetch_error)
+            await asyncio.sleep(self.interval)
+
+    async def refresh(self) -> None:
+        active_model = await get_model_async()
+        if (
+            active_model is None
+            or response_cache.max_size <= 0
+            or response_cache.ttl <= 0
         ):
-            gr.Markdown("# Manansh Chatbot")
-            gr.Markdown("### Your AI Assistant")
+            return
+        for prompt in self.prompts:
+            key = reply_cache_key(active_model, "", prompt)
+            if await self._fresh(key):
+                self.counts["fresh"] += 1
+                continue
+            if single_flight.in_flight(key):
+                # Someone is asking right now; their reply gets cached
+                continue
+            if self.budget.wait_time(1) > 0:
+                self.counts["over_budget"] += 1
+                continue
+            try:
+                await self._generate(active_model, key, prompt)
+            except Exception as generate_error:
+                self.counts["failed"] += 1
+                log.warning("Prefetch of %.40r failed: %s", prompt,
+                            generate_error)
+
+    async def _generate(self, active_model, key: str, prompt: str) -> None:
+        estimated = estimate_tokens(prompt) + EXPECTED_REPLY_TOKENS
+        ticket = admission.enqueue("prefetch", estimated)
+        try:
+            await ticket.future
+        finally:
+            admission.cancel(ticket)
+        # in_flight() goes last so nothing can lead between it and lead()
+        if await self._fresh(key) or single_flight.in_flight(key):
+            # A click got there while we queued; its reply gets cached
+            admission.settle("prefetch", estimated, 0)
+            return
+        self.budget.take(1)
 
-            new_chat_btn = gr.Button(
-                " New Chat", elem_classes="new-chat-btn", size="lg"
+        async def open_session(candidate, fresh: bool):
+            return candidate.start_chat(history=[]), (0, 0)
+
+        started = time.monotonic()
+        flight = single_flight.lead(
+            key, request_executor.open_stream(
+                active_model, open_session, prompt
             )
+        )
+        reply = ""
+        async for text in single_flight.follow(flight):
+            reply += text
+        admission.settle(
+            "prefetch", estimated,
+            estimate_tokens(prompt) + estimate_tokens(reply),
+        )
+        response_cache.put(key, reply, time.monotonic() - started)
+        self._warmed[key] = prompt
+        self.counts["generated"] += 1
+        log.info("Prefetched a reply to %.40r", prompt)
+
+    def record_hit(self, key: str) -> None:
+        """Count a cache hit on ``key`` if this prefetcher stored it."""
+        if key in self._warmed:
+            self.counts["served"] += 1
+
+    def stats(self) -> Dict:
+        return dict(
+            self.counts,
+            prompts=len(self.prompts),
+            budget_left=int(self.budget.tokens),
+        )
+
+
+prefetcher = Prefetcher(
+    prefetch_prompts(PREFETCH_PROMPTS_PATH if PREFETCH_ENABLED else ""),
+    PREFETCH_INTERVAL,
+    # Only work out the default budget when it will be spent
+    int(PREFETCH_DAILY_REQUESTS) if PREFETCH_DAILY_REQUESTS
+    else None if PREFETCH_ENABLED else 0,
+)
+if PREFETCH_ENABLED:
+    metrics.register("prefetch", lambda: prefetcher.stats())
+
+
+def build_demo() -> "gr.Blocks":
+    """Build the Gradio UI; see ``get_demo()`` for the shared one."""
+    with gr.Blocks(
+        css=CSS, theme=gr.themes.Soft(), title="Manansh Chatbot"
+    ) as demo:
+        # Saved chats live in chat_store; the session only keeps the user
+        # id, in browser storage when this Gradio version supports it
+        browser_state = getattr(gr, "BrowserState", None)
+        if browser_state is not None:
+            user_id = browser_state("", storage_key="gem-chatbot-user")
+        else:
+            user_id = gr.State("")
+        # Per-tab state travels with each event instead of living in one
+        # process, so any worker can serve any turn
+        conversation_id = gr.Textbox("", visible=False)
+
+        with gr.Row():
+            # Sidebar
+            with gr.Column(
+                scale=1, elem_classes="sidebar-column", min_width=280
+            ):
+                gr.Markdown("# Manansh Chatbot")
+                gr.Markdown("### Your AI Assistant")
+
+                new_chat_btn = gr.Button(
+                    " New Chat", elem_classes="new-chat-btn", size="lg"
+                )
+
+                gr.HTML('<div class="section-divider"></div>')
+                gr.Markdown("###  Chat History")
 
-            gr.HTML('<div class="section-divider"></div>')
-            gr.Markdown("###  Chat History")
+                history_search = gr.Textbox(
+                    show_label=False,
+                    placeholder=" Search chats...",
+                    max_lines=1,
+                )
+
+                # One page of saved chats, fetched from the store on demand
+                history_list = gr.Dataset(
+                    components=["textbox"],
+                    samples=[],
+                    type="index",
+                    samples_per_page=SIDEBAR_PAGE_SIZE,
+                    elem_classes="history-list",
+                    label="",
+                )
+                sidebar_ids = gr.JSON([], visible=False)
+                sidebar_page = gr.Number(0, precision=0, visible=False)
+                selected_chat = gr.Number(None, precision=0, visible=False)
 
-            # Create 10 pairs of history button + delete button
-            history_buttons = []
-            delete_buttons = []
-            for _ in range(10):
                 with gr.Row():
-                    hist_btn = gr.Button(
-                        visible=False,
+                    prev_page_btn = gr.Button(
+                        "‹ Newer",
                         elem_classes="history-btn",
-                        scale=4,
+                        size="sm",
+                        interactive=False,
                     )
-                    del_btn = gr.Button(
-                        "",
-                        visible=False,
-                        elem_classes="delete-btn",
-                        scale=1,
+                    next_page_btn = gr.Button(
+                        "Older ›",
+                        elem_classes="history-btn",
                         size="sm",
+                        interactive=False,
                     )
-                    history_buttons.append(hist_btn)
-                    delete_buttons.append(del_btn)
-
-            gr.HTML('<div class="section-divider"></div>')
-            clear_all_btn = gr.Button(
-                " Clear All History",
-                elem_classes="delete-btn",
-                size="sm",
-            )
 
-            gr.Markdown("---")
-            gr.Markdown("** Powered by Manansh**")
-            gr.Markdown("*Fast • Smart • Reliable*")
-
-        # Main Chat Area
-        with gr.Column(scale=4, elem_classes="chat-column"):
-            # Initial Welcome View
-            with gr.Column(
-                visible=True, elem_classes="welcome-section"
-            ) as initial_view:
-                gr.HTML(
-                    '<h1 class="welcome-title">'
-                    " Welcome to Manansh Chat"
-                    "</h1>"
+                delete_btn = gr.Button(
+                    " Delete Selected Chat",
+                    elem_classes="delete-btn",
+                    size="sm",
                 )
-                gr.HTML(
-                    '<p class="welcome-subtitle">'
-                    "Choose a prompt below or start typing "
-                    "your own message"
-                    "</p>"
+
+                gr.HTML('<div class="section-divider"></div>')
+                clear_all_btn = gr.Button(
+                    " Clear All History",
+                    elem_classes="delete-btn",
+                    size="sm",
                 )
 
-                with gr.Row():
-                    prompt1 = gr.Button(
-                        " Explain quantum computing\nin simple terms",
-                        elem_classes="prompt-card",
-                        size="lg",
+                gr.Markdown("---")
+                gr.Markdown("** Powered by Manansh**")
+                gr.Markdown("*Fast • Smart • Reliable*")
+
+            # Main Chat Area
+            with gr.Column(scale=4, elem_classes="chat-column"):
+                # Initial Welcome View
+                with gr.Column(
+                    visible=True, elem_classes="welcome-section"
+                ) as initial_view:
+                    gr.HTML(
+                        '<h1 class="welcome-title">'
+                        " Welcome to Manansh Chat"
+                        "</h1>"
                     )
-                    prompt2 = gr.Button(
-                        " Creative ideas for a\n"
-                        "10 year old's birthday",
-                        elem_classes="prompt-card",
-                        size="lg",
+                    gr.HTML(
+                        '<p class="welcome-subtitle">'
+                        "Choose a prompt below or start typing "
+                        "your own message"
+                        "</p>"
                     )
 
-                with gr.Row():
-                    prompt3 = gr.Button(
-                        " How to make an HTTP\n"
-                        "request in JavaScript?",
-                        elem_classes="prompt-card",
-                        size="lg",
+                    # Two cards to a row
+                    prompt_buttons = []
+                    for start in range(0, len(PROMPT_CARDS), 2):
+                        with gr.Row():
+                            for label, _ in PROMPT_CARDS[start:start + 2]:
+                                prompt_buttons.append(
+                                    gr.Button(
+                                        label,
+                                        elem_classes="prompt-card",
+                                        size="lg",
+                                    )
+                                )
+
+                # Chatbot
+                chatbot = gr.Chatbot(
+                    type="messages",
+                    avatar_images=(
+                        "https://api.dicebear.com/7.x/avataaars/svg"
+                        "?seed=User",
+                        "https://api.dicebear.com/7.x/bottts/svg?seed=Gemini",
+                    ),
+                    visible=False,
+                    height=650,
+                    show_copy_button=True,
+                    placeholder=" Your conversation will appear here...",
+                    render_markdown=True,
+                    elem_id="gem-chatbot",
+                )
+
+                # Carries delta frames when GEM_STREAM_MODE=delta
+                stream_delta = gr.Textbox(visible=False)
+
+                # Input Area
+                with gr.Row(elem_classes="input-container"):
+                    msg = gr.Textbox(
+                        show_label=False,
+                        placeholder=(
+                            " Type your message here... "
+                            "(Press Enter to send)"
+                        ),
+                        lines=2,
+                        max_lines=6,
+                        scale=9,
                     )
-                    prompt4 = gr.Button(
-                        " Write a poem about\n"
-                        "artificial intelligence",
-                        elem_classes="prompt-card",
-                        size="lg",
+                    send_btn = gr.Button(
+                        "➤", scale=1, variant="primary", size="lg"
                     )
+                    stop_btn = gr.Button("■", scale=1, size="lg")
 
-            # Chatbot
-            chatbot = gr.Chatbot(
-                type="messages",
-                avatar_images=(
-                    "https://api.dicebear.com/7.x/avataaars/svg"
-                    "?seed=User",
-                    "https://api.dicebear.com/7.x/bottts/svg?seed=Gemini",
-                ),
-                visible=False,
-                height=650,
-                show_copy_button=True,
-                placeholder=" Your conversation will appear here...",
-                render_markdown=True,
+        # Event Handlers
+
+        add_message, show_chat, stream_fn = MESSAGE_CHAIN
+        if STREAM_MODE == "delta":
+            stream_outputs = [chatbot, stream_delta]
+            stream_delta.change(
+                None, [stream_delta], None, js=STREAM_DELTA_JS
             )
+        else:
+            stream_outputs = [chatbot]
 
-            # Input Area
-            with gr.Row(elem_classes="input-container"):
-                msg = gr.Textbox(
-                    show_label=False,
-                    placeholder=(
-                        " Type your message here... "
-                        "(Press Enter to send)"
-                    ),
-                    lines=2,
-                    max_lines=6,
-                    scale=9,
+        def message_chain(trigger, message_input):
+            """Add the message, show the chat, then stream the reply."""
+            return (
+                trigger(
+                    add_message,
+                    [message_input, chatbot, conversation_id],
+                    [chatbot, conversation_id],
+                    queue=False,
                 )
-                send_btn = gr.Button(
-                    "➤", scale=1, variant="primary", size="lg"
+                .then(show_chat, [chatbot], [initial_view, chatbot, msg])
+                .then(
+                    stream_fn,
+                    [chatbot, conversation_id, user_id],
+                    stream_outputs,
+                    concurrency_limit=STREAM_CONCURRENCY_LIMIT,
                 )
+            )
+
+        # Text input submission and send button click
+        msg_submit = message_chain(msg.submit, msg)
+        send_click = message_chain(send_btn.click, msg)
+
+        # Prompt card buttons
+        stream_events = [msg_submit, send_click]
+        for (_, prompt_text), prompt_btn in zip(
+            PROMPT_CARDS, prompt_buttons
+        ):
+            stream_events.append(
+                message_chain(prompt_btn.click, gr.State(prompt_text))
+            )
+
+        # Stop generating; the stream closes its upstream request too
+        stop_btn.click(None, None, None, cancels=stream_events, queue=False)
+
+        sidebar_components = [
+            history_list,
+            sidebar_ids,
+            sidebar_page,
+            prev_page_btn,
+            next_page_btn,
+            history_search,
+        ]
 
-    # Event Handlers
+        # Show the saved chats as soon as the page opens
+        demo.load(init_session, [user_id], [user_id] + sidebar_components)
 
-    # Text input submission
-    msg_submit = (
-        msg.submit(
-            handle_user_message, [msg, chatbot], [chatbot], queue=False
+        # New chat button
+        new_chat_btn.click(
+            save_and_clear_session,
+            [chatbot, user_id, conversation_id],
+            [user_id, chatbot, initial_view, conversation_id, selected_chat]
+            + sidebar_components,
+            cancels=stream_events,
         )
-        .then(
-            show_chat_and_clear_textbox,
-            [chatbot],
-            [initial_view, chatbot, msg],
+
+        # Selecting a saved chat loads it
+        history_list.click(
+            load_chat_history,
+            inputs=[
+                chatbot,
+                user_id,
+                history_list,
+                sidebar_ids,
+                sidebar_page,
+                conversation_id,
+                history_search,
+            ],
+            outputs=[user_id, chatbot, initial_view, conversation_id,
+                     selected_chat] + sidebar_components,
+            cancels=stream_events,
         )
-        .then(chat_response_stream, [chatbot], [chatbot])
-    )
 
-    # Send button click
-    send_click = (
-        send_btn.click(
-            handle_user_message, [msg, chatbot], [chatbot], queue=False
+        # Page through older chats
+        for page_btn, step in ((prev_page_btn, -1), (next_page_btn, 1)):
+            page_btn.click(
+                change_sidebar_page,
+                inputs=[user_id, sidebar_page, gr.State(step), history_search],
+                outputs=sidebar_components,
+            )
+
+        # Full-text search over saved chats
+        history_search.submit(
+            search_chat_history,
+            inputs=[user_id, history_search],
+            outputs=sidebar_components,
         )
-        .then(
-            show_chat_and_clear_textbox,
-            [chatbot],
-            [initial_view, chatbot, msg],
+
+        # Delete the selected chat
+        delete_btn.click(
+            delete_chat_history,
+            inputs=[user_id, selected_chat, chatbot, sidebar_page,
+                    conversation_id, history_search],
+            outputs=[user_id, chatbot, initial_view, selected_chat]
+            + sidebar_components,
         )
-        .then(chat_response_stream, [chatbot], [chatbot])
-    )
 
-    # New chat button
-    all_history_components = []
-    for i in range(10):
-        all_history_components.append(history_buttons[i])
-        all_history_components.append(delete_buttons[i])
+        # Clear all history button
+        clear_all_btn.click(
+            clear_all_history,
+            inputs=[user_id, chatbot],
+            outputs=[user_id, chatbot, initial_view, selected_chat]
+            + sidebar_components,
+        )
+    return demo
 
-    new_chat_btn.click(
-        save_and_clear_session,
-        [chatbot, all_chats],
-        [all_chats, chatbot, initial_view] + all_history_components,
-    )
 
-    # History load buttons
-    for i, btn in enumerate(history_buttons):
-        btn.click(
-            load_chat_history,
-            inputs=[chatbot, all_chats, gr.State(i)],
-            outputs=[all_chats, chatbot, initial_view],
+_demo = None
+_demo_lock = threading.Lock()
+
+
+def get_demo() -> "gr.Blocks":
+    """The app's UI, built on first use so engine-only imports skip it."""
+    global _demo
+    with _demo_lock:
+        if _demo is None:
+            _demo = build_demo()
+        return _demo
+
+
+def __getattr__(name: str):
+    # ``chatbot.demo`` still works for ``gradio chatbot.py`` and scripts
+    if name == "demo":
+        return get_demo()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# --------------------------------------------------------------------------
+# HTTP API
+# --------------------------------------------------------------------------
+
+# Opt-in, like metrics: the API needs the FastAPI app and uvicorn
+API_ENABLED = os.getenv("GEM_API", "0") == "1"
+# Bearer token for /v1. Saved conversations are only served with it set,
+# since X-User-Id alone would let anyone read anyone's chats
+API_TOKEN = os.getenv("GEM_API_TOKEN", "")
+
+# Replies a single /v1/chat/batch call may run at once
+API_BATCH_CONCURRENCY = int(os.getenv("GEM_API_BATCH_CONCURRENCY", "4"))
+API_BATCH_MAX = int(os.getenv("GEM_API_BATCH_MAX", "100"))
+
+
+def sse_event(kind: str, payload) -> str:
+    return f"event: {kind}\ndata: {json.dumps(payload)}\n\n"
+
+
+def create_api_router():
+    """
+    JSON/SSE endpoints over the same engine, caches and store as the UI.
+
+    Requests are served directly on the event loop rather than through
+    the Gradio queue, so a backlog in the UI doesn't hold them up; both
+    share the rate limits.
+
+    With ``GEM_API_TOKEN`` set, every call needs it as a bearer token.
+    Saved conversations belong to the caller's ``X-User-Id``, the same
+    id the UI keeps in the browser; the header is taken on trust from
+    token holders, so those endpoints are refused without a token.
+    """
+    from fastapi import APIRouter, Depends, HTTPException, Request
+    from fastapi.responses import StreamingResponse
+    from pydantic import BaseModel
+
+    class Message(BaseModel):
+        role: str
+        content: str
+
+    class ChatRequest(BaseModel):
+        message: str
+        history: List[Message] = []
+        conversation_id: str = ""
+        stream: bool = True
+
+    class BatchRequest(BaseModel):
+        requests: List[ChatRequest]
+
+    class SaveRequest(BaseModel):
+        messages: List[Message]
+        conversation_id: str = ""
+
+    class DeleteRequest(BaseModel):
+        ids: List[int]
+
+    def check_token(request: Request) -> None:
+        if not API_TOKEN:
+            return
+        scheme, _, token = request.headers.get(
+            "authorization", ""
+        ).partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(
+            token.strip().encode(), API_TOKEN.encode()
+        ):
+            raise HTTPException(
+                401, "A valid bearer token is required",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+
+    router = APIRouter(prefix="/v1", dependencies=[Depends(check_token)])
+
+    def api_user(request: Request) -> str:
+        if not API_TOKEN:
+            raise HTTPException(
+                403, "Set GEM_API_TOKEN to enable the conversations API"
+            )
+        user_id = request.headers.get("x-user-id", "").strip()
+        if not user_id:
+            raise HTTPException(400, "X-User-Id header is required")
+        return user_id
+
+    def check_message(body: ChatRequest) -> None:
+        if not body.message.strip():
+            raise HTTPException(400, "message must not be empty")
+        if len(body.message.strip()) > MAX_MESSAGE_CHARS:
+            raise HTTPException(
+                413, f"message is over {MAX_MESSAGE_CHARS} characters"
+            )
+
+    async def run_turn(body: ChatRequest, user_key: str) -> Dict:
+        async for kind, payload in reply_events(
+            body.message,
+            [msg.model_dump() for msg in body.history],
+            body.conversation_id,
+            user_key,
+        ):
+            if kind == "error":
+                return {"error": payload}
+            if kind == "done":
+                return payload
+        return {"error": "No reply"}
+
+    @router.post("/chat")
+    async def chat(body: ChatRequest, request: Request):
+        check_message(body)
+        user_key = request_user_key(request)
+        if not body.stream:
+            result = await run_turn(body, user_key)
+            if "error" in result:
+                raise HTTPException(502, result["error"])
+            return result
+
+        async def events():
+            async for kind, payload in reply_events(
+                body.message,
+                [msg.model_dump() for msg in body.history],
+                body.conversation_id,
+                user_key,
+            ):
+                if kind == "delta":
+                    payload = {"text": payload}
+                elif kind in ("status", "error"):
+                    payload = {"message": payload}
+                yield sse_event(kind, payload)
+
+        return StreamingResponse(
+            events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
         )
 
-    # Delete buttons for individual chats
-    for i, del_btn in enumerate(delete_buttons):
-        del_btn.click(
-            delete_chat_history,
-            inputs=[all_chats, gr.State(i), chatbot],
-            outputs=[
-                all_chats,
-                chatbot,
-                initial_view,
-            ]
-            + all_history_components,
+    @router.post("/chat/batch")
+    async def chat_batch(body: BatchRequest, request: Request):
+        if len(body.requests) > API_BATCH_MAX:
+            raise HTTPException(
+                413, f"At most {API_BATCH_MAX} requests per batch"
+            )
+        for item in body.requests:
+            check_message(item)
+        user_key = request_user_key(request)
+        limit = asyncio.Semaphore(API_BATCH_CONCURRENCY)
+
+        async def one(item: ChatRequest) -> Dict:
+            async with limit:
+                return await run_turn(item, user_key)
+
+        results = await asyncio.gather(*(one(item) for item in body.requests))
+        return {"results": results}
+
+    @router.get("/conversations")
+    def list_conversations(
+        request: Request, offset: int = 0, limit: int = 20, q: str = ""
+    ):
+        user_id = api_user(request)
+        if offset < 0:
+            raise HTTPException(400, "offset must not be negative")
+        limit = max(1, min(limit, 100))
+        if q.strip():
+            chats = chat_store.search(user_id, q, offset=offset, limit=limit)
+        else:
+            chats = chat_store.list_chats(user_id, offset=offset, limit=limit)
+        return {"conversations": chats}
+
+    @router.get("/conversations/{chat_id}")
+    def get_conversation(chat_id: int, request: Request):
+        user_id = api_user(request)
+        summary = chat_store.get_summary(user_id, chat_id)
+        if summary is None:
+            raise HTTPException(404, "Conversation not found")
+        return dict(
+            summary, messages=chat_store.get_history(user_id, chat_id)
         )
 
-    # Clear all history button
-    clear_all_btn.click(
-        clear_all_history,
-        inputs=[all_chats, chatbot],
-        outputs=[all_chats, chatbot, initial_view]
-        + all_history_components,
-    )
+    @router.post("/conversations", status_code=201)
+    def save_conversation(body: SaveRequest, request: Request):
+        user_id = api_user(request)
+        history = [msg.model_dump() for msg in body.messages]
+        if not history:
+            raise HTTPException(400, "messages must not be empty")
+        created = save_chat_if_new(user_id, history, body.conversation_id)
+        digest = conversation_hasher.digest(history, body.conversation_id)
+        return {
+            "id": chat_store.find_chat(user_id, digest),
+            "created": created,
+        }
 
-    # Prompt card buttons
-    prompts = [
-        ("Explain quantum computing in simple terms", prompt1),
-        (
-            "Got any creative ideas for a 10 year old's birthday?",
-            prompt2,
+    @router.delete("/conversations/{chat_id}", status_code=204)
+    def delete_conversation(chat_id: int, request: Request):
+        user_id = api_user(request)
+        summary = chat_store.get_summary(user_id, chat_id)
+        if summary is None:
+            raise HTTPException(404, "Conversation not found")
+        chat_store.delete_chat(user_id, chat_id)
+        session_cache.forget(user_id, summary["content_hash"])
+
+    @router.post("/conversations/delete")
+    def delete_conversations(body: DeleteRequest, request: Request):
+        user_id = api_user(request)
+        deleted = []
+        for chat_id in body.ids:
+            summary = chat_store.get_summary(user_id, chat_id)
+            if summary is not None:
+                chat_store.delete_chat(user_id, chat_id)
+                session_cache.forget(user_id, summary["content_hash"])
+                deleted.append(chat_id)
+        return {"deleted": deleted}
+
+    @router.delete("/conversations", status_code=204)
+    def clear_conversations(request: Request):
+        user_id = api_user(request)
+        chat_store.clear(user_id)
+        session_cache.forget(user_id)
+
+    return router
+
+
+def create_app():
+    """FastAPI app serving the chat UI at ``/``, ``/v1`` and ``/metrics``."""
+    from fastapi import FastAPI
+    from fastapi.responses import PlainTextResponse
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        # Warm the prompt-card replies on the serving event loop
+        task = prefetcher.start() if PREFETCH_ENABLED else None
+        try:
+            yield
+        finally:
+            if task is not None:
+                task.cancel()
+            if isinstance(genai, RestGemini):
+                # Close pooled connections on the loop that owns them
+                await genai.aclose()
+
+    app = FastAPI(lifespan=lifespan)
+    if API_ENABLED:
+        app.include_router(create_api_router())
+    if METRICS_ENABLED:
+        @app.get("/metrics")
+        def metrics_endpoint():
+            return PlainTextResponse(
+                metrics.render(), media_type="text/plain; version=0.0.4"
+            )
+
+    demo = get_demo()
+    demo.show_error = True
+    return gr.mount_gradio_app(app, demo.queue(), path="/")
+
+
+# --------------------------------------------------------------------------
+# Multi-worker serving
+# --------------------------------------------------------------------------
+
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "transfer-encoding", "upgrade",
+    "proxy-connection", "te", "trailer",
+}
+
+
+def worker_for(client_host: str, workers: int) -> int:
+    """Pick a client's worker; the same address always gets the same one."""
+    return zlib.crc32(client_host.encode()) % workers
+
+
+def create_proxy_app(backends: List[str]):
+    """
+    ASGI app that forwards each client to one worker, chosen by address.
+
+    Gradio's queue keeps an event in the process that accepted it, so
+    the request that joins the queue and the stream that reads it must
+    reach the same worker. Hashing the client address does that without
+    shared queue state. If a worker is down the next one is tried; the
+    conversation travels with the request, so the new worker can carry
+    on. Behind another proxy, put that one in front (its
+    X-Forwarded-For is kept) or hash on a cookie there instead.
+    """
+    import httpx
+    from starlette.applications import Starlette
+    from starlette.background import BackgroundTask
+    from starlette.responses import PlainTextResponse, StreamingResponse
+    from starlette.routing import Route
+
+    client = httpx.AsyncClient(
+        timeout=httpx.Timeout(None, connect=5.0),
+        limits=httpx.Limits(
+            max_connections=None, max_keepalive_connections=100
         ),
-        ("How do I make an HTTP request in JavaScript?", prompt3),
-        ("Write a poem about artificial intelligence", prompt4),
-    ]
+    )
 
-    for prompt_text, prompt_btn in prompts:
-        (
-            prompt_btn.click(
-                handle_user_message,
-                [gr.State(prompt_text), chatbot],
-                [chatbot],
-                queue=False,
+    async def forward(request):
+        peer = request.client.host if request.client else ""
+        forwarded = request.headers.get("x-forwarded-for", "")
+        # Stick to the original client when there is a proxy in front
+        address = forwarded.split(",")[0].strip() or peer
+        headers = [
+            (name, value) for name, value in request.headers.raw
+            if name.decode("latin-1").lower()
+            not in HOP_BY_HOP_HEADERS | {"x-forwarded-for"}
+        ]
+        headers.append((
+            b"x-forwarded-for",
+            (f"{forwarded}, {peer}" if forwarded else peer).encode(),
+        ))
+        body = await request.body()
+        path = request.url.path
+        if request.url.query:
+            path += "?" + request.url.query
+
+        first = worker_for(address, len(backends))
+        for offset in range(len(backends)):
+            backend = backends[(first + offset) % len(backends)]
+            upstream_request = client.build_request(
+                request.method, backend + path, headers=headers, content=body
             )
-            .then(
-                show_chat_and_clear_textbox,
-                [chatbot],
-                [initial_view, chatbot, msg],
+            try:
+                upstream = await client.send(upstream_request, stream=True)
+            except httpx.ConnectError:
+                log.warning("Worker %s unreachable, trying the next", backend)
+                continue
+            return StreamingResponse(
+                upstream.aiter_raw(),
+                status_code=upstream.status_code,
+                headers={
+                    name: value for name, value in upstream.headers.items()
+                    if name.lower() not in HOP_BY_HOP_HEADERS
+                },
+                background=BackgroundTask(upstream.aclose),
+            )
+        return PlainTextResponse("No workers available", status_code=503)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        yield
+        await client.aclose()
+
+    methods = ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "HEAD"]
+    return Starlette(
+        routes=[Route("/{path:path}", forward, methods=methods)],
+        lifespan=lifespan,
+    )
+
+
+def serve_workers(
+    workers: int, host: str, port: int, app: str = "chatbot:create_app"
+) -> None:
+    """
+    Run ``workers`` app processes behind one sticky front port.
+
+    Each worker is a uvicorn process running the ``app`` factory on
+    ``port + i`` that trusts the front proxy's X-Forwarded-For, so
+    per-user rate limits still see real client addresses. Chats are
+    shared through the SQLite chat store, and replies through a shared
+    response cache file. Limits that apply to the whole deployment are
+    divided between workers.
+    """
+    import uvicorn
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, GEM_WORKERS="1")
+    env.setdefault(
+        "GEM_RESPONSE_CACHE_PATH", os.path.join(here, "response_cache.db")
+    )
+    if env.get("GEM_CHAT_STORE", "").startswith("memory://"):
+        log.warning("memory:// chat stores are not shared between workers")
+    # Deployment-wide limits become per-worker shares
+    totals = {
+        "GEM_GLOBAL_RPM": admission.global_requests.per_minute,
+        "GEM_GLOBAL_TPM": admission.global_tokens.per_minute,
+        "GEM_STREAM_CONCURRENCY": STREAM_CONCURRENCY_LIMIT or 0,
+    }
+    for name, total in totals.items():
+        if total:
+            env[name] = str(max(1, int(total // workers)))
+
+    processes = []
+    backends = []
+    for index in range(workers):
+        worker_port = port + 1 + index
+        backends.append(f"http://127.0.0.1:{worker_port}")
+        processes.append(
+            subprocess.Popen(
+                [
+                    sys.executable, "-m", "uvicorn", app,
+                    "--factory", "--app-dir", here,
+                    "--host", "127.0.0.1", "--port", str(worker_port),
+                    "--proxy-headers", "--forwarded-allow-ips", "127.0.0.1",
+                ],
+                # The cache file is shared, so one worker prefetches
+                env=dict(env, GEM_PREFETCH="0") if index else env,
             )
-            .then(chat_response_stream, [chatbot], [chatbot])
         )
+    try:
+        uvicorn.run(create_proxy_app(backends), host=host, port=port)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
 
 
-if __name__ == "__main__":
+# --------------------------------------------------------------------------
+# Batch mode
+# --------------------------------------------------------------------------
+
+# How often a running batch logs its progress
+BATCH_REPORT_SECONDS = float(os.getenv("GEM_BATCH_REPORT_SECONDS", "10"))
+
+
+def batch_item(line: str, number: int) -> Tuple[str, str, List[Dict]]:
+    """
+    Parse one input line into ``(id, message, history)``.
+
+    Lines are JSON objects with a ``prompt`` (or ``message``), or with
+    ``messages`` whose last entry is the user turn to answer. Items
+    without an ``id`` are numbered by line.
+    """
+    item = json.loads(line)
+    if isinstance(item, str):
+        item = {"prompt": item}
+    if not isinstance(item, dict):
+        raise ValueError("each line must be a JSON object or string")
+    item_id = str(item.get("id", number))
+    if "messages" in item:
+        if not isinstance(item["messages"], list) or not all(
+            isinstance(msg, dict)
+            and isinstance(msg.get("role"), str)
+            and isinstance(msg.get("content"), str)
+            for msg in item["messages"]
+        ):
+            raise ValueError(
+                "messages must be a list of objects with string "
+                "role and content"
+            )
+        messages = [
+            {"role": msg["role"], "content": msg["content"]}
+            for msg in item["messages"]
+        ]
+        if not messages or messages[-1]["role"] != "user":
+            raise ValueError("the last message must be from the user")
+        return item_id, messages[-1]["content"], messages[:-1]
+    message = item.get("prompt") or item.get("message") or ""
+    if not isinstance(message, str):
+        raise ValueError("prompt must be a string")
+    return item_id, message, []
+
+
+def completed_batch_ids(output_path: str) -> set:
+    """
+    Ids already answered in ``output_path``, so a rerun can skip them.
+
+    A line cut short by a crash is dropped from the file first, so
+    appending carries on from a clean line boundary.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    for line in data[:end].splitlines():
+        try:
+            result = json.loads(line)
+        except ValueError:
+            continue
+        # Unparseable lines fail the same way every time
+        if "reply" in result or result.get("bad_input"):
+            done.add(str(result["id"]))
+    return done
+
+
+async def run_batch(
+    input_path: str,
+    output_path: str,
+    concurrency: int = 4,
+    resume: bool = True,
+    max_errors: int = 20,
+) -> Dict:
+    """
+    Answer every item of a JSONL file and append results as they finish.
+
+    Items go through ``reply_events`` like UI and API turns, so model
+    selection, retries, failover, caching and the rate limits all apply.
+    The output file is the checkpoint: on resume, items that already
+    have a reply, or could not be parsed, are skipped and failed ones
+    are tried again. The run stops early after ``max_errors`` failures
+    in a row (for example when every model is out of quota) and can be
+    resumed later.
+    """
+    done = completed_batch_ids(output_path) if resume else set()
+    work: "asyncio.Queue" = asyncio.Queue(maxsize=concurrency * 2)
+    stats = {"ok": 0, "error": 0, "skipped": 0, "chars": 0}
+    consecutive_errors = 0
+    stop = asyncio.Event()
+    started = time.monotonic()
+    mode = "a" if resume else "w"
+
+    with open(output_path, mode, encoding="utf-8") as out:
+
+        def write(result: Dict) -> None:
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+
+        async def produce() -> None:
+            with open(input_path, encoding="utf-8") as f:
+                for number, line in enumerate(f, 1):
+                    if stop.is_set():
+                        break
+                    if not line.strip():
+                        continue
+                    try:
+                        item = batch_item(line, number)
+                    except (ValueError, KeyError, TypeError) as e:
+                        if str(number) in done:
+                            stats["skipped"] += 1
+                            continue
+                        write({
+                            "id": str(number), "error": f"Bad input: {e}",
+                            "bad_input": True,
+                        })
+                        stats["error"] += 1
+                        continue
+                    if item[0] in done:
+                        stats["skipped"] += 1
+                        continue
+                    await work.put(item)
+            for _ in range(concurrency):
+                await work.put(None)
+
+        async def consume() -> None:
+            nonlocal consecutive_errors
+            while True:
+                item = await work.get()
+                if item is None:
+                    return
+                if stop.is_set():
+                    continue
+                item_id, message, history = item
+                item_started = time.monotonic()
+                result: Dict = {"id": item_id}
+                async for kind, payload in reply_events(
+                    message, history, user_key="batch"
+                ):
+                    if kind == "done":
+                        result["reply"] = payload["reply"]
+                    elif kind == "error":
+                        result["error"] = payload
+                result["latency_s"] = round(
+                    time.monotonic() - item_started, 3
+                )
+                write(result)
+                if "reply" in result:
+                    stats["ok"] += 1
+                    stats["chars"] += len(result["reply"])
+                    consecutive_errors = 0
+                else:
+                    stats["error"] += 1
+                    consecutive_errors += 1
+                    if max_errors and consecutive_errors >= max_errors:
+                        log.error(
+                            "Stopping after %d failures in a row; rerun "
+                            "to resume", consecutive_errors,
+                        )
+                        stop.set()
+
+        async def report() -> None:
+            while True:
+                await asyncio.sleep(BATCH_REPORT_SECONDS)
+                elapsed = time.monotonic() - started
+                finished = stats["ok"] + stats["error"]
+                log.info(
+                    "Batch: %d ok, %d failed, %d skipped, %.2f items/s",
+                    stats["ok"], stats["error"], stats["skipped"],
+                    finished / elapsed,
+                )
+
+        reporter = asyncio.create_task(report())
+        try:
+            await asyncio.gather(
+                produce(), *(consume() for _ in range(concurrency))
+            )
+        finally:
+            reporter.cancel()
+
+    elapsed = time.monotonic() - started
+    finished = stats["ok"] + stats["error"]
+    stats.update(
+        wall_s=elapsed,
+        items_per_s=finished / elapsed if elapsed else 0.0,
+        chars_per_s=stats["chars"] / elapsed if elapsed else 0.0,
+        stopped_early=stop.is_set(),
+    )
+    return stats
+
+
+def launch_ui() -> None:
+    """Print the startup banner and serve the UI until interrupted."""
     print("=" * 60)
     print(" Starting Gemini Chat AI Application...")
     print("=" * 60)
 
-    if not model:
+    if not GOOGLE_API_KEY:
         print("\n  WARNING: Model not initialized!")
         print(" Please ensure your .env file contains:")
         print("   GOOGLE_API_KEY=your_actual_api_key")
         print("\n Get your API key from:")
         print("   https://aistudio.google.com/app/apikey")
     else:
-        print("\n Model initialized successfully!")
-        print("🤖 Using: Gemini Pro")
+        # Resolve the model off the startup path
+        start_model_discovery()
+        print("\n Model discovery running in background...")
 
     print("\n Features enabled:")
     print("   • Real-time streaming responses")
@@ -841,17 +5404,112 @@ if __name__ == "__main__":
     print("   • Clear all history")
     print("   • Markdown rendering")
     print("   • Copy response button")
+    if PREFETCH_ENABLED:
+        print(f"   • Prefetching {len(prefetcher.prompts)} prompt replies")
+
+    if WORKERS > 1:
+        print(f"\n Serving on http://{SERVER_HOST}:{SERVER_PORT}")
+        print(f" Workers: {WORKERS} (ports {SERVER_PORT + 1}-"
+              f"{SERVER_PORT + WORKERS})")
+        print("=" * 60)
+        serve_workers(WORKERS, SERVER_HOST, SERVER_PORT)
+    elif METRICS_ENABLED or API_ENABLED or PREFETCH_ENABLED:
+        # Only when asked for: serve the UI from our own app so /v1
+        # and /metrics sit alongside it, and prefetch can start with
+        # the server
+        import uvicorn
+
+        base_url = f"http://{SERVER_HOST}:{SERVER_PORT}"
+        print(f"\n Serving on {base_url}")
+        if API_ENABLED:
+            print(f" API: {base_url}/v1 (docs at {base_url}/docs)")
+            if not API_TOKEN:
+                print(" API: no GEM_API_TOKEN, conversations API is off")
+        if METRICS_ENABLED:
+            print(f" Metrics: {base_url}/metrics")
+        print("=" * 60)
+        uvicorn.run(create_app(), host=SERVER_HOST, port=SERVER_PORT)
+    else:
+        print("\n Opening in browser...")
+        print(" Debug mode: Enabled")
+        print("=" * 60)
+
+        get_demo().queue().launch(
+            debug=True,
+            show_error=True,
+            inbrowser=True,
+            server_name=SERVER_HOST,
+            server_port=SERVER_PORT,
+            share=False,
+        )
 
-    print("\n Opening in browser...")
-    print(" Debug mode: Enabled")
-    print("=" * 60)
 
-    demo.queue().launch(
-        debug=True,
-        show_error=True,
-        inbrowser=True,
-        server_name="127.0.0.1",
-        server_port=7860,
-        share=False,
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Manansh Chatbot")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("ui", help="serve the chat UI (the default)")
+    batch = commands.add_parser(
+        "batch", help="answer a JSONL file of prompts or conversations"
     )
+    batch.add_argument("input", help="JSONL file to read")
+    batch.add_argument(
+        "-o", "--output", required=True,
+        help="JSONL file for results; also the checkpoint for --resume",
+    )
+    batch.add_argument(
+        "-c", "--concurrency", type=int, default=4,
+        help="replies in flight at once",
+    )
+    batch.add_argument(
+        "--restart", action="store_true",
+        help="overwrite the output instead of resuming from it",
+    )
+    batch.add_argument(
+        "--rpm", type=float,
+        help="requests per minute for this run (default GEM_USER_RPM)",
+    )
+    batch.add_argument(
+        "--tpm", type=float,
+        help="tokens per minute for this run (default GEM_USER_TPM)",
+    )
+    batch.add_argument(
+        "--max-errors", type=int, default=20,
+        help="stop after this many failures in a row (0 = never)",
+    )
+    args = parser.parse_args(argv)
+
+    if args.command != "batch":
+        launch_ui()
+        return
 
+    global admission
+    if args.rpm is not None or args.tpm is not None:
+        admission = AdmissionController(
+            global_rpm=admission.global_requests.per_minute,
+            global_tpm=admission.global_tokens.per_minute,
+            user_rpm=admission.user_rpm if args.rpm is None else args.rpm,
+            user_tpm=admission.user_tpm if args.tpm is None else args.tpm,
+        )
+    if GOOGLE_API_KEY:
+        start_model_discovery()
+    stats = asyncio.run(
+        run_batch(
+            args.input,
+            args.output,
+            concurrency=max(1, args.concurrency),
+            resume=not args.restart,
+            max_errors=args.max_errors,
+        )
+    )
+    print(
+        f" {stats['ok']} answered, {stats['error']} failed, "
+        f"{stats['skipped']} already done in {stats['wall_s']:.1f} s "
+        f"({stats['items_per_s']:.2f} items/s, "
+        f"{stats['chars_per_s']:.0f} chars/s)"
+    )
+    if stats["stopped_early"]:
+        print(" Stopped early; run the same command again to resume.")
+
+
+if __name__ == "__main__":
+    main()